@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import timeit
+
+import click
+import numpy as np
+import numpy.ma as ma
+
+from projections.rasterset.executor import BufferPool
+
+NODATA = -9999.0
+
+def masked_path(namask, data):
+  # What _eval_block() used to do: re-inflate into a masked array and
+  # fill it.
+  arr = ma.empty_like(namask, dtype=np.float32)
+  arr.mask = namask
+  arr[~namask] = data
+  return arr.filled(NODATA)
+
+def pooled_path(pool, namask, data):
+  out = pool.get(namask.shape)
+  out[~namask] = data
+  pool.put(out)
+  return out
+
+@click.command()
+@click.option('--block', type=int, default=1024,
+              help='Side of the (square) block')
+@click.option('--valid', type=float, default=0.3,
+              help='Fraction of valid cells (land)')
+@click.option('--number', '-n', type=int, default=50)
+def main(block, valid, number):
+  """Compare the cost of turning the dense results of a block into the
+float32 array handed to the writer: through a masked array and filled()
+and straight into a block from a BufferPool.
+
+  """
+  rng = np.random.default_rng(0)
+  namask = rng.random((block, block)) > valid
+  data = rng.random(np.count_nonzero(~namask), dtype=np.float32)
+  pool = BufferPool(NODATA)
+  assert np.array_equal(masked_path(namask, data),
+                        pooled_path(pool, namask, data))
+  t1 = timeit.timeit(lambda: masked_path(namask, data),
+                     number=number) / number
+  t2 = timeit.timeit(lambda: pooled_path(pool, namask, data),
+                     number=number) / number
+  print("masked %8.4fs  pooled %8.4fs  (%.1fx, %d buffers)" %
+        (t1, t2, t1 / t2, pool.allocated))
+
+if __name__ == '__main__':
+  main()
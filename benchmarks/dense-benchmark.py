@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import timeit
+
+import click
+import numpy as np
+import numpy.ma as ma
+
+from projections.r2py import reval, rparser, tree
+
+EXPRS = ('log(hpd + 1)',
+         'cropland + pasture + primary + secondary + urban',
+         'log(hpd + 1) / 10.02 * 2 - 1',
+         'clip(cropland * 0.25 + pasture * 0.5 - urban, 0, 1) * ' +
+         'exp(primary / (secondary + 1))')
+
+@click.command()
+@click.option('--size', type=int, default=4 * 1024 * 1024,
+              help='Number of (dense) cells')
+@click.option('--chunk', type=int, default=reval.DENSE_CHUNK)
+@click.option('--number', '-n', type=int, default=5)
+def main(size, chunk, number):
+  """Compare the numpy.ma code generated by to_py() with the chunked
+ufunc code generated by to_dense() on dense inputs (the columns of a
+RasterSet after dropna()).
+
+  """
+  rng = np.random.default_rng(0)
+  names = ('cropland', 'pasture', 'primary', 'secondary', 'urban', 'hpd')
+  stab = dict((name, rng.random(size, dtype=np.float32)) for name in names)
+  for expr in EXPRS:
+    root = tree.optimize(reval.make_inputs(rparser.parse(expr)))
+    slow = {}
+    fast = {}
+    exec(reval.to_py(root, 'f'), slow)
+    exec(reval.to_dense(root, 'f', chunk), fast)
+    r1 = slow['f_st'](stab)
+    r2 = fast['f_st'](stab)
+    assert np.array_equal(ma.getdata(r1), ma.getdata(r2)), expr
+    t1 = timeit.timeit(lambda: slow['f_st'](stab), number=number) / number
+    t2 = timeit.timeit(lambda: fast['f_st'](stab), number=number) / number
+    print(expr)
+    print("  numpy.ma %8.4fs  dense %8.4fs  (%.1fx)" % (t1, t2, t1 / t2))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import time
+import tracemalloc
+
+import click
+
+from projections.rasterset import RasterSet
+import projections.predicts as predicts
+
+def run(scenario, year, what, fuse):
+  rs = RasterSet(predicts.luh2(scenario, year, 'medium'), fuse=fuse)
+  plan = rs.plan(what)
+  # Compile the fused kernels before measuring.
+  rs.eval(what, quiet=True)
+  tracemalloc.start()
+  stime = time.time()
+  rs.eval(what, quiet=True)
+  elapsed = time.time() - stime
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return len(plan), elapsed, peak
+
+@click.command()
+@click.argument('what', nargs=-1)
+@click.option('--scenario', '-s', default='historical')
+@click.option('--year', '-y', type=int, default=2000)
+def main(what, scenario, year):
+  """Compare evaluation of the luh2 raster set with and without fusing
+chains of SimpleExpr columns.  Reports the number of evaluated columns,
+wall time and peak memory allocated by numpy during evaluation.
+
+  """
+  for target in what or ('secondary', 'logHPD_diff', 'logHPD_rs'):
+    for fuse in (False, True):
+      ncols, elapsed, peak = run(scenario, year, target, fuse)
+      print("%-20s fuse=%-5s %3d columns %8.3fs peak %8.1f MB" %
+            (target, fuse, ncols, elapsed, peak / (1024.0 * 1024)))
+
+if __name__ == '__main__':
+  main()
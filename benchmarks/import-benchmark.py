@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os
+import re
+import subprocess
+import sys
+
+import click
+
+PROBE = '''
+import sys
+import time
+stime = time.time()
+try:
+  import {module}
+  status = 'ok'
+except BaseException as e:
+  status = '%s: %s' % (type(e).__name__, e)
+elapsed = time.time() - stime
+heavy = sorted(set(name.split('.')[0] for name in sys.modules
+                   if name.split('.')[0] in ('rpy2', 'pyparsing')))
+print('%f|%s|%s' % (elapsed, ','.join(heavy), status))
+'''
+
+## Modules on the projection path besides the console scripts.
+MODULES = ('projections.r2py.modelr', 'projections.rasterset',
+           'projections.predicts', 'projections.lui')
+
+def entry_points():
+  setup = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'setup.py')
+  with open(setup) as ifile:
+    return re.findall(r'=\s*(projections\.scripts\.\w+):', ifile.read())
+
+def probe(module):
+  proc = subprocess.run([sys.executable, '-c', PROBE.format(module=module)],
+                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  lines = proc.stdout.decode('utf-8').strip().split('\n')
+  if lines[-1].count('|') < 2:
+    return float('nan'), '', 'exit status %d' % proc.returncode
+  elapsed, heavy, status = lines[-1].split('|', 2)
+  return float(elapsed), heavy, status
+
+@click.command()
+@click.argument('modules', nargs=-1)
+@click.option('--repeat', '-r', type=int, default=3)
+def main(modules, repeat):
+  """Measure the import time of the console scripts (from setup.py) and
+the modules used by projections in fresh processes.  Also reports
+whether importing them loads rpy2 (and R) or pyparsing.
+
+  """
+  for module in modules or tuple(entry_points()) + MODULES:
+    times = []
+    for x in range(repeat):
+      elapsed, heavy, status = probe(module)
+      times.append(elapsed)
+    print("%-36s %7.3fs  %-16s %s" % (module, sorted(times)[len(times) // 2],
+                                      heavy or '-',
+                                      '' if status == 'ok' else status))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import click
+
+from projections.r2py import modelr
+from projections.r2py import modelstore
+from projections.r2py import reval
+from projections.r2py import rparser
+
+FORMULA = ('inv_logit(0.5 + 1.2 * x + 0.3 * log(y + 1) - 0.2 * x:y + '
+           '0.7 * log(z + 1):y - 0.05 * z)')
+
+## Time to first block in a fresh process: import, load the model and
+## evaluate one block.
+PROBE = '''
+import time
+stime = time.time()
+import numpy as np
+from projections.r2py import modelr, modelstore
+{load}
+size = {size}
+df = dict((name, np.random.rand(size).astype(np.float32))
+          for name in mod.syms)
+mod.eval(df)
+print(time.time() - stime)
+'''
+
+def formula_compiler(formula):
+  def compile(rds, outdir, typed=True):
+    root = reval.make_inputs(rparser.parse(formula))
+    path = os.path.join(outdir, 'model.py')
+    with open(path, 'w') as ofile:
+      ofile.write(reval.to_numba(root, 'model', 'out', typed=typed))
+    return path
+  return compile
+
+def probe(load, size):
+  out = subprocess.check_output([sys.executable, '-c',
+                                 PROBE.format(load=load, size=size)])
+  return float(out.decode('utf-8').split()[-1])
+
+@click.command()
+@click.option('--rds', type=click.Path(dir_okay=False),
+              help='Benchmark a real model (default: a synthetic formula)')
+@click.option('--formula', default=FORMULA,
+              help='R formula of the synthetic model')
+@click.option('--size', type=int, default=1024 * 1024,
+              help='Number of cells in the first block')
+@click.option('--repeat', '-r', type=int, default=3)
+def main(rds, formula, size, repeat):
+  """Compare the time to the first evaluated block of a fresh process
+(e.g. a worker of ipbes-project.py) for untyped jit kernels, typed
+kernels loaded from the numba cache and ahead of time compiled kernels.
+
+  """
+  tmpdir = tempfile.mkdtemp()
+  try:
+    store = os.path.join(tmpdir, 'store')
+    cases = []
+    if rds:
+      rds = os.path.abspath(rds)
+      for aot in (False, True):
+        modelr.load(rds, modelstore.ModelStore(store), aot=aot)
+        cases.append(('typed' + (' + aot' if aot else ''),
+                      'mod = modelr.load(%r, modelstore.ModelStore(%r), '
+                      'aot=%s)' % (rds, store, aot)))
+    else:
+      rds = os.path.join(tmpdir, 'model.rds')
+      with open(rds, 'w') as ofile:
+        ofile.write(formula)
+      mstore = modelstore.ModelStore(store)
+      for typed, aot in ((False, False), (True, False), (True, True)):
+        opts = {'typed': typed, 'aot': aot}
+        mstore.add(rds, formula_compiler(formula), opts)
+        name = ('typed' if typed else 'untyped') + (' + aot' if aot else '')
+        cases.append((name,
+                      'mod = modelr.from_module(modelstore.ModelStore(%r)'
+                      '.module(%r, None, %r))' % (store, rds, opts)))
+    for name, load in cases:
+      # The first process may have to fill the numba cache.
+      times = [probe(load, size) for x in range(repeat + 1)]
+      rest = sorted(times[1:])
+      print("%-15s first block: first process %7.3fs, then %7.3fs" %
+            (name, times[0], rest[len(rest) // 2]))
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import timeit
+
+import click
+import numpy as np
+import rasterio
+
+from projections.rasterset.raster import Raster, read_grouped
+
+def make_raster(path, bands, size, interleave):
+  rng = np.random.default_rng(0)
+  meta = {'driver': 'GTiff', 'dtype': 'float32', 'count': bands,
+          'width': size, 'height': size, 'nodata': -9999.0,
+          'crs': 'EPSG:4326', 'compress': 'deflate', 'tiled': True,
+          'blockxsize': 256, 'blockysize': 256, 'interleave': interleave,
+          'transform': rasterio.transform.from_origin(-180, 90, 360.0 / size,
+                                                      180.0 / size)}
+  with rasterio.open(path, 'w', **meta) as dst:
+    for band in range(1, bands + 1):
+      dst.write(rng.random((size, size), dtype=np.float32), band)
+
+def read_blocks(rasters, size, rows, grouped):
+  for raster in rasters:
+    raster.window = ((0, size), (0, size))
+  for r0 in range(0, size, rows):
+    window = ((r0, min(r0 + rows, size)), (0, size))
+    if grouped:
+      read_grouped(rasters, window)
+    for raster in rasters:
+      raster.eval({}, window)
+
+@click.command()
+@click.option('--bands', type=int, default=3)
+@click.option('--size', type=int, default=4096)
+@click.option('--interleave', type=click.Choice(('pixel', 'band')),
+              default='pixel')
+@click.option('--rows', type=int, default=256,
+              help='Number of rows per block')
+@click.option('--number', '-n', type=int, default=3)
+def main(bands, size, interleave, rows, number):
+  """Read the bands of a compressed GeoTIFF block by block with one
+read per band and with one multi-band read per block (see
+raster.read_grouped()).
+
+  """
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'bands.tif')
+    make_raster(path, bands, size, interleave)
+    rasters = [Raster('b%d' % band, path, band)
+               for band in range(1, bands + 1)]
+    for name, grouped in (('per band', False), ('grouped', True)):
+      elapsed = timeit.timeit(lambda: read_blocks(rasters, size, rows,
+                                                  grouped),
+                              number=number) / number
+      print("%-10s %8.4fs" % (name, elapsed))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import timeit
+
+import click
+
+from projections.rasterset import NetCDFRaster, Raster
+from projections.rasterset.raster import read_grouped
+
+def read_blocks(rasters, rows):
+  reader = rasters[0].reader
+  for raster in rasters:
+    raster.window = ((0, reader.height), (0, reader.width))
+  for r0 in range(0, reader.height, rows):
+    window = ((r0, min(r0 + rows, reader.height)), (0, reader.width))
+    read_grouped(rasters, window)
+    for raster in rasters:
+      raster.eval({}, window)
+
+@click.command()
+@click.argument('fname', type=click.Path(dir_okay=False))
+@click.option('--variable', '-v', multiple=True,
+              default=('primf', 'primn', 'secdf', 'secdn', 'pastr', 'range'),
+              help='Variables to read (repeat the option for several)')
+@click.option('--band', '-b', type=int, default=1166,
+              help='Time step (band) to read; 1166 is 2015 in the ' +
+              'historical LUH2 states')
+@click.option('--rows', type=int, default=None,
+              help='Number of rows per block (default: chunk height)')
+@click.option('--number', '-n', type=int, default=3)
+def main(fname, variable, band, rows, number):
+  """Read variables of an LUH2 states.nc file block by block through
+GDAL's netcdf: driver (Raster) and directly with netCDF4 (NetCDFRaster).
+
+  """
+  def gdal():
+    return [Raster(var, 'netcdf:%s:%s' % (fname, var), band)
+            for var in variable]
+  def native():
+    return [NetCDFRaster(var, fname, var, band) for var in variable]
+  if rows is None:
+    rows = native()[0].block_shape[0]
+  print('%d variables, %d rows per block' % (len(variable), rows))
+  for name, make in (('gdal', gdal), ('netcdf4', native)):
+    rasters = make()
+    elapsed = timeit.timeit(lambda: read_blocks(rasters, rows),
+                            number=number) / number
+    print("%-8s %8.4fs" % (name, elapsed))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import timeit
+
+import click
+import numpy as np
+import numpy.ma as ma
+import rasterio
+
+from projections.r2py import poly
+from projections.r2py import reval
+from projections.r2py.tree import Node, Operator
+
+def inputs(cropland, hpd, size):
+  if cropland and hpd:
+    with rasterio.open(cropland) as ds:
+      c = ds.read(1, masked=True)
+    with rasterio.open(hpd) as ds:
+      h = ds.read(1, masked=True)
+    mask = np.logical_or(c.mask, h.mask)
+    c.mask = mask
+    h.mask = mask
+    return c.compressed(), h.compressed()
+  rng = np.random.default_rng(1)
+  return (rng.random(size, dtype=np.float32),
+          (rng.random(size, dtype=np.float32) * 1000).astype(np.float32))
+
+def poly_term(inp, degree, sample):
+  _, norm2, alpha = poly.ortho_poly_fit(sample, degree)
+  node = Node(Operator('poly'), (inp, degree,
+                                 Node(Operator('list'), list(norm2)),
+                                 Node(Operator('list'), list(alpha))))
+  return Node(Operator('var'), (hash(node), node))
+
+def model(c, h):
+  '''Build a model with the same shape as the land-use intensity models:
+poly(cropland, 3) + poly(log(hpd + 1), 3) and their interactions.'''
+  cin = Node(Operator('in'), ('cropland', 'float32[:]'))
+  hin = Node(Operator('log'), [Node(Operator('+'),
+                                    [Node(Operator('in'),
+                                          ('hpd', 'float32[:]')), 1])])
+  pc = poly_term(cin, 3, c[::97].astype(np.float64))
+  ph = poly_term(hin, 3, np.log(h[::97] + 1).astype(np.float64))
+  terms = [0.2]
+  for k in range(1, 4):
+    terms.append(Node(Operator('*'), [0.1 * k, Node(Operator('sel'),
+                                                    (pc, k))]))
+    terms.append(Node(Operator('*'), [-0.05 * k, Node(Operator('sel'),
+                                                      (ph, k))]))
+    terms.append(Node(Operator('*'),
+                      [0.01 * k,
+                       Node(Operator(':'), [Node(Operator('sel'), (pc, k)),
+                                            Node(Operator('sel'), (ph, k))])]))
+  return Node(Operator('inv_logit'), [Node(Operator('+'), terms)])
+
+@click.command()
+@click.option('--cropland', type=click.Path(dir_okay=False),
+              help='Cropland raster (default: random data)')
+@click.option('--hpd', type=click.Path(dir_okay=False),
+              help='Human population density raster (default: random data)')
+@click.option('--size', type=int, default=4 * 1024 * 1024,
+              help='Number of cells when using random data')
+@click.option('--number', '-n', type=int, default=10)
+def main(cropland, hpd, size, number):
+  """Compare evaluating poly() terms by materialising the full
+orthogonal polynomial matrix (ortho_poly_predict) with selecting a
+single column inside the numba kernel (ortho_poly_sel).
+
+  """
+  c, h = inputs(cropland, hpd, size)
+  df = {'cropland': c, 'hpd': h, 'np': np, 'ma': ma, 'poly': poly}
+  root = model(c, h)
+  ns = {}
+  exec(reval.to_numba(model(c, h), 'fused', 'out', cache=False), ns)
+  fused = ns['fused_st']
+  matrix = reval.evalr(root, dict(df))
+  assert np.allclose(fused(df), matrix, atol=1e-5)
+
+  nbytes = 2 * len(c) * 4 * 8
+  print("%d cells, 2 poly(x, 3) terms (%.1f MB of Z matrices)" %
+        (len(c), nbytes / (1024.0 * 1024)))
+  t1 = timeit.timeit(lambda: reval.evalr(root, dict(df)), number=number)
+  t2 = timeit.timeit(lambda: fused(df), number=number)
+  print("ortho_poly_predict: %8.4fs per block" % (t1 / number))
+  print("ortho_poly_sel:     %8.4fs per block" % (t2 / number))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import time
+
+import click
+
+from projections.rasterset import RasterSet, EXECUTORS
+import projections.predicts as predicts
+
+def run(what, year, scenario, executor, workers):
+  rs = RasterSet(predicts.oneKm(year, scenario, 'medium'))
+  fd, path = tempfile.mkstemp(suffix='.tif')
+  os.close(fd)
+  try:
+    stime = time.time()
+    rs.write(what, path, executor=executor, num_workers=workers)
+    return time.time() - stime
+  finally:
+    os.remove(path)
+
+@click.command()
+@click.argument('what', default='logHPD_rs')
+@click.option('--year', '-y', type=int, default=2005)
+@click.option('--scenario', '-s', default='1km')
+@click.option('--executor', '-e', multiple=True, type=click.Choice(EXECUTORS),
+              help='Executor(s) to benchmark (default: all)')
+@click.option('--workers', '-w', default='1,2,4,8,16,32,64',
+              help='Comma separated list of worker counts')
+def main(what, year, scenario, executor, workers):
+  """Compare RasterSet.write throughput on the 1km raster set across
+executors and worker counts.
+
+  """
+  counts = tuple(int(w) for w in workers.split(','))
+  for kind in executor or EXECUTORS:
+    for count in counts if kind != 'serial' else (1, ):
+      elapsed = run(what, year, scenario, kind, count)
+      print("%-10s %3d workers: %8.2fs" % (kind, count, elapsed))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import timeit
+
+import click
+
+from projections.r2py import rparser
+
+def terms(levels, degree):
+  '''Coefficient names like the fixed effects of the land-use intensity
+lmerMod models: poly() terms of cropland and hpd, their interactions and
+their interactions with the UN subregion factor.'''
+  cr = 'poly(log(cropland + 1), %d)' % degree
+  hp = 'poly(log(hpd + 1), %d)' % degree
+  res = ['(Intercept)']
+  for i in range(1, degree + 1):
+    res += ['%s%d' % (cr, i), '%s%d' % (hp, i)]
+    for j in range(1, degree + 1):
+      res.append('%s%d:%s%d' % (cr, i, hp, j))
+  for level in range(1, levels + 1):
+    res.append('factor(unSub)%d' % level)
+    for i in range(1, degree + 1):
+      res.append('factor(unSub)%d:%s%d' % (level, cr, i))
+  return res
+
+@click.command()
+@click.option('--levels', type=int, default=22,
+              help='Number of levels of the factor')
+@click.option('--degree', type=int, default=3)
+@click.option('--number', '-n', type=int, default=3)
+def main(levels, degree, number):
+  """Compare the parse throughput of the pyparsing grammar with the
+hand-written parser (with and without the cache of parsed expressions).
+
+  """
+  texts = terms(levels, degree)
+  for text in texts:
+    assert rparser.parse(text) == rparser.parse_pyparsing(text), text
+  print("%d terms" % len(texts))
+  def fast():
+    rparser._parse.cache_clear()
+    for text in texts:
+      rparser.parse(text)
+  def cached():
+    for text in texts:
+      rparser.parse(text)
+  def slow():
+    for text in texts:
+      rparser.parse_pyparsing(text)
+  for name, fn in (('pyparsing', slow), ('hand-written', fast),
+                   ('cached', cached)):
+    elapsed = timeit.timeit(fn, number=number) / number
+    print("%-12s %8.4fs %10.0f terms/s" % (name, elapsed,
+                                           len(texts) / elapsed))
+
+if __name__ == '__main__':
+  main()
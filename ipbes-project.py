@@ -68,9 +68,10 @@ compositional similarity depending on what the user wants to project.
     #raise RuntimeError('Unknown model type %s' % model)
   return out, None if mod is None else os.path.join(model_dir, mod)
 
-def project_year(model, model_dir, scenario, year):
+def project_year(model, model_dir, scenario, year, zarr=False):
   """Run a projection for a single year.  Can be called in parallel when
-projecting a range of years.
+projecting a range of years.  With zarr the year is written as a time
+step of the array <what> in the store <scenario>.zarr.
 
   """
 
@@ -100,6 +101,10 @@ projecting a range of years.
     sys.exit(1)
 
   stime = time.time()
+  if zarr:
+    rs.write(what, '%s/luh2/%s.zarr' % (utils.outdir(), scenario), time=year)
+    print("executed in %6.2fs" % (time.time() - stime))
+    return
   data, meta = rs.eval(what, quiet=True)
   etime = time.time()
   print("executed in %6.2fs" % (etime - stime))
@@ -127,23 +132,28 @@ def unpack(args):
               '(default: ../models)')
 @click.option('--parallel', '-p', default=1, type=click.INT,
               help='How many projections to run in parallel (default: 1)')
-def project(what, scenario, years, model_dir, parallel=1):
+@click.option('--zarr', is_flag=True, default=False,
+              help='Write every year to the zarr store <scenario>.zarr ' +
+              'instead of one GeoTIFF per year')
+def project(what, scenario, years, model_dir, parallel=1, zarr=False):
   """Project changes in terrestrial biodiversity using REDICTS models.
 
-  Writes output to a GeoTIFF file named <scenario>-<what>-<year>.tif.
+  Writes output to a GeoTIFF file named <scenario>-<what>-<year>.tif, or
+  with --zarr to the array <what> of the store <scenario>.zarr.
 
   """
 
   utils.luh2_check_year(min(years), scenario)
   utils.luh2_check_year(max(years), scenario)
   if parallel == 1:
-    tuple(map(lambda y: project_year(what, model_dir, scenario, y),
+    tuple(map(lambda y: project_year(what, model_dir, scenario, y, zarr),
               years))
     return
   pool = multiprocessing.Pool(processes=parallel)
   pool.map(unpack, zip(itertools.repeat(what),
                        itertools.repeat(model_dir),
-                       itertools.repeat(scenario), years))
+                       itertools.repeat(scenario), years,
+                       itertools.repeat(zarr)))
 
 if __name__ == '__main__':
 #pylint: disable-msg=no-value-for-parameter
@@ -1,6 +1,6 @@
 
 from .base import *
 from .rcp import RCP
-from .luh2 import LUH2
+from .luh2 import LUH2Multi
 from .luh5 import LUH5
 from .onekm import OneKm
@@ -1,13 +1,13 @@
 
-from copy import copy
-import importlib
 import numpy as np
+import numpy.ma as ma
 import re
 import os
-import sys
 
 from .. import lu
 from .. import utils
+from ..r2py import modelr
+from ..ui import intensities
 
 LUI_MODEL_MAP = {'annual': 'cropland',
                  'nitrogen': 'cropland',
@@ -26,74 +26,61 @@ LUI_MODEL_MAP = {'annual': 'cropland',
 def model(name):
   return LUI_MODEL_MAP[name]
 
-class LUH2(object):
-  def __init__(self, name, intensity):
+class LUH2Multi(object):
+  '''Evaluate all the use intensities of a land-use type in one pass.
+
+The LUI models of a land-use type are compiled into a single kernel (see
+reval.to_numba_multi()) so the inputs are read and the shared poly()
+terms computed once instead of once per intensity.  eval() returns an
+array with one row per intensity (in the order of outputs): the intense
+and light fractions are the model predictions added to the reference
+fractions (clipped so light + intense <= 1) times the land-use fraction,
+and minimal is the rest.  Masked inputs stay masked in every row.
+Adding it to a RasterSet registers the columns <name>_minimal,
+<name>_light and <name>_intense.'''
+  def __init__(self, name):
     self._name = name
-    self._intensity = intensity
-    self._inputs = []
     mod_name = model(name)
-    py = os.path.join(utils.lui_model_dir(), '%s.py' % mod_name)
-    if not os.path.isfile(py):
-      raise RuntimeError('could not find python module for %s' % mod_name)
     rds = os.path.join(utils.lui_model_dir(), '%s.rds' % mod_name)
     if not os.path.isfile(rds):
       raise RuntimeError('could not find RDS file for %s' % mod_name)
-    if os.path.getmtime(py) < os.path.getmtime(rds):
-      raise RuntimeError('python module is older than RDS file for %s' % name)
-    if intensity != 'minimal':
-      if utils.lui_model_dir() not in sys.path:
-        sys.path.append(utils.lui_model_dir())
-      self._pkg = importlib.import_module(mod_name)
-      self._pkg_func = getattr(self._pkg, intensity)
-      self._pkg_inputs = getattr(self._pkg, 'inputs')()
-      self._inputs += [name if x == mod_name else x for x in self._pkg_inputs]
-      self._finputs = copy(self._inputs)
-      self._inputs += [name + '_' + intensity + '_ref']
-      def myfunc(df):
-        args = [df[arg] for arg in self._finputs]
-        return self._pkg_func(*args)
-      self._func = myfunc
-    if intensity == 'light':
-      self._inputs += [name + '_intense']
-    elif intensity == 'minimal':
-      self._inputs += [name + '_intense', name + '_light']
-    
+    self._pkg = modelr.load_module(rds, multi=True)
+    self._pkg_func = getattr(self._pkg, getattr(self._pkg, 'func_name')())
+    models = getattr(self._pkg, 'output')()
+    self._rows = dict((intensity, models.index(intensity))
+                      for intensity in ('light', 'intense'))
+    self._finputs = [name if x == mod_name else x
+                     for x in getattr(self._pkg, 'inputs')()]
+    self._inputs = self._finputs + [name,
+                                    name + '_light_ref',
+                                    name + '_intense_ref']
+
   @property
   def name(self):
-    return self._name + '_' + self.intensity
-    
-  @property
-  def as_intense(self):
-    return self._name + '_intense'
-    
-  @property
-  def as_light(self):
-    return self._name + '_light'
-    
-  @property
-  def as_minimal(self):
-    return self._name + '_minimal'
-    
+    return self._name + '_lui'
+
   @property
-  def intensity(self):
-    return self._intensity
-    
+  def outputs(self):
+    return [self._name + '_' + intensity for intensity in intensities()]
+
   @property
   def syms(self):
     return self._inputs
 
   def eval(self, df):
-    if self.intensity == 'minimal':
-      res = (df[self._name] - df[self.as_intense] - df[self.as_light])
-      return res
-    res = self._func(df)
-    res[np.where(np.isnan(res))] = 1.0
-    res = np.clip(df[self.name + '_ref'] + res, 0, 1)
-    if self.intensity == 'light':
-      intense = df[self.as_intense] / (df[self._name] + 1e-10)
-      res = np.where(intense + res > 1, 1 - intense, res)
-    res *= df[self._name]
-    return res
+    total = df[self._name]
+    preds = self._pkg_func(*[df[arg] for arg in self._finputs])
+    preds[np.where(np.isnan(preds))] = 1.0
+    res = {}
+    for intensity in ('intense', 'light'):
+      res[intensity] = np.clip(df[self._name + '_' + intensity + '_ref'] +
+                               preds[self._rows[intensity]], 0, 1)
+    res['intense'] = res['intense'] * total
+    intense = res['intense'] / (total + 1e-10)
+    res['light'] = ma.where(intense + res['light'] > 1, 1 - intense,
+                            res['light']) * total
+    res['minimal'] = total - res['intense'] - res['light']
+    return ma.stack([res[intensity] for intensity in intensities()])
 
 def _predictify(sym, prefix):
   newr = sym.replace(prefix, '')
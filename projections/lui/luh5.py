@@ -1,13 +1,12 @@
 
-import importlib
 import numpy as np
 import numpy.ma as ma
 import os
 import re
-import sys
 
 from .. import lu
 from .. import utils
+from ..r2py import modelr
 from projections.r2py.tree import Node, Operator
 
 class LUH5(object):
@@ -22,18 +21,11 @@ class LUH5(object):
       self._inputs = ['secondary', 'secondary_minimal', 'secondary_light',
                       'secondary_intense', name]
     else:
-      py = os.path.join(utils.lui_model_dir(), '%s.py' % name)
-      if not os.path.isfile(py):
-        raise RuntimeError('could not find python module for %s' % name)
       rds = os.path.join(utils.lui_model_dir(), '%s.rds' % name)
       if not os.path.isfile(rds):
         raise RuntimeError('could not find RDS file for %s' % name)
-      if os.path.getmtime(py) < os.path.getmtime(rds):
-        raise RuntimeError('python module is older than RDS file for %s' % name)
       if intensity != 'minimal':
-        if utils.lui_model_dir() not in sys.path:
-          sys.path.append(utils.lui_model_dir())
-        self._pkg = importlib.import_module(name)
+        self._pkg = modelr.load_module(rds)
         self._pkg_func = getattr(self._pkg, intensity + '_st')
         self._inputs += getattr(self._pkg, 'inputs')()
       self._inputs += [name + '_' + intensity + '_ref']
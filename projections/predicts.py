@@ -4,7 +4,8 @@ import netCDF4
 import os
 import sys
 
-from .rasterset import Raster
+from .rasterset import NetCDFRaster, OutputSelector, Raster
+from .rasterset import netcdf
 from .simpleexpr import SimpleExpr
 from . import hpd
 from . import lu
@@ -149,6 +150,13 @@ def luh5(scenario, year, plus3):
   return rasters
 
 
+def add_multi(rasters, multi):
+  '''Add a multi-output column and a column for each of its outputs
+  (e.g. <lu>_minimal, <lu>_light and <lu>_intense for lui.LUH2Multi).'''
+  rasters[multi.name] = multi
+  for idx, name in enumerate(multi.outputs):
+    rasters[name] = OutputSelector(multi.name, idx)
+
 def luh2(scenario, year, hpd_trend):
   rasters = {}
   if scenario not in utils.luh2_scenarios():
@@ -207,17 +215,13 @@ def luh2(scenario, year, hpd_trend):
                                 outfn('luh2', 'roads-final.tif'))
   for fname in (utils.luh2_states(scenario),
                 outfn('luh2', 'secd-' + scenario + '.nc')):
-    try:
-      ds = netCDF4.Dataset(fname)
-    except IOError as e:
-      print("Error: opening '%s'" % fname)
-      raise IOError("Error: opening '%s'" % fname)
+    # Shared with the NetCDFRaster columns.
+    ds = netcdf.open_dataset(fname)
     ds_vars = set(ds.variables.keys())
     names = set(reduce(lambda x,y: x + y, [list(lu.syms) for lu in lus], ['urban']))
     for name in set.intersection(names, ds_vars):
       band = year - 849 if scenario == 'historical' else year - 2014
-      rasters[name] = Raster(name, "netcdf:%s:%s" % (fname, name),
-                             band = band)
+      rasters[name] = NetCDFRaster(name, fname, name, band = band)
 
   for lu in lus:
     rasters[lu.name] = lu
@@ -232,15 +236,16 @@ def luh2(scenario, year, hpd_trend):
         rasters[n] = SimpleExpr(n, '0')
         rasters[n2] = SimpleExpr(n2, '0')
       else:
-        rasters[n] = lui.LUH2(lu.name, intensity)
         rasters[n2] = Raster(n2, ref_path, band + 1)
+    if lu.name != 'timber':
+      # Evaluates all the intensities in one pass.
+      add_multi(rasters, lui.LUH2Multi(lu.name))
 
   ref_path = outfn('luh2', 'urban-recal.tif')
   for band, intensity in enumerate(lui.intensities()):
-    n = 'urban_' + intensity
-    rasters[n] = lui.LUH2('urban', intensity)
-    n2 = n + '_ref'
+    n2 = 'urban_' + intensity + '_ref'
     rasters[n2] = Raster(n2, ref_path, band + 1)
+  add_multi(rasters, lui.LUH2Multi('urban'))
 
   for lu in ('annual', 'pasture'):
     name = '%s_minimal_and_light' % lu
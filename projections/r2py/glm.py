@@ -8,6 +8,7 @@ import rpy2.rinterface as rinterface
 from . import reval
 from .ri2pi import ri2pi
 from . import rparser
+from . import tree
 from .tree import Node, Operator
 
 class GLM():
@@ -56,34 +57,9 @@ class GLM():
                                Node(Operator('list'), alpha))
 
   def _cse(self):
-    cache = dict()
-    reps = dict()
-    visited = dict()
-    def match(n):
-      if not isinstance(n, Node):
-        return n
-      if hash(n) in visited:
-        # NOTE: special case since transform is pre-order, i.e. we just
-        # created a var node and now get called with the child of a var
-        # node we just created.
-        return n
-      ms = tuple(filter(lambda x: x == n, cache.values()))
-      if ms:
-        assert len(ms) == 1, 'matched too many nodes'
-        m = ms[0]
-        if hash(m) not in reps:
-          reps[hash(m)] = Node(Operator('var'), (hash(m), m))
-          visited[hash(m)] = 1
-        assert m == n, 'not equal %s != %s' % (repr(n), repr(m))
-        assert hash(n) != hash(m), 'matched node to itself'
-        return reps[hash(m)]
-      if n.type == Operator('poly') or n.type == Operator('=='):
-        cache[hash(n)] = n
-        reps[hash(n)] = Node(Operator('var'), (hash(n), n))
-        visited[hash(n)] = 1
-        return reps[hash(n)]
-      return n
-    self._equation = self.equation.transform(match)
+    '''Fold constants and share common subexpressions (poly and ==
+terms are always computed once).'''
+    self._equation = tree.optimize(self.equation)
 
   def to_py(self, fname):
     return reval.to_py(self.equation, fname)
@@ -91,8 +67,8 @@ class GLM():
   def to_pyx(self, fname):
     return reval.to_pyx(self.equation, fname)
 
-  def to_numba(self, fname):
-    return reval.to_numba(self.equation, fname, self.output)
+  def to_numba(self, fname, **kwargs):
+    return reval.to_numba(self.equation, fname, self.output, **kwargs)
 
   def eval(self, df):
     return reval.evalr(self.equation, df)
@@ -0,0 +1,130 @@
+import collections
+import json
+import os
+
+from . import modelstore
+from . import reval
+from . import tree
+from .tree import Node, Operator
+
+## Bump when the layout of the description changes.
+FORMAT = 1
+
+def encode(root):
+  '''Convert a tree into nested lists and dictionaries that can be
+serialised as JSON.'''
+  if isinstance(root, Node):
+    return {'op': root.type.type, 'args': [encode(arg) for arg in root.args]}
+  if isinstance(root, bool) or not isinstance(root, (int, float, str)):
+    raise ValueError('cannot encode %r' % (root, ))
+  # Converts numpy scalars.
+  return float(root) if isinstance(root, float) else root
+
+def decode(obj):
+  '''Inverse of encode().'''
+  if isinstance(obj, dict):
+    return Node(Operator(obj['op']), [decode(arg) for arg in obj['args']])
+  return obj
+
+class ModelDescription(object):
+  '''A model read from a description file.  It has the attributes the
+code generator needs (see modelr._compile()) and the coefficients
+and link function of the R model for reference.'''
+  def __init__(self, name, desc):
+    self._name = name
+    self._desc = desc
+    self._equation = None
+
+  @property
+  def name(self):
+    return self._name
+
+  @property
+  def output(self):
+    return self._desc['output']
+
+  @property
+  def link(self):
+    return self._desc.get('link')
+
+  @property
+  def coefficients(self):
+    return self._desc.get('coefficients', {})
+
+  @property
+  def syms(self):
+    return self._desc['inputs']
+
+  @property
+  def equation(self):
+    if self._equation is None:
+      # Shared subtrees are written out in full, share them again.
+      self._equation = tree.cse(decode(self._desc['equation']))
+    return self._equation
+
+def describe(mod):
+  '''Return the description of a model read from an RDS file (a GLM or
+MerMod).'''
+  if hasattr(mod, 'coefficients'):
+    coefs = mod.coefficients().dropna()
+  else:
+    coefs = mod.fixef()
+  return collections.OrderedDict(
+    (('output', mod.output),
+     ('link', getattr(mod, 'link', 'identity')),
+     ('inputs', list(reval.find_inputs(mod.equation))),
+     ('coefficients', collections.OrderedDict((str(x[0]), float(x[1]))
+                                              for x in coefs.itertuples())),
+     ('equation', encode(mod.equation))))
+
+def path_for(rds):
+  return os.path.splitext(rds)[0] + '.json'
+
+def export(rds, path=None):
+  '''Write the description of the models in an RDS file to path (by
+default next to the RDS file, with a .json extension).  This is the only
+step that needs rpy2 and R; projections read the description with
+read().  Returns the path of the description.'''
+  from . import modelr
+  models, is_list = modelr.read_rds(rds)
+  if path is None:
+    path = path_for(rds)
+  desc = collections.OrderedDict(
+    (('format', FORMAT),
+     ('rds', os.path.basename(rds)),
+     ('rds_sha256', modelstore.sha256(rds)),
+     ('list', is_list),
+     ('models', collections.OrderedDict((name, describe(mod))
+                                        for name, mod in models.items()))))
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as ofile:
+    json.dump(desc, ofile, indent=1)
+  os.rename(tmp, path)
+  return path
+
+def read(path):
+  '''Read a model description.  Returns an ordered dictionary that maps
+model names to ModelDescription objects and whether the RDS file held a
+list of models (see modelr.read_rds()).'''
+  with open(path) as ifile:
+    desc = json.load(ifile, object_pairs_hook=collections.OrderedDict)
+  if desc.get('format') != FORMAT:
+    raise RuntimeError('unsupported model description format in %s' % path)
+  models = collections.OrderedDict((name, ModelDescription(name, model))
+                                   for name, model in desc['models'].items())
+  return models, desc['list']
+
+def find(rds):
+  '''Return the path of the description of an RDS file if there is one
+and it was exported from the current content of the RDS file.'''
+  path = path_for(rds)
+  if not os.path.isfile(path):
+    return None
+  with open(path) as ifile:
+    desc = json.load(ifile)
+  if desc.get('format') != FORMAT:
+    return None
+  if desc.get('rds_sha256') != modelstore.sha256(rds):
+    print('WARNING: ignoring stale model description %s' % path)
+    return None
+  return path
@@ -1,9 +1,12 @@
 
-import importlib
+import collections
 import numpy as np
 import os
 import re
-import sys
+
+from . import modeldesc
+from . import modelstore
+from . import reval
 
 class Model(object):
   def __init__(self, name, pkg, func, inputs, out_name):
@@ -70,30 +73,59 @@ class Model(object):
   def eval(self, df):
     return self._func(df)
   
-def read_py(fname):
-  path, name = os.path.split(fname)
-  pkg_name, ext = os.path.splitext(name)
-  if path not in sys.path:
-    sys.path.append(path)
-  pkg = importlib.import_module(pkg_name)
+def from_module(pkg):
   func_name = getattr(pkg, 'func_name')()
   func = getattr(pkg, func_name + '_st')
   inputs = getattr(pkg, 'inputs')()
   out_name = getattr(pkg, 'output')()
-  return Model(pkg_name, pkg, func, inputs, out_name)
+  # Modules from a ModelStore are imported under a name that includes the
+  # entry key; the model is named after the file.
+  name = os.path.splitext(os.path.basename(pkg.__file__))[0]
+  return Model(name, pkg, func, inputs, out_name)
+
+def read_py(fname):
+  return from_module(modelstore.import_file(fname))
 
-def load(path):
+def load_module(path, store=None, aot=False, parallel=False, fastmath=False,
+                multi=False):
+  '''Return the python module compiled from the RDS file path.  Compiled
+modules are kept in a ModelStore keyed by the content of the RDS file,
+so models are only recompiled when the RDS file (or the compiler)
+changes.  Set aot to also compile the kernels ahead of time into an
+extension module, which avoids any numba compilation in the process
+that loads the model.  parallel and fastmath select the kind of kernel
+generated (see reval.to_numba()); each combination of options is a
+separate entry in the store.
+
+When multi is set and the RDS file holds a list of models, the module
+has a single kernel that evaluates all of them in one pass and returns
+one row per model (see reval.to_numba_multi()); output() returns the
+names of the models.
+
+path can also be a model description written by modeldesc.export().
+If there is an up to date description next to the RDS file it is used
+instead of the RDS file, so compiling the model does not need rpy2 (or
+R).'''
   if not os.path.isfile(path):
     raise RuntimeError('no such file: %s' % path)
-  pypath = os.path.splitext(path)[0] + '.py'
-  if (os.path.isfile(pypath) and
-      os.path.getmtime(pypath) > os.path.getmtime(path)):
-    #print("loading %s" % pypath)
-    return read_py(pypath)
-  print("compiling %s" % path)
-  return read_py(_compile(path))
-
-def _compile(fname):
+  if not path.endswith('.json'):
+    path = modeldesc.find(path) or path
+  if store is None:
+    store = modelstore.ModelStore()
+  options = dict((k, v) for k, v in (('aot', aot), ('parallel', parallel),
+                                      ('fastmath', fastmath),
+                                      ('multi', multi)) if v)
+  return store.module(path, _compile, options)
+
+def load(path, store=None, aot=False, parallel=False, fastmath=False,
+         multi=False):
+  return from_module(load_module(path, store, aot, parallel, fastmath,
+                                 multi))
+
+def read_rds(fname):
+  '''Read the models in an RDS file (needs rpy2 and R).  Returns an
+ordered dictionary that maps model names to models and whether the file
+holds a list of models.  A single model is named after the file.'''
   import rpy2.robjects as robjects
 
   from ..r2py import glm
@@ -113,24 +145,42 @@ def _compile(fname):
       return None
     predicts.predictify(mod)
     return mod
-  
+
+  base = os.path.splitext(os.path.basename(fname))[0]
+  models = collections.OrderedDict()
+  obj = robjects.r('models <- readRDS("%s")' % fname)
+  is_list = 'list' in obj.rclass
+  if is_list:
+    for mm in obj.items():
+      print("  %s" % mm[0])
+      mod = doit(mm[1])
+      if mod:
+        models[mm[0]] = mod
+  else:
+    mod = doit(obj)
+    if mod:
+      models[re.sub(r'[ \-.$]', '_', base)] = mod
+  return models, is_list
+
+def _compile(fname, outdir=None, multi=False, **kwargs):
   name = os.path.basename(fname)
   base = os.path.splitext(name)[0]
   pname = re.sub(r'[ \-.$]', '_', base)
-  outdir = os.path.dirname(fname)
+  if outdir is None:
+    outdir = os.path.dirname(fname)
   oname = os.path.join(outdir, base + '.py')
-  
+
   print('%s:' % name)
+  if fname.endswith('.json'):
+    models, is_list = modeldesc.read(fname)
+  else:
+    models, is_list = read_rds(fname)
   with open(oname, 'w') as ofile:
-    obj = robjects.r('models <- readRDS("%s")' % fname)
-    if 'list' in obj.rclass:
-      for mm in obj.items():
-        print("  %s" % mm[0])
-        mod = doit(mm[1])
-        if mod:
-          ofile.write(mod.to_numba(mm[0]))
+    if is_list and multi:
+      roots = collections.OrderedDict((name, mod.equation)
+                                      for name, mod in models.items())
+      ofile.write(reval.to_numba_multi(roots, pname, **kwargs))
     else:
-      mod = doit(obj)
-      if mod:
-        ofile.write(mod.to_numba(pname))
+      for name, mod in models.items():
+        ofile.write(reval.to_numba(mod.equation, name, mod.output, **kwargs))
   return(oname)
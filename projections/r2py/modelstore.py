@@ -0,0 +1,293 @@
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import numba
+from numba.core.dispatcher import Dispatcher
+
+## Bump whenever the generated code changes so stale entries are not
+## reused.
+COMPILER_VERSION = 10
+
+MANIFEST = 'manifest.json'
+
+## Modification time given to the generated module of every entry.  The
+## numba cache index (and the .pyc) are keyed by the mtime of the source,
+## so an entry copied between nodes or restored from an archive would
+## otherwise be recompiled on first load.
+STABLE_MTIME = 946684800
+
+## Modules imported by ModelStore.module() in this process, keyed by the
+## RDS file (path, size and modification time), the store directories and
+## the options.  Saves hashing the RDS file and verifying the entry on
+## every load.
+_modules = {}
+
+def stabilize(path):
+  '''Set the modification time of path to STABLE_MTIME.  Returns False
+when that is not possible (e.g. a read-only store).'''
+  if os.stat(path).st_mtime == STABLE_MTIME:
+    return True
+  try:
+    os.utime(path, (STABLE_MTIME, STABLE_MTIME))
+  except OSError:
+    return False
+  return True
+
+def module_name(fname, key):
+  '''Name a generated module is imported with.  Includes the entry key
+so that entries of the same model compiled with different options do not
+replace each other in sys.modules.'''
+  return '%s_%s' % (os.path.splitext(os.path.basename(fname))[0], key[:16])
+
+def sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as ifile:
+    for chunk in iter(lambda: ifile.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def import_file(path, name=None):
+  '''Import the python file path as a module (without touching
+sys.path).'''
+  if name is None:
+    name = os.path.splitext(os.path.basename(path))[0]
+  spec = importlib.util.spec_from_file_location(name, path)
+  mod = importlib.util.module_from_spec(spec)
+  sys.modules[name] = mod
+  try:
+    spec.loader.exec_module(mod)
+  except BaseException:
+    del sys.modules[name]
+    raise
+  return mod
+
+def signatures(mod):
+  '''Return the inputs, output and entry point of a generated module
+(where defined).'''
+  sigs = {}
+  for what in ('inputs', 'output', 'func_name'):
+    fn = getattr(mod, what, None)
+    if callable(fn):
+      sigs[what] = fn()
+  return sigs
+
+def compile_aot(mod, name, outdir):
+  '''Compile the typed numba kernels of a generated module ahead of time
+into the extension module name in outdir.  Returns the file name of the
+extension and the names of the functions it exports, or None when
+numba.pycc is not available or the module has no typed kernels.'''
+  try:
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      from numba.pycc import CC
+  except ImportError:
+    return None
+  cc = CC(name)
+  cc.output_dir = outdir
+  cc.verbose = False
+  exported = []
+  for attr, obj in sorted(vars(mod).items()):
+    if isinstance(obj, Dispatcher) and obj.nopython_signatures:
+      cc.export(attr, obj.nopython_signatures[0])(obj.py_func)
+      exported.append(attr)
+  if not exported:
+    return None
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    cc.compile()
+  return os.path.basename(cc.output_file), exported
+
+def load_aot(mod, path, functions):
+  '''Replace the jit kernels of mod by their ahead of time compiled
+versions.'''
+  name = os.path.basename(path).split('.')[0]
+  ext = import_file(path, name)
+  for fn in functions:
+    setattr(mod, fn, getattr(ext, fn))
+  return mod
+
+class ModelStore(object):
+  '''Content-addressed store of compiled models.
+
+Each entry is a directory named after the hash of the RDS file, the
+compiler version, the numba version and the compilation options.  It
+holds the generated module, the numba cache files (in __pycache__,
+written when the module is first imported, since the kernels have
+explicit signatures), optionally an ahead of time compiled extension
+with the kernels and a manifest with the hash of the module and the
+extension and the signatures of the model.  The numba cache files are
+deliberately left out of the manifest: numba checks them itself (and
+recompiles when they are stale or corrupt), and rewrites the index when
+it adds an overload, e.g. on a node with a different CPU, so their hash
+would not be stable.  Since entries only depend on the
+content of the RDS file they survive copying files between nodes or
+restoring them from an archive, unlike the modification times used
+previously.  The generated module is given a fixed modification time
+(see STABLE_MTIME) so the numba cache, which is keyed by it, stays valid
+too.
+
+paths is a list of store directories (default: $MODEL_STORE, a list
+separated by os.pathsep, or a .model-store directory next to the RDS
+file).  Entries are looked up in all of them, so a read-only store
+shared between worker nodes can be listed first; new entries are added
+to the first writable one.  Entries that fail the integrity check are
+ignored (and recompiled).
+
+  '''
+  def __init__(self, paths=None):
+    if paths is None and os.environ.get('MODEL_STORE'):
+      paths = os.environ['MODEL_STORE'].split(os.pathsep)
+    if isinstance(paths, str):
+      paths = [paths]
+    self._paths = paths
+
+  def roots(self, rds):
+    if self._paths:
+      return list(self._paths)
+    return [os.path.join(os.path.dirname(os.path.abspath(rds)),
+                         '.model-store')]
+
+  @staticmethod
+  def key(rds, options=None):
+    digest = hashlib.sha256()
+    digest.update(sha256(rds).encode('ascii'))
+    digest.update(('compiler=%d;numba=%s;' %
+                   (COMPILER_VERSION, numba.__version__)).encode('ascii'))
+    digest.update(json.dumps(options or {}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+  @staticmethod
+  def verify(entry):
+    '''Return the manifest of an entry if all its files are intact.'''
+    try:
+      with open(os.path.join(entry, MANIFEST)) as ifile:
+        manifest = json.load(ifile)
+      for fname, digest in manifest['files'].items():
+        if sha256(os.path.join(entry, fname)) != digest:
+          return None
+    except (OSError, ValueError, KeyError):
+      return None
+    return manifest
+
+  def lookup(self, rds, options=None):
+    '''Return the path of the entry for rds (or None).'''
+    key = self.key(rds, options)
+    for root in self.roots(rds):
+      entry = os.path.join(root, key[:2], key)
+      if not os.path.isdir(entry):
+        continue
+      if self.verify(entry) is None:
+        print('WARNING: ignoring corrupt model store entry %s' % entry)
+        continue
+      return entry
+    return None
+
+  def writable_root(self, rds):
+    for root in self.roots(rds):
+      if not os.path.isdir(root):
+        try:
+          os.makedirs(root)
+        except OSError:
+          continue
+      if os.access(root, os.W_OK):
+        return root
+    raise RuntimeError('no writable model store for %s' % rds)
+
+  def add(self, rds, compile, options=None):
+    '''Compile rds with compile(rds, outdir, **options), which must
+write the generated module to outdir and return its path, and add the
+result to the store.  When options has aot set the kernels are also
+compiled into an extension module (see compile_aot()).  Returns the path
+of the new entry.'''
+    key = self.key(rds, options)
+    options = dict(options or {})
+    aot = options.pop('aot', False)
+    root = self.writable_root(rds)
+    entry = os.path.join(root, key[:2], key)
+    if not os.path.isdir(os.path.dirname(entry)):
+      os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+    try:
+      pypath = compile(rds, tmp, **options)
+      name = os.path.basename(pypath)
+      files = {name: sha256(pypath)}
+      stabilize(pypath)
+      # Importing the module compiles the typed kernels and fills the
+      # numba cache in the entry.  The cache records the name of the
+      # module so use the name it is imported with by module().
+      mod = import_file(pypath, module_name(name, key))
+      try:
+        sigs = signatures(mod)
+        extension = None
+        if aot:
+          extension = compile_aot(mod, '%s_aot_%s' %
+                                  (os.path.splitext(name)[0], key[:16]), tmp)
+          if extension is None:
+            print('WARNING: ahead of time compilation not available')
+          else:
+            files[extension[0]] = sha256(os.path.join(tmp, extension[0]))
+      finally:
+        del sys.modules[mod.__name__]
+      manifest = {'key': key,
+                  'rds': os.path.basename(rds),
+                  'rds_sha256': sha256(rds),
+                  'compiler': COMPILER_VERSION,
+                  'numba': numba.__version__,
+                  'options': options,
+                  'module': name,
+                  'signatures': sigs,
+                  'files': files}
+      if extension:
+        manifest['aot'] = {'file': extension[0], 'functions': extension[1]}
+      with open(os.path.join(tmp, MANIFEST), 'w') as ofile:
+        json.dump(manifest, ofile, indent=2, sort_keys=True)
+      if os.path.isdir(entry) and self.verify(entry) is None:
+        shutil.rmtree(entry)
+      try:
+        # Atomic, so concurrent writers never see a partial entry.
+        os.rename(tmp, entry)
+      except OSError:
+        # Somebody else added the same entry first.
+        if self.verify(entry) is None:
+          raise
+    finally:
+      shutil.rmtree(tmp, ignore_errors=True)
+    return entry
+
+  def manifest(self, entry):
+    with open(os.path.join(entry, MANIFEST)) as ifile:
+      return json.load(ifile)
+
+  def module(self, rds, compile, options=None):
+    '''Import the compiled module for rds, compiling it first if the
+store does not have it.  The module is imported once per process (until
+the RDS file changes).'''
+    stat = os.stat(rds)
+    memo = (os.path.abspath(rds), stat.st_size, stat.st_mtime_ns,
+            tuple(self.roots(rds)), json.dumps(options or {}, sort_keys=True))
+    if memo not in _modules:
+      _modules[memo] = self._import(rds, compile, options)
+    return _modules[memo]
+
+  def _import(self, rds, compile, options=None):
+    entry = self.lookup(rds, options)
+    if entry is None:
+      print("compiling %s" % rds)
+      entry = self.add(rds, compile, options)
+    manifest = self.manifest(entry)
+    pypath = os.path.join(entry, manifest['module'])
+    if not stabilize(pypath):
+      print('WARNING: %s was copied without its modification time; '
+            'numba may recompile it' % pypath)
+    mod = import_file(pypath, module_name(manifest['module'],
+                                          manifest['key']))
+    if 'aot' in manifest:
+      load_aot(mod, os.path.join(entry, manifest['aot']['file']),
+               manifest['aot']['functions'])
+    return mod
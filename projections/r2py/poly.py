@@ -75,6 +75,42 @@ def ortho_poly_predict(x, norm2, alpha, degree = 1):
   Z /= np.sqrt(norm2)
   return Z
 
+@jit(nopython=True, nogil=True, cache=True)
+def ortho_poly_sel(x, degree, norm2, alpha):
+  '''Return column degree of ortho_poly_predict() for a single value
+x.  Only the terms of the three-term recurrence up to degree are
+computed, so this can be called from the per-pixel loop of a kernel
+without building the (n, degree + 1) matrix.'''
+  if degree == 0:
+    return 1.0 / np.sqrt(norm2[0])
+  z0 = 1.0
+  z1 = x - alpha[0]
+  for i in range(1, degree):
+    z2 = (x - alpha[i]) * z1 - (norm2[i] / norm2[i-1]) * z0
+    z0 = z1
+    z1 = z2
+  return z1 / np.sqrt(norm2[degree])
+
+@jit(nopython=True, nogil=True, cache=True)
+def factor_lookup(x, offset, table):
+  '''Return the entry of table for the factor level x (0 when x is not
+one of the levels offset, offset + 1, ...).'''
+  if x != x:
+    return 0.0
+  i = int(x) - offset
+  if i < 0 or i >= len(table) or i + offset != x:
+    return 0.0
+  return table[i]
+
+def factor_lookup_vec(x, offset, table):
+  '''Vectorised factor_lookup().'''
+  x = np.asarray(x)
+  table = np.asarray(table, dtype=np.float32)
+  idx = np.floor(np.nan_to_num(x, nan=-1.0)).astype(np.int64) - offset
+  hit = (idx >= 0) & (idx < len(table)) & (idx + offset == x)
+  return np.where(hit, table[np.clip(idx, 0, len(table) - 1)],
+                  np.float32(0))
+
 @vectorize(nopython=True, cache=True)
 def inv_logit(p):
   return np.exp(p) / (1 + np.exp(p))
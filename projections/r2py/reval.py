@@ -7,6 +7,7 @@ import pandas as pd
 import string
 
 from . import poly
+from . import tree
 from .tree import Node, Operator
 
 Context = collections.namedtuple('Context', 'context index')
@@ -14,6 +15,22 @@ Context = collections.namedtuple('Context', 'context index')
 def to_list(l):
   return '[' + ', '.join(map(str, l)) + ']'
 
+def to_tuple(l):
+  return '(' + ''.join('%r, ' % float(x) for x in l) + ')'
+
+def sel_poly(node):
+  '''If node selects a column of a poly() term whose coefficients are
+known return the poly node, otherwise None.'''
+  if not isinstance(node, Node) or node.type is not Operator('sel'):
+    return None
+  arg = node.args[0]
+  if isinstance(arg, Node) and arg.type is Operator('var'):
+    arg = arg.args[1]
+  if (isinstance(arg, Node) and arg.type is Operator('poly') and
+      len(arg.args) == 4):
+    return arg
+  return None
+
 def to_rexpr(root):
   if isinstance(root, str):
     return root
@@ -65,6 +82,9 @@ def to_repr(root):
     return '(* ' + ' '.join(map(to_repr, root.args)) + ')'
   if root.type is Operator('=='):
     return '(== ' + ' '.join(map(to_repr, root.args)) + ')'
+  if root.type is Operator('lookup'):
+    return '(lookup %s %d %s)' % (to_repr(root.args[0]), root.args[1],
+                                  to_repr(root.args[2]))
   if root.type is Operator('in'):
       return '%s' % root.args[0]
   if root.type is Operator('I'):
@@ -137,6 +157,14 @@ def to_expr(root, ctx=None):
     return '(' + ' * '.join(map(recurse, root.args)) + ')'
   if root.type is Operator('=='):
     return '(' + ' == '.join(map(recurse, root.args)) + ')'
+  if root.type is Operator('lookup'):
+    if jit():
+      # The table is a global array (see lookup_tables()).
+      return '(poly.factor_lookup(%s, %d, lookup_%d))' % (
+        recurse(root.args[0]), root.args[1], hash(root.args[2]))
+    return '(poly.factor_lookup_vec(%s, %d, %s))' % (recurse(root.args[0]),
+                                                     root.args[1],
+                                                     recurse(root.args[2]))
   if root.type is Operator('in'):
     if guvec():
       return '%s[0]' % root.args[0]
@@ -147,10 +175,17 @@ def to_expr(root, ctx=None):
   if root.type is Operator('I'):
     return recurse(root.args[0])
   if root.type is Operator('var'):
-    return 'var_%d' % hash(root.args[0])
+    return 'var_%d' % root.args[0]
   if root.type is Operator('list'):
     return '[' + ', '.join(map(str, root.args)) + ']'
   if root.type is Operator('sel'):
+    if jit() and sel_poly(root) is not None:
+      # Compute only the selected column of the polynomial for this
+      # pixel.
+      node = sel_poly(root)
+      return '(poly.ortho_poly_sel(%s, %d, %s, %s))' % (
+        recurse(node.args[0]), root.args[1], to_tuple(node.args[2].args),
+        to_tuple(node.args[3].args))
     expr = recurse(root.args[0])
     if isinstance(root.args[0], str):
       import pdb; pdb.set_trace()
@@ -180,10 +215,22 @@ def to_expr(root, ctx=None):
   if root.type is Operator('poly_fit'):
     return 'poly.ortho_poly_fit(%s, %d)' % (recurse(root.args[0]), root.args[1])
   if root.type is Operator('log'):
+    if jit():
+      return '(np.log(%s))' % recurse(root.args[0])
     return '(ma.log(%s))' % recurse(root.args[0])
   if root.type is Operator('exp'):
+    if jit():
+      return '(np.exp(%s))' % recurse(root.args[0])
     return '(ma.exp(%s))' % recurse(root.args[0])
   if root.type is Operator('scale'):
+    if jit() and len(root.args) == 5:
+      # Inline the scaling so the expression can be used in nopython
+      # mode.
+      return ('(((%s) - np.float32(%f)) / np.float32(%f) * np.float32(%f) + '
+              'np.float32(%f))' % (recurse(root.args[0]), root.args[3],
+                                   root.args[4] - root.args[3],
+                                   root.args[2] - root.args[1],
+                                   root.args[1]))
     if len(root.args) == 3:
       return '(poly.scale(%s, %d, %d))' % (recurse(root.args[0]),
                                            root.args[1], root.args[2])
@@ -203,6 +250,10 @@ def to_expr(root, ctx=None):
     return '(np.minimum(%s, %s))' % (recurse(root.args[0]),
                                      recurse(root.args[1]))
   if root.type is Operator('clip'):
+    if jit():
+      return '(min(max(%s, %s), %s))' % (recurse(root.args[0]),
+                                         recurse(root.args[1]),
+                                         recurse(root.args[2]))
     return '(np.clip(%s, %s, %s))' % (recurse(root.args[0]),
                                       recurse(root.args[1]),
                                       recurse(root.args[2]))
@@ -222,9 +273,14 @@ def make_inputs(root):
 
 def find_syms(root, ctx=None):
   lsyms = collections.OrderedDict()
+  jit = ctx is not None and ctx.context == 'jit'
   if isinstance(root, Node):
     for node in root.walk():
       if isinstance(node, Node) and node.type == Operator('var'):
+        if (jit and isinstance(node.args[1], Node) and
+            node.args[1].type is Operator('poly')):
+          # Selected one pixel at a time (see sel_poly()).
+          continue
         name = 'var_%d' % node.args[0]
         if name not in lsyms:
           lsyms[name] = to_expr(node.args[1], ctx)
@@ -242,6 +298,44 @@ def find_input_types(root):
       types[node.args[0]] = node.args[1:3]
   return types
 
+POINTWISE = tuple(Operator(op) for op in ('+', '-', '*', '/', ':', '==',
+                                           'lookup', 'in',
+                                           'I', 'var', 'log', 'exp', 'pow',
+                                           'max', 'min', 'clip', 'inv_logit'))
+
+def lookup_tables(root):
+  '''Return the definitions of the global arrays used by the lookup
+nodes of a jit expression.  Numba freezes global arrays into the
+compiled kernel.'''
+  tables = collections.OrderedDict()
+  for node in root.walk():
+    if isinstance(node, Node) and node.type is Operator('lookup'):
+      name = 'lookup_%d' % hash(node.args[2])
+      tables[name] = '%s = np.array(%s, dtype=np.float32)' % (
+        name, to_list(node.args[2].args))
+  return list(tables.values())
+
+def is_pointwise(root):
+  '''Return True if every operator in the tree computes each output cell
+from the same cell of its inputs, i.e. the expression can be evaluated
+one pixel at a time by a numba kernel.'''
+  def check(node):
+    if not isinstance(node, Node):
+      return True
+    if sel_poly(node) is not None:
+      return check(sel_poly(node).args[0])
+    if node.type is Operator('lookup'):
+      return check(node.args[0])
+    if node.type is Operator('scale'):
+      # Without an explicit range scale() depends on the min / max of
+      # the whole input.
+      if len(node.args) != 5:
+        return False
+    elif node.type not in POINTWISE:
+      return False
+    return all(map(check, node.args))
+  return isinstance(root, Node) and check(root)
+
 def find_nonvector(root):
   letters = list(string.ascii_lowercase)
   nonvector = (Operator('poly'), )
@@ -249,6 +343,9 @@ def find_nonvector(root):
   def replace(node):
     if not isinstance(node, Node):
       return node
+    if sel_poly(node) is not None:
+      # Evaluated in the kernel by poly.ortho_poly_sel().
+      raise StopIteration
     if node.type is Operator('var') and node.args[1].type in nonvector:
       nodes[node.args[0]] = node.args[1]
       if node.args[1].type is Operator('poly'):
@@ -267,9 +364,13 @@ def find_nonvector(root):
     return node
   root.transform(replace)
   ## Walk the tree again to verify are no non-vectorizable nodes left
-  for node in root.walk():
-    if isinstance(node, Node):
-      assert not node.type in nonvector, 'non-vectorizable operator left'
+  def check(node):
+    if not isinstance(node, Node) or sel_poly(node) is not None:
+      return
+    assert not node.type in nonvector, 'non-vectorizable operator left'
+    for arg in node.args:
+      check(arg)
+  check(root)
   return nodes
 
 def evalr(root, stab):
@@ -279,6 +380,11 @@ def evalr(root, stab):
       lsyms[col] = stab[col]
   else:
     lsyms = stab
+  if isinstance(root, Node):
+    args = [lsyms.get(name) for name in sorted(set(find_inputs(root)))]
+    func = dense_func(root) if args and is_dense(args) else None
+    if func is not None:
+      return func(*args)
   for name, expr in find_syms(root).items():
     if name not in lsyms:
       lsyms[name] = eval(to_expr(expr), None, lsyms)
@@ -303,6 +409,276 @@ import projections.r2py.poly as poly
   fun3 = "def func_name(): return '%s'" % fname
   return prelude + "\n\n\n" + fun1 + "\n\n\n" + fun2 + "\n\n\n" + fun3 + "\n\n"
 
+## Number of cells evaluated at a time by the code generated by
+## to_dense().  The temporaries of one chunk (64KiB each) stay in cache.
+DENSE_CHUNK = 16384
+
+_DENSE_UFUNCS = {Operator('+'): 'np.add', Operator('-'): 'np.subtract',
+                 Operator('*'): 'np.multiply', Operator(':'): 'np.multiply',
+                 Operator('/'): 'np.divide', Operator('=='): 'np.equal',
+                 Operator('pow'): 'np.power', Operator('max'): 'np.maximum',
+                 Operator('min'): 'np.minimum'}
+
+class _DenseGen(object):
+  '''Three-address code generator for to_dense().  Each node becomes one
+(or a few) ufunc calls that write into a chunk sized temporary.
+Temporaries are recycled as soon as their value has been consumed.
+
+Operands are (text, temp, mask) tuples: the expression of the value,
+the temporary that holds it (None for inputs and constants) and the
+temporary that holds its mask.  Only values derived from log() or exp()
+have a mask since that is where numpy.ma (used by to_py()) turns dense
+inputs into masked arrays.  The masks follow numpy.ma: they are or-ed by every operation,
+and log() and divisions of masked values also mask non-finite results.'''
+  def __init__(self):
+    self.lines = []
+    self.temps = []
+    self.masks = []
+    self.free = {'t': [], 'k': []}
+    self.pinned = set()
+    self.vars = {}
+    self.polys = {}
+    self.scratch = False
+
+  def alloc(self, kind):
+    if self.free[kind]:
+      return self.free[kind].pop()
+    pool = self.temps if kind == 't' else self.masks
+    name = '_%s%d' % (kind, len(pool))
+    pool.append(name)
+    return name
+
+  def release(self, *names):
+    for name in names:
+      if name is not None and name not in self.pinned:
+        self.free[name[1]].append(name)
+
+  def emit(self, line, *args):
+    self.lines.append(line % args)
+
+  def dest(self, *ops):
+    '''Return a temporary for the result of an operation on ops.  The
+temporary of the first operand is reused and the others released.'''
+    temps = [op[1] for op in ops if op[1] is not None and
+             op[1] not in self.pinned]
+    if temps:
+      self.release(*temps[1:])
+      return temps[0]
+    return self.alloc('t')
+
+  def mask(self, ops, invalid=None):
+    '''Combine the masks of ops (and the non-finite cells of the
+temporary invalid) into one mask temporary.'''
+    masks = [op[2] for op in ops if op[2] is not None]
+    if not masks and invalid is None:
+      return None
+    owned = [m for m in masks if m not in self.pinned]
+    res = owned[0] if owned else self.alloc('k')
+    self.release(*owned[1:])
+    others = [m for m in masks if m != res]
+    if invalid is not None:
+      # Use the scratch mask if res already holds a mask.
+      tmp = '_kx' if res in masks else res
+      self.scratch = self.scratch or tmp == '_kx'
+      self.emit('np.isfinite(%s[:_m], out=%s[:_m])', invalid, tmp)
+      self.emit('np.logical_not(%s[:_m], out=%s[:_m])', tmp, tmp)
+      if tmp != res:
+        others.append(tmp)
+    elif res not in masks:
+      self.emit('%s[:_m] = %s[:_m]', res, others.pop(0))
+    for m in others:
+      self.emit('np.logical_or(%s[:_m], %s[:_m], out=%s[:_m])', res, m, res)
+    return res
+
+  def operand(self, node):
+    if not isinstance(node, Node):
+      return (to_expr(node), None, None)
+    if node.type is Operator('in'):
+      return ('_c_%s' % node.args[0], None, None)
+    if node.type is Operator('I'):
+      return self.operand(node.args[0])
+    if node.type is Operator('var'):
+      if node.args[0] not in self.vars:
+        op = self.operand(node.args[1])
+        self.pinned.update(x for x in op[1:] if x is not None)
+        self.vars[node.args[0]] = op
+      return self.vars[node.args[0]]
+    if sel_poly(node) is not None:
+      return self.sel(node, sel_poly(node))
+    if node.type is Operator('lookup'):
+      x = self.plain(node.args[0])
+      res = self.alloc('t')
+      self.emit('%s[:_m] = poly.factor_lookup_vec(%s, %d, %s)', res, x[0],
+                node.args[1], to_expr(node.args[2]))
+      self.release(x[1])
+      return ('%s[:_m]' % res, res, None)
+    if node.type in _DENSE_UFUNCS:
+      return self.ufunc(node)
+    if node.type in (Operator('log'), Operator('exp')):
+      x = self.operand(node.args[0])
+      res = self.dest(x)
+      self.emit('np.%s(%s, out=%s[:_m])', node.type.type, x[0], res)
+      if node.type is Operator('log'):
+        return ('%s[:_m]' % res, res, self.mask([x], res))
+      if x[2] is not None:
+        return ('%s[:_m]' % res, res, self.mask([x]))
+      # ma.exp() returns a masked array even if nothing is masked.
+      mask = self.alloc('k')
+      self.emit('%s[:_m] = False', mask)
+      return ('%s[:_m]' % res, res, mask)
+    if node.type is Operator('clip'):
+      ops = [self.operand(arg) for arg in node.args]
+      res = self.dest(*ops)
+      self.emit('np.clip(%s, %s, %s, out=%s[:_m])', ops[0][0], ops[1][0],
+                ops[2][0], res)
+      return ('%s[:_m]' % res, res, self.mask(ops))
+    if node.type is Operator('inv_logit'):
+      x = self.plain(node.args[0])
+      res = self.dest(x)
+      tmp = self.alloc('t')
+      self.emit('np.exp(%s, out=%s[:_m])', x[0], res)
+      self.emit('np.add(%s[:_m], np.float32(1), out=%s[:_m])', res, tmp)
+      self.emit('np.divide(%s[:_m], %s[:_m], out=%s[:_m])', res, tmp, res)
+      self.release(tmp)
+      return ('%s[:_m]' % res, res, None)
+    if node.type is Operator('scale') and len(node.args) == 5:
+      # Same operations as poly.scale().
+      x = self.plain(node.args[0])
+      res = self.dest(x)
+      self.emit('np.subtract(%s, np.float32(%f), out=%s[:_m])', x[0],
+                node.args[3], res)
+      self.emit('np.divide(%s[:_m], np.float32(%f) - np.float32(%f), '
+                'out=%s[:_m])', res, node.args[4], node.args[3], res)
+      self.emit('np.multiply(%s[:_m], np.float32(%d) - np.float32(%d), '
+                'out=%s[:_m])', res, node.args[2], node.args[1], res)
+      self.emit('np.add(%s[:_m], np.float32(%d), out=%s[:_m])', res,
+                node.args[1], res)
+      return ('%s[:_m]' % res, res, None)
+    raise ValueError("operator %s cannot be evaluated densely" % node.type)
+
+  def plain(self, node):
+    '''Operand that must not have a mask: functions that drop the mask
+see the values numpy.ma leaves under it, and inv_logit() of a masked
+array is computed in double precision.'''
+    op = self.operand(node)
+    if op[2] is not None:
+      raise ValueError('masked argument to a function without mask support')
+    return op
+
+  def ufunc(self, node):
+    ops = [self.operand(node.args[0])]
+    for arg in node.args[1:]:
+      right = self.operand(arg)
+      left = ops[-1]
+      res = self.dest(left, right)
+      self.emit('%s(%s, %s, out=%s[:_m])', _DENSE_UFUNCS[node.type], left[0],
+                right[0], res)
+      masked = left[2] is not None or right[2] is not None
+      invalid = res if node.type is Operator('/') and masked else None
+      ops[-1] = ('%s[:_m]' % res, res, self.mask([left, right], invalid))
+    return ops[-1]
+
+  def sel(self, node, pnode):
+    key = hash(pnode)
+    if key not in self.polys:
+      x = self.plain(pnode.args[0])
+      name = '_p%d' % len(self.polys)
+      self.emit('%s = poly.ortho_poly_predict(%s, %s, %s, %d)', name, x[0],
+                to_tuple(pnode.args[2].args), to_tuple(pnode.args[3].args),
+                pnode.args[1])
+      self.release(x[1])
+      self.polys[key] = name
+    return ('%s[:, %d]' % (self.polys[key], node.args[1]), None, None)
+
+def to_dense(root, fname, chunk=DENSE_CHUNK):
+  '''Generate a function that evaluates root for dense (not masked)
+float32 inputs of the same shape.  Unlike to_py() it only uses plain
+numpy ufuncs that write into preallocated temporaries, and evaluates
+the expression chunk cells at a time so the temporaries stay in cache.
+The result is the same as that of the function generated by to_py()
+(a masked array only if the expression takes a log()).
+
+Raises ValueError if the expression is not pointwise (see
+is_pointwise()).'''
+  if not is_pointwise(root):
+    raise ValueError('expression is not pointwise')
+  if root.type is Operator('=='):
+    raise ValueError('expression is a comparison')
+  inputs = sorted(set(find_inputs(root)))
+  if not inputs:
+    raise ValueError('expression has no inputs')
+  gen = _DenseGen()
+  res = gen.operand(root)
+  out = 'out=%s[:_m])' % res[1]
+  if res[2] is None and gen.lines and gen.lines[-1].endswith(out):
+    # Write the last operation straight into the result.
+    gen.lines[-1] = gen.lines[-1][:-len(out)] + 'out=_res[_s:_e])'
+  else:
+    gen.emit('_res[_s:_e] = %s', res[0])
+  if res[2] is not None:
+    gen.emit('_mask[_s:_e] = %s[:_m]', res[2])
+  body = ['_shape = %s.shape' % inputs[0],
+          '_n = %s.size' % inputs[0],
+          '_size = min(_n, %d)' % chunk]
+  body += ['%s = %s.reshape(-1)' % (v, v) for v in inputs]
+  body += ['%s = np.empty(_size, dtype=np.float32)' % t for t in gen.temps]
+  body += ['%s = np.empty(_size, dtype=np.bool_)' % k
+           for k in gen.masks + (['_kx'] if gen.scratch else [])]
+  body.append('_res = np.empty(_n, dtype=np.float32)')
+  if res[2] is not None:
+    body.append('_mask = np.empty(_n, dtype=np.bool_)')
+  loop = ['for _s in range(0, _n, %d):' % chunk,
+          '  _e = min(_s + %d, _n)' % chunk,
+          '  _m = _e - _s']
+  loop += ['  _c_%s = %s[_s:_e]' % (v, v) for v in inputs]
+  loop += ['  ' + line for line in gen.lines]
+  if gen.masks:
+    # numpy.ma does not warn about the cells it masks.
+    body.append("with np.errstate(divide='ignore', invalid='ignore'):")
+    body += ['  ' + line for line in loop]
+  else:
+    body += loop
+  if res[2] is not None:
+    body.append('return ma.masked_array(_res.reshape(_shape), '
+                'mask=_mask.reshape(_shape))')
+  else:
+    body.append('return _res.reshape(_shape)')
+  prelude = '''
+import numpy as np
+import numpy.ma as ma
+import projections.r2py.poly as poly
+'''
+  fun1 = "def %s(%s):\n  " % (fname, ', '.join(inputs)) + "\n  ".join(body)
+  iodecls = ["stab['%s']" % v for v in inputs]
+  fun2 = "def %s_st(stab):\n  return %s(%s)" % (fname, fname,
+                                                 ", ".join(iodecls))
+  fun3 = "def func_name(): return '%s'" % fname
+  return prelude + "\n\n\n" + fun1 + "\n\n\n" + fun2 + "\n\n\n" + fun3 + "\n\n"
+
+def is_dense(arrays):
+  '''Return True if arrays are plain (not masked) float32 arrays of the
+same shape, i.e. valid arguments of the functions generated by
+to_dense().'''
+  return (all(type(x) is np.ndarray and x.dtype == np.float32
+              for x in arrays) and
+          len(set(x.shape for x in arrays)) == 1)
+
+_DENSE_FUNCS = {}
+
+def dense_func(root):
+  '''Return the function generated by to_dense() for root, or None if
+root cannot be evaluated densely.  Functions are compiled once per
+expression.  The arguments are the inputs of root in sorted order.'''
+  key = repr(root)
+  if key not in _DENSE_FUNCS:
+    lokals = {}
+    try:
+      exec(to_dense(root, 'dense'), lokals)
+      _DENSE_FUNCS[key] = lokals['dense']
+    except ValueError:
+      _DENSE_FUNCS[key] = None
+  return _DENSE_FUNCS[key]
+
 def to_pyx(root, fname):
   lsyms = find_syms(root)
   decls = ["cdef np.ndarray %s = %s" % (name, lsyms[name])
@@ -329,26 +705,57 @@ ctypedef np.float_t DTYPE_t
 def rreplace(src, what, repl, num=1):
   return repl.join(src.rsplit(what, num))
 
-def to_numba(root, fname, out_name, child=False, ctx=None):
+def to_numba(root, fname, out_name, child=False, ctx=None, cache=True,
+             typed=True, parallel=False, fastmath=False, error_model=None):
+  '''Generate the source of a module that evaluates the tree with a numba
+kernel.  When typed is set the kernel is declared with an explicit
+float32 signature (derived from the input types), so it is compiled (or
+loaded from the numba cache) when the module is imported instead of on
+the first call, and the wrapper functions cast their inputs to float32
+(cells masked in any input are masked in the result).  Typed kernels can also be compiled ahead of time (see
+modelstore.compile_aot()).
+
+parallel generates a parallel=True kernel whose per-pixel loop is a
+prange, so a single large block uses all cores.  Numba's default
+(workqueue) threading layer does not support calls from several threads
+at once, so use parallel kernels with the serial or process executors
+(or install tbb).  fastmath lets LLVM reorder floating point operations,
+which changes results in the last bits.  error_model is passed to numba
+as is: with 'numpy' a division by zero gives inf or NaN instead of
+raising ZeroDivisionError.'''
   inputs = find_inputs(root)
   poly_src = inspect.getsource(poly.ortho_poly_predict)
   impts = '''
-from numba import jit, guvectorize, float32, int64
+from numba import jit, guvectorize, float32, int64, prange
 import numpy as np
 import numpy.ma as ma
 import projections.r2py.poly as poly
 {poly}
+def _f32(x):
+  return np.asarray(ma.getdata(x), dtype=np.float32)
+
+def _remask(res, *args):
+  # Cells masked in any input are masked in (every row of) the result.
+  mask = ma.nomask
+  for arg in args:
+    mask = ma.mask_or(mask, ma.getmask(arg))
+  if mask is ma.nomask:
+    return res
+  return ma.masked_array(res, mask=np.broadcast_to(mask, res.shape).copy())
 '''.format(poly=poly_src)
+  cast = (lambda x: '_f32(%s)' % x) if typed else (lambda x: x)
   ## *****
   ## NOTE: This operation modifies the expression tree.
   ## *****
   io_types = find_input_types(root)
   ios = sorted(io_types.keys())
   nonvector = find_nonvector(root)
-  params = ["df['%s']" % v for v in sorted(inputs)]
+  params = [cast("df['%s']" % v) for v in sorted(inputs)]
   
   if nonvector:
-    vec_fun = to_numba(root, '_' + fname, out_name, child=True)
+    vec_fun = to_numba(root, '_' + fname, out_name, child=True, cache=cache,
+                       typed=typed, parallel=parallel, fastmath=fastmath,
+                       error_model=error_model)
     inner_inputs = sorted(find_inputs(root))
     stmts = ["var_%d = %s" % (name, to_expr(nonvector[name]))
              for name in nonvector.keys()]
@@ -361,27 +768,44 @@ def {fname}({iodecls}):
            fname = fname,
            iodecls = ', '.join(ios),
            stmts = '\n  '.join(stmts),
-           inputs = ', '.join(inner_inputs))
+           inputs = ', '.join(map(cast, inner_inputs)))
   else:
     lsyms = find_syms(root, Context('jit', 'idx'))
     stmts = ["%s = %s" % (name, lsyms[name]) for name in lsyms.keys()]
-    expr = to_expr(root, Context('jit', 'idx'))
     nb_types = ', '.join([io_types[x][0] for x in sorted(io_types)])
+    if root.type is Operator('list'):
+      # One row of the result per expression.
+      res_type = 'float32[:, :]'
+      alloc = '(%d, %s.size)' % (len(root.args), inputs[0])
+      stmts += ["res[%d, idx] = %s" % (row, to_expr(arg, Context('jit', 'idx')))
+                for row, arg in enumerate(root.args)]
+    else:
+      res_type = 'float32[:]'
+      alloc = '%s.size' % inputs[0]
+      stmts += ["res[idx] = %s" % to_expr(root, Context('jit', 'idx'))]
     body = '''
-@jit(#[float32[:]({nb_types})],
-     cache=True, nopython=True, nogil=True)
+{tables}
+@jit({sig}
+     cache={cache}, nopython=True, nogil=True{options})
 def {fname}({iodecls}):
-  res = np.empty({first_in}.size, dtype=np.float32)
-  for idx in np.arange({first_in}.size):
+  res = np.empty({alloc}, dtype=np.float32)
+  for idx in {loop}({first_in}.size):
     {stmts}
-    res[idx] = {expr}
   return res
-'''.format(nb_types = nb_types,
+'''.format(sig = ('[%s(%s)],' % (res_type, nb_types) if typed else
+                  '#[%s(%s)],' % (res_type, nb_types)),
+           alloc = alloc,
+           tables = '\n'.join(lookup_tables(root)),
+           cache = cache,
+           options = ((', parallel=True' if parallel else '') +
+                      (', fastmath=True' if fastmath else '') +
+                      (", error_model='%s'" % error_model
+                       if error_model else '')),
+           loop = 'prange' if parallel else 'np.arange',
            fname = fname,
            iodecls = ', '.join(ios),
            first_in = inputs[0],
-           stmts = "\n    ".join(stmts),
-           expr = expr)
+           stmts = "\n    ".join(stmts))
     if child:
       return body
     
@@ -390,13 +814,13 @@ def {fname}({iodecls}):
 {body}
 
 def {fname}_st(df):
-  return {fname}({params})
+  return {call}
 
 def inputs():
   return {in_list}
 
 def output():
-  return "{out_name}"
+  return {out_name}
 
 def func_name():
   return "{fname}"
@@ -404,7 +828,25 @@ def func_name():
 '''.format(prelude = impts if not child else '',
            body = body,
            fname = fname,
-           params = ', '.join(params),
+           call = (('_remask(%s(%s), %s)' %
+                    (fname, ', '.join(params),
+                     ', '.join("df['%s']" % v for v in sorted(inputs))))
+                   if typed else
+                   '%s(%s)' % (fname, ', '.join(params))),
            in_list = sorted(inputs),
-           out_name = out_name)
+           out_name = ('"%s"' % out_name if isinstance(out_name, str) else
+                       repr(list(out_name))))
   return code
+
+def to_numba_multi(roots, fname, cache=True, typed=True, parallel=False,
+                   fastmath=False):
+  '''Generate the source of a module with a single kernel that evaluates
+several trees (a dictionary that maps output names to trees) in one pass
+over the inputs.  The kernel returns a (k, n) array with one row per
+tree, in the order of roots, and output() returns the list of output
+names.  Subexpressions common to several trees (e.g. the poly() terms of
+models fitted on the same inputs) are computed once per pixel.'''
+  names = list(roots.keys())
+  root = tree.cse(Node(Operator('list'), [roots[name] for name in names]))
+  return to_numba(root, fname, names, cache=cache, typed=typed,
+                  parallel=parallel, fastmath=fastmath)
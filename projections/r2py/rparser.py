@@ -1,12 +1,23 @@
-from pyparsing import *
+import functools
 import re
-ParserElement.enablePackrat()
 
+from . import tree
 from .tree import Node, Operator
 
 import pdb
 
+class ParseError(ValueError):
+  pass
+
 def rparser():
+  '''Build the pyparsing grammar.  Only used by parse_pyparsing(), the
+reference for the hand-written parser below.'''
+  from pyparsing import (Forward, Group, Literal, Optional, ParserElement,
+                         Word, alphanums, alphas, dblQuotedString,
+                         delimitedList, infixNotation, nums, oneOf, opAssoc,
+                         pyparsing_common)
+  ParserElement.enablePackrat()
+
   expr = Forward()
 
   lparen = Literal("(").suppress()
@@ -33,107 +44,233 @@ def rparser():
                          (plusop, 2, opAssoc.LEFT),]).setResultsName('expr')
   return expr
 
-PARSER = rparser()
+_PARSER = None
 
-def parse(text):
-  def walk(l):
-    ## ['log', [['cropland', '+', 1]]]
-    ## ['poly', [['log', [['cropland', '+', 1]]], 3], 3]
-    ## [[['factor', ['unSub'], 21], ':', ['poly', [['log', [['cropland', '+', 1]]], 3], 3], ':', ['poly', [['log', [['hpd', '+', 1]]], 3], 2]]]
-    if type(l) in (int, float):
-        return l
-    if isinstance(l, str):
-      if l == 'Intercept' or l == '"Intercept"':
-        return 1
-      elif l[0] == '"' and l[-1] == '"':
-        return l[1:-1]
-      else:
-        return l
-    if len(l) == 1 and type(l[0]) in (int, str, float, ParseResults):
-      return walk(l[0])
-    if l[0] == 'factor':
-      assert len(l) == 3, "unexpected number of arguments to factor"
-      assert len(l[1]) == 1, "argument to factor is an expression"
-      assert type(l[2]) == int, "second argument to factor is not an int"
-      return Node(Operator('=='), (Node(Operator('in'),
-                                        (l[1][0], 'float32[:]')), l[2]))
-    if l[0] == 'poly':
-      assert len(l) in (2, 3), "unexpected number of arguments to poly"
-      assert isinstance(l[1][1], int), "degree argument to poly is not an int"
-      inner = walk(l[1][0])
-      degree = l[1][1]
-      if len(l) == 2:
-        pwr = 1
-      else:
-        assert type(l[2]) == int, "power argument to poly is not an int"
-        pwr = l[2]
-      return Node(Operator('sel'), (Node(Operator('poly'), (inner, degree)),
-                                    pwr))
-    if l[0] == 'log':
-      assert len(l) == 2, "unexpected number of arguments to log"
-      args = walk(l[1])
-      return Node(Operator('log'), [args])
-    if l[0] == 'scale':
-      assert len(l[1]) in (3, 5), "unexpected number of arguments to scale"
-      args = walk(l[1][0])
-      return Node(Operator('scale'), [args] + l[1][1:])
-    if l[0] == 'I':
-      assert len(l) == 2, "unexpected number of arguments to I"
-      args = walk(l[1])
-      return Node(Operator('I'), [args])
-    # Only used for testing
-    if l[0] in ('sin', 'tan'):
-      assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
-      args = walk(l[1])
-      return Node(Operator(l[0]), [args])
-    if l[0] in ('max', 'min', 'pow'):
-      assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
-      assert len(l[1]) == 2, "unexpected number of arguments to %s" % l[0]
-      left = walk(l[1][0])
-      right = walk(l[1][1])
-      return Node(Operator(l[0]), (left, right))
-    if l[0] == 'exp':
-      assert len(l) == 2, "unexpected number of arguments to exp"
-      args = walk(l[1])
-      return Node(Operator('exp'), [args])
-    if l[0] == 'clip':
-      assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
-      assert len(l[1]) == 3, "unexpected number of arguments to %s" % l[0]
-      left = walk(l[1][0])
-      low = walk(l[1][1])
-      high = walk(l[1][2])
-      return Node(Operator(l[0]), (left, low, high))
-    if l[0] == 'inv_logit':
-      assert len(l) == 2, "unexpected number of arguments to inv_logit"
-      args = walk(l[1])
-      return Node(Operator('inv_logit'), [args])
-      
-
-    ## Only binary operators left
-    if len(l) == 1:
-      pdb.set_trace()
-      pass
-    assert len(l) % 2 == 1, "unexpected number of arguments for binary operator"
-    assert len(l) != 1, "unexpected number of arguments for binary operator"
-    ## FIXME: this only works for associative operators.  Need to either
-    ## special-case division or include an attribute that specifies
-    ## whether the op is associative.
-    left = walk(l.pop(0))
-    op = l.pop(0)
-    right = walk(l)
-    if type(right) != Node:
-      return Node(Operator(op), (left, right))
-    elif right.type.type == op:
-      return Node(Operator(op), (left, ) + right.args)
+def __getattr__(name):
+  ## Build the pyparsing grammar on first use (importing pyparsing and
+  ## building the grammar is slow).
+  global _PARSER
+  if name == 'PARSER':
+    if _PARSER is None:
+      _PARSER = rparser()
+    return _PARSER
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+## Tokens of the hand-written parser.  Numbers match
+## pyparsing_common.number and the trailing integer of a function call
+## (e.g. poly(x, 3)2 or factor(unSub)21) pyparsing_common.signed_integer.
+_SPACE = re.compile(r'\s*')
+_NUMBER = re.compile(r'[+-]?(?:\d+[eE][+-]?\d+|(?:\d+\.\d*|\.\d+)'
+                     r'(?:[eE][+-]?\d+)?)|([+-]?\d+)')
+_INTEGER = re.compile(r'[+-]?\d+')
+_STRING = re.compile(r'"(?:[^"\n\r\\]|""|\\.)*"')
+_IDENT = re.compile(r'[A-Za-z_][A-Za-z0-9_.]*')
+
+## Binary operators from the tightest to the loosest binding.  ^ is right
+## associative, the others are left associative.
+_LEVELS = (('^', ), ('|', ':'), ('*', '/'), ('+', '-'))
+
+class _Parser(object):
+  '''Recursive-descent parser for the grammar of rparser().  It returns
+the same nested lists as pyparsing, e.g.
+
+  [[['factor', ['unSub'], 143], ':', ['poly', [['log', [['hpd', '+', 1]]], 3], 2]]]
+
+so the result can be converted to a tree by walk().'''
+  def __init__(self, text):
+    self.text = text
+    self.pos = 0
+
+  def error(self, msg):
+    raise ParseError('%s at column %d in "%s"' % (msg, self.pos + 1,
+                                                  self.text))
+
+  def peek(self):
+    self.pos = _SPACE.match(self.text, self.pos).end()
+    return self.text[self.pos:self.pos + 1]
+
+  def match(self, regexp):
+    self.peek()
+    m = regexp.match(self.text, self.pos)
+    if m:
+      self.pos = m.end()
+    return m
+
+  def expect(self, char):
+    if self.peek() != char:
+      self.error("expected '%s'" % char)
+    self.pos += 1
+
+  def parse(self):
+    res = self.expr(len(_LEVELS) - 1)
+    if self.peek():
+      self.error('unexpected input')
+    return [res]
+
+  def expr(self, level):
+    if level < 0:
+      return self.operand()
+    ops = _LEVELS[level]
+    first = self.expr(level - 1)
+    res = [first]
+    while self.peek() and self.peek() in ops:
+      res.append(self.text[self.pos])
+      self.pos += 1
+      if ops == ('^', ):
+        # a ^ b ^ c is [a, '^', [b, '^', c]]
+        res.append(self.expr(level))
+        break
+      res.append(self.expr(level - 1))
+    return res if len(res) > 1 else first
+
+  def operand(self):
+    m = self.match(_NUMBER)
+    if m:
+      return int(m.group(0)) if m.group(1) else float(m.group(0))
+    m = self.match(_STRING)
+    if m:
+      return m.group(0)
+    m = self.match(_IDENT)
+    if m:
+      if self.peek() != '(':
+        return m.group(0)
+      self.pos += 1
+      args = []
+      if self.peek() != ')':
+        args.append(self.expr(len(_LEVELS) - 1))
+        while self.peek() == ',':
+          self.pos += 1
+          args.append(self.expr(len(_LEVELS) - 1))
+      self.expect(')')
+      res = [m.group(0), args]
+      power = self.match(_INTEGER)
+      if power:
+        res.append(int(power.group(0)))
+      return res
+    if self.peek() == '(':
+      self.pos += 1
+      res = self.expr(len(_LEVELS) - 1)
+      self.expect(')')
+      return res
+    self.error('expected an operand')
+
+def walk(l):
+  ## ['log', [['cropland', '+', 1]]]
+  ## ['poly', [['log', [['cropland', '+', 1]]], 3], 3]
+  ## [[['factor', ['unSub'], 21], ':', ['poly', [['log', [['cropland', '+', 1]]], 3], 3], ':', ['poly', [['log', [['hpd', '+', 1]]], 3], 2]]]
+  if type(l) in (int, float):
+      return l
+  if isinstance(l, str):
+    if l == 'Intercept' or l == '"Intercept"':
+      return 1
+    elif l[0] == '"' and l[-1] == '"':
+      return l[1:-1]
+    else:
+      return l
+  if len(l) == 1 and isinstance(l[0], (int, str, float, list)):
+    return walk(l[0])
+  if l[0] == 'factor':
+    assert len(l) == 3, "unexpected number of arguments to factor"
+    assert len(l[1]) == 1, "argument to factor is an expression"
+    assert type(l[2]) == int, "second argument to factor is not an int"
+    return Node(Operator('=='), (Node(Operator('in'),
+                                      (l[1][0], 'float32[:]')), l[2]))
+  if l[0] == 'poly':
+    assert len(l) in (2, 3), "unexpected number of arguments to poly"
+    assert isinstance(l[1][1], int), "degree argument to poly is not an int"
+    inner = walk(l[1][0])
+    degree = l[1][1]
+    if len(l) == 2:
+      pwr = 1
+    else:
+      assert type(l[2]) == int, "power argument to poly is not an int"
+      pwr = l[2]
+    return Node(Operator('sel'), (Node(Operator('poly'), (inner, degree)),
+                                  pwr))
+  if l[0] == 'log':
+    assert len(l) == 2, "unexpected number of arguments to log"
+    args = walk(l[1])
+    return Node(Operator('log'), [args])
+  if l[0] == 'scale':
+    assert len(l[1]) in (3, 5), "unexpected number of arguments to scale"
+    args = walk(l[1][0])
+    return Node(Operator('scale'), [args] + l[1][1:])
+  if l[0] == 'I':
+    assert len(l) == 2, "unexpected number of arguments to I"
+    args = walk(l[1])
+    return Node(Operator('I'), [args])
+  # Only used for testing
+  if l[0] in ('sin', 'tan'):
+    assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
+    args = walk(l[1])
+    return Node(Operator(l[0]), [args])
+  if l[0] in ('max', 'min', 'pow'):
+    assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
+    assert len(l[1]) == 2, "unexpected number of arguments to %s" % l[0]
+    left = walk(l[1][0])
+    right = walk(l[1][1])
+    return Node(Operator(l[0]), (left, right))
+  if l[0] == 'exp':
+    assert len(l) == 2, "unexpected number of arguments to exp"
+    args = walk(l[1])
+    return Node(Operator('exp'), [args])
+  if l[0] == 'clip':
+    assert len(l) == 2, "unexpected number of arguments to %s" % l[0]
+    assert len(l[1]) == 3, "unexpected number of arguments to %s" % l[0]
+    left = walk(l[1][0])
+    low = walk(l[1][1])
+    high = walk(l[1][2])
+    return Node(Operator(l[0]), (left, low, high))
+  if l[0] == 'inv_logit':
+    assert len(l) == 2, "unexpected number of arguments to inv_logit"
+    args = walk(l[1])
+    return Node(Operator('inv_logit'), [args])
+
+
+  ## Only binary operators left
+  if len(l) == 1:
+    pdb.set_trace()
+    pass
+  assert len(l) % 2 == 1, "unexpected number of arguments for binary operator"
+  assert len(l) != 1, "unexpected number of arguments for binary operator"
+  ## FIXME: this only works for associative operators.  Need to either
+  ## special-case division or include an attribute that specifies
+  ## whether the op is associative.
+  left = walk(l.pop(0))
+  op = l.pop(0)
+  right = walk(l)
+  if type(right) != Node:
     return Node(Operator(op), (left, right))
+  elif right.type.type == op:
+    return Node(Operator(op), (left, ) + right.args)
+  return Node(Operator(op), (left, right))
 
+def _prepare(text):
   ### FIXME: hack
   if not isinstance(text, str):
     text = str(text)
   new_text = re.sub('newrange = c\((\d), (\d+)\)', '\\1, \\2', text)
-  new_text = new_text.replace('rescale(', 'scale(')
-  nodes = PARSER.parseString(new_text, parseAll=True)
-  tree =  walk(nodes)
-  if isinstance(tree, (str, int, float)):
-    tree = Node(Operator('I'), [tree])
-  return tree
+  return new_text.replace('rescale(', 'scale(')
+
+def _to_tree(nodes):
+  res = walk(nodes)
+  if isinstance(res, (str, int, float)):
+    res = Node(Operator('I'), [res])
+  return res
+
+@functools.lru_cache(maxsize=4096)
+def _parse(text):
+  return _to_tree(_Parser(_prepare(text)).parse())
+
+def parse(text):
+  '''Parse an R expression (or model term) into a tree.  Trees are cached
+by the text of the expression; each call returns a new copy since
+callers modify the trees they get.'''
+  if not isinstance(text, str):
+    text = str(text)
+  return tree.clone(_parse(text))
+
+def parse_pyparsing(text):
+  '''Parse text with the pyparsing grammar (slow).'''
+  nodes = __getattr__('PARSER').parseString(_prepare(text), parseAll=True)
+  return _to_tree(nodes.asList())
@@ -1,3 +1,4 @@
+import collections
 import functools
 import itertools
 import sys
@@ -57,6 +58,324 @@ class Node(object):
     newnode.args = tuple(filter(lambda x: x is not None, newargs))
     return newnode
     
+def clone(root):
+  '''Return a copy of the tree that shares no Node with the original.
+Operators are singletons and are not copied.'''
+  if not isinstance(root, Node):
+    return root
+  return Node(root.type, tuple(clone(arg) for arg in root.args))
+
+def is_const(node):
+  return isinstance(node, (int, float)) and not isinstance(node, bool)
+
+def _const_fold(op, args):
+  ## Evaluate an operator whose arguments are all constants.  Returns
+  ## None if the operator cannot be folded.
+  import math
+  try:
+    if op is Operator('+'):
+      return sum(args)
+    if op is Operator('-'):
+      return args[0] - sum(args[1:]) if len(args) > 1 else -args[0]
+    if op is Operator('*') or op is Operator(':'):
+      return functools.reduce(lambda a, b: a * b, args)
+    if op is Operator('/'):
+      return functools.reduce(lambda a, b: a / b, args)
+    if op is Operator('I'):
+      return args[0]
+    if op is Operator('log'):
+      return math.log(args[0])
+    if op is Operator('exp'):
+      return math.exp(args[0])
+    if op is Operator('pow'):
+      return math.pow(args[0], args[1])
+    if op is Operator('inv_logit'):
+      return math.exp(args[0]) / (1 + math.exp(args[0]))
+    if op is Operator('=='):
+      return 1 if args[0] == args[1] else 0
+  except (ArithmeticError, ValueError):
+    return None
+  return None
+
+def fold(root, constants=None, absorb=False):
+  '''Fold constants in the tree.  Inputs (in nodes) named in the
+dictionary constants are replaced by their value first.  Besides
+evaluating operators with constant arguments, zero terms of sums and
+unit factors of products are dropped.  These rewrites preserve the value
+of the expression everywhere.  With absorb set products (and
+interactions) with a zero factor, and zero divided by anything, are
+folded to zero too, even where the other operands are NaN or masked; use
+it only to drop the terms zeroed out by substituted constants (e.g. a
+land use that is always 0).  Returns a new tree, which is a constant
+when the whole expression folds.'''
+  constants = constants or {}
+  memo = {}
+  def visit(node):
+    if not isinstance(node, Node):
+      return node
+    if id(node) in memo:
+      return memo[id(node)]
+    op = node.type
+    if op is Operator('in'):
+      res = constants.get(node.args[0], node)
+    elif op is Operator('var'):
+      inner = visit(node.args[1])
+      res = inner if is_const(inner) else Node(op, (node.args[0], inner))
+    elif op is Operator('list'):
+      res = node
+    else:
+      args = tuple(visit(arg) for arg in node.args)
+      res = None
+      if all(map(is_const, args)):
+        res = _const_fold(op, args)
+      if res is None:
+        res = _simplify(op, args, absorb)
+    memo[id(node)] = res
+    return res
+  return visit(root)
+
+def _merge_consts(args, combine, identity):
+  ## Combine the constant arguments of a commutative operator into one,
+  ## placed where the first constant was.
+  consts = [arg for arg in args if is_const(arg)]
+  if len(consts) < 2 and not (consts and consts[0] == identity):
+    return list(args)
+  value = functools.reduce(combine, consts)
+  res = []
+  for arg in args:
+    if not is_const(arg):
+      res.append(arg)
+    elif consts is not None:
+      if value != identity:
+        res.append(value)
+      consts = None
+  return res
+
+def _simplify(op, args, absorb=False):
+  if op is Operator('*') or op is Operator(':'):
+    if absorb and any(is_const(arg) and arg == 0 for arg in args):
+      return 0
+    args = _merge_consts(args, lambda a, b: a * b, 1)
+    if not args:
+      return 1
+    return args[0] if len(args) == 1 else Node(op, args)
+  if op is Operator('+'):
+    args = _merge_consts(args, lambda a, b: a + b, 0)
+    if not args:
+      return 0
+    return args[0] if len(args) == 1 else Node(op, args)
+  if op is Operator('-'):
+    args = [args[0]] + [arg for arg in args[1:]
+                        if not (is_const(arg) and arg == 0)]
+    return args[0] if len(args) == 1 else Node(op, args)
+  if op is Operator('/'):
+    if absorb and is_const(args[0]) and args[0] == 0:
+      return 0
+    args = [args[0]] + [arg for arg in args[1:]
+                        if not (is_const(arg) and arg == 1)]
+    return args[0] if len(args) == 1 else Node(op, args)
+  return Node(op, args)
+
+## Largest table (levels between the smallest and the largest level of a
+## factor) built by factor_lookups().
+MAX_LOOKUP_SIZE = 4096
+
+def _factors(node):
+  ## Flatten a product (or interaction) into the list of its factors.
+  if isinstance(node, Node) and node.type is Operator('var'):
+    return _factors(node.args[1])
+  if isinstance(node, Node) and node.type in (Operator('*'), Operator(':')):
+    return [f for arg in node.args for f in _factors(arg)]
+  return [node]
+
+def _level(node):
+  ## Return (input, level) if node compares an input with an integer
+  ## (e.g. factor(unSub)21), otherwise None.
+  if isinstance(node, Node) and node.type is Operator('var'):
+    node = node.args[1]
+  if not isinstance(node, Node) or node.type is not Operator('=='):
+    return None
+  a, b = node.args
+  if is_const(a):
+    a, b = b, a
+  if (isinstance(a, Node) and a.type is Operator('in') and is_const(b) and
+      b == int(b)):
+    return a, int(b)
+  return None
+
+class _LevelGroup(object):
+  def __init__(self, inp, rest):
+    self.input = inp
+    self.rest = rest
+    self.coefs = collections.OrderedDict()
+    self.terms = []
+
+  def node(self):
+    offset = min(self.coefs.keys())
+    size = max(self.coefs.keys()) - offset + 1
+    if len(self.terms) < 2 or size > MAX_LOOKUP_SIZE:
+      return None
+    table = [float(self.coefs.get(offset + i, 0.0)) for i in range(size)]
+    lookup = Node(Operator('lookup'), (self.input, offset,
+                                       Node(Operator('list'), table)))
+    if not self.rest:
+      return lookup
+    return Node(Operator('*'), [lookup] + self.rest)
+
+def _group_levels(args):
+  ## Replace the terms of a sum that are (constant) multiples of
+  ## comparisons of the same input, times the same other factors, by a
+  ## single lookup term.
+  groups = {}
+  res = []
+  for arg in args:
+    factors = _factors(arg)
+    levels = [f for f in factors if _level(f) is not None]
+    if len(levels) != 1:
+      res.append(arg)
+      continue
+    inp, level = _level(levels[0])
+    coef = 1
+    rest = []
+    for f in factors:
+      if f is levels[0]:
+        continue
+      if is_const(f):
+        coef *= f
+      else:
+        rest.append(f)
+    rest.sort(key=hash)
+    key = (inp.args[0], tuple(hash(f) for f in rest))
+    if key not in groups:
+      groups[key] = _LevelGroup(inp, rest)
+      res.append(groups[key])
+    groups[key].coefs[level] = groups[key].coefs.get(level, 0) + coef
+    groups[key].terms.append(arg)
+  out = []
+  for item in res:
+    if not isinstance(item, _LevelGroup):
+      out.append(item)
+      continue
+    node = item.node()
+    if node is None:
+      out.extend(item.terms)
+    else:
+      out.append(node)
+  return out
+
+def factor_lookups(root):
+  '''Replace the levels of a factor by a lookup table.  R models
+expand a factor into one term per level, e.g.
+
+  c21 * factor(unSub)21 + c22 * factor(unSub)22 + ...
+
+which rparser turns into a sum of products with (== unSub level)
+comparisons, so the cost of evaluating a pixel grows with the number of
+levels (and interactions repeat the comparisons for every term they
+appear in).  The terms of a sum that only differ by the level (and the
+coefficient) are replaced by
+
+  (lookup unSub offset (list c...))
+
+times the other factors of the terms, which returns the coefficient of
+the level equal to the input (0 if there is none) by indexing a table.
+Returns a new tree.'''
+  memo = {}
+  def visit(node):
+    if not isinstance(node, Node) or node.type in (Operator('in'),
+                                                   Operator('list')):
+      return node
+    if id(node) in memo:
+      return memo[id(node)]
+    args = [visit(arg) for arg in node.args]
+    if node.type is Operator('+'):
+      args = _group_levels(args)
+      res = args[0] if len(args) == 1 else Node(node.type, args)
+    else:
+      res = Node(node.type, args)
+    memo[id(node)] = res
+    return res
+  return visit(root)
+
+def cse(root, always=None):
+  '''Common subexpression elimination by hash-consing.  Structurally
+equal subtrees are merged bottom-up in a single pass (each node is
+looked up by its operator and the identity of its already merged
+children, so the cost is linear in the size of the tree).  Subtrees
+used more than once, every subtree whose operator is in always (poly
+and == by default, which the code generators expect), every subtree
+that was already in a var node and the argument of inv_logit (which the
+code generators use twice) are wrapped in a var node so they are
+computed once.  Returns a new tree; shared subtrees are shared Node
+objects.'''
+  if always is None:
+    always = (Operator('poly'), Operator('=='))
+  table = {}
+  pinned = set()
+  def intern(node):
+    if not isinstance(node, Node):
+      return node
+    if node.type is Operator('var'):
+      # Existing var nodes are recreated below.
+      res = intern(node.args[1])
+      if isinstance(res, Node):
+        pinned.add(id(res))
+      return res
+    args = tuple(intern(arg) for arg in node.args)
+    key = (node.type, tuple(('node', id(arg)) if isinstance(arg, Node)
+                            else (type(arg), arg) for arg in args))
+    if key not in table:
+      table[key] = Node(node.type, args)
+    return table[key]
+  dag = intern(root)
+
+  uses = collections.Counter()
+  seen = set()
+  def count(node):
+    if id(node) in seen:
+      return
+    seen.add(id(node))
+    for arg in node.args:
+      if isinstance(arg, Node):
+        uses[id(arg)] += 1
+        count(arg)
+  if isinstance(dag, Node):
+    count(dag)
+
+  for node in table.values():
+    if node.type is Operator('inv_logit') and isinstance(node.args[0], Node):
+      pinned.add(id(node.args[0]))
+
+  wrapped = {}
+  def wrap(node):
+    if not isinstance(node, Node):
+      return node
+    if id(node) in wrapped:
+      return wrapped[id(node)]
+    new = Node(node.type, tuple(wrap(arg) for arg in node.args))
+    if (node.type in always or
+        (uses[id(node)] > 1 and node.type not in (Operator('in'),
+                                                  Operator('list'))) or
+        (id(node) in pinned and node.type not in (Operator('in'),
+                                                  Operator('I'),
+                                                  Operator('list')))):
+      new = Node(Operator('var'), (hash(new), new))
+    wrapped[id(node)] = new
+    return new
+  return wrap(dag)
+
+def optimize(root, constants=None, always=None, absorb=False):
+  '''Fold constants, replace factor levels by lookup tables and
+eliminate common subexpressions.  The result is always a Node (a
+constant expression is returned as (I value)).  See fold() for absorb.'''
+  res = fold(root, constants, absorb)
+  if isinstance(res, Node):
+    res = factor_lookups(res)
+  res = cse(res, always)
+  if not isinstance(res, Node):
+    res = Node(Operator('I'), (res, ))
+  return res
+
 class Operator(object):
   operators = {}
   @classmethod
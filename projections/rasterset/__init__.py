@@ -1,21 +1,27 @@
 
 import click
-import concurrent.futures
+import contextlib
 from functools import reduce
 import math
-import multiprocessing
 import numpy as np
 import numpy.ma as ma
 import rasterio
 from tqdm import tqdm
 
-from .evalcontext import EvalContext
-from .raster import Raster
-from .rastercol import RasterCol
+from .cache import EvalCache
+from .evalcontext import EvalContext, window_shape
+from .evalplan import EvalPlan
+from .executor import BlockExecutor, BufferPool, EXECUTORS
+from .netcdf import NetCDFRaster
+from .raster import Raster, read_grouped
+from .rastercol import OutputSelector, RasterCol
+from . import reduction
+from . import zarrstore
 
 class RasterSet(object):
   def __init__(self, data=None, shapes=None, bbox=None, mask=None,
-               maskval=1.0, crop=True, all_touched=False):
+               maskval=1.0, crop=True, all_touched=False, cache=None,
+               fuse=False, compact=False, block_shape=None, mem_budget=None):
     self._mask = mask
     self._maskval = maskval
     self._shapes = shapes
@@ -25,23 +31,50 @@ class RasterSet(object):
     self._crop = crop
     self._all_touched = all_touched
     self._levels = []
+    self._plans = {}
+    self._fuse = fuse
+    self._compact = compact
+    self._block_shape = block_shape
+    self._mem_budget = mem_budget
+    if cache is True:
+      cache = EvalCache()
+    elif cache is False:
+      cache = None
+    self._cache = cache
     if data is None:
       self._data = {}
     elif isinstance(data, dict):
       self._data = {}
       for k, v in data.items():
-        self._data[k] = RasterCol(k, v, None, bbox)
+        self._add(k, v, None)
     else:
       raise RuntimeError('unknown data source')
 
+  def _add(self, key, value, mask):
+    '''Add a column.  When the source has a list of outputs (e.g.
+    lui.LUH2Multi) its eval() returns one row per output and each output
+    is also registered as a column that selects its row.  Returns the
+    names of the columns added.'''
+    self._data[key] = RasterCol(key, value, mask, self._bbox)
+    names = [key]
+    for idx, name in enumerate(getattr(value, 'outputs', ())):
+      self._data[name] = RasterCol(name, OutputSelector(key, idx), mask,
+                                   self._bbox)
+      names.append(name)
+    return names
+
   def __getitem__(self, key):
     if key in self._data:
       return self._data[key]
     raise KeyError(key)
 
   def __setitem__(self, key, value):
-    self._data[key] = RasterCol(key, value, self.mask, self.bbox)
+    names = self._add(key, value, self.mask)
     self._levels = []
+    self._plans = {}
+    if self._cache is not None:
+      for name in names:
+        self._cache.invalidate(name)
 
   def __contains__(self, key):
     return key in self._data
@@ -53,6 +86,53 @@ class RasterSet(object):
   def mask(self):
     return self._mask
 
+  @property
+  def fuse(self):
+    '''Whether chains of SimpleExpr columns are compiled into a single
+    kernel (see EvalPlan.fuse).'''
+    return self._fuse
+
+  @fuse.setter
+  def fuse(self, fuse):
+    self._fuse = fuse
+    self._plans = {}
+
+  @property
+  def compact(self):
+    '''Whether to evaluate with plain float32 vectors of the valid cells
+    and a single validity mask per window instead of masked arrays.'''
+    return self._compact
+
+  @compact.setter
+  def compact(self, compact):
+    self._compact = compact
+
+  @property
+  def block_shape(self):
+    '''Shape (rows, columns) of the blocks evaluated by write().  When
+    None (the default) the shape is chosen from the layout of the sources
+    and mem_budget (see EvalContext.auto_block_shape).'''
+    return self._block_shape
+
+  @block_shape.setter
+  def block_shape(self, block_shape):
+    self._block_shape = block_shape
+
+  @property
+  def mem_budget(self):
+    '''Approximate number of bytes used by the columns of one block when
+    picking the block shape automatically.'''
+    return self._mem_budget
+
+  @mem_budget.setter
+  def mem_budget(self, mem_budget):
+    self._mem_budget = mem_budget
+
+  @property
+  def cache(self):
+    '''The intermediate column cache (None when caching is disabled).'''
+    return self._cache
+
   @property
   def maskval(self):
     return self._maskval
@@ -88,35 +168,20 @@ class RasterSet(object):
     return self._levels
 
   def compute_order(self):
-    '''Compute a partial ordering of the rasters.  Checks for cycles in the
-    graph as it does the work.'''
+    '''Compute a partial ordering of all the rasters in the set.  Checks
+    for cycles in the graph as it does the work.  Evaluation only uses
+    the (much smaller) plan for the requested targets, see plan().'''
     if self._levels:
       return
-    order = {}
-    visiting = {}
-    def visit(col):
-      if col.name in order:
-        return
-      me = 0
-      if col.name in visiting and col.name not in order:
-        raise RuntimeError('circular dependency')
-      visiting[col.name] = True
-      for name in col.inputs:
-        if name not in order:
-          visit(self._data[name])
-        me = max(me, order[name] + 1)
-      del visiting[col.name]
-      order[col.name] = me
-    for col in self._data.values():
-      visit(col)
-
-    ordered = sorted(order.items(), key=lambda kv: (kv[1], kv[0]))
-    nlevels = ordered[-1][1]
-    self._levels = [[] for x in range(nlevels + 1)]
-    for k, v in ordered:
-      self._levels[v].append(k)
-    self._levels[0].sort(key=lambda a: -1 if isinstance(self._data[a].source,
-                                                        Raster) else 1)
+    self._levels = self.plan(tuple(self._data.keys())).levels
+
+  def plan(self, what):
+    '''Return the EvalPlan for one target or a list of targets.  Plans are
+    cached until a column is added or replaced.'''
+    key = (what, ) if isinstance(what, str) else tuple(sorted(what))
+    if key not in self._plans:
+      self._plans[key] = EvalPlan(self, key, self._fuse)
+    return self._plans[key]
 
   def to_dot(self):
     import pdb; pdb.set_trace()
@@ -137,25 +202,47 @@ class RasterSet(object):
       col.window = col.reader.window(*ctx.bounds)
 
   def find_needed(self, what):
-    def transitive(me):
-      ret = list(me.inputs)
-      for name in me.inputs:
-        if name in self:
-          ret += transitive(self[name])
-        else:
-          raise KeyError(name)
-      return ret
-
     if what not in self._data:
       raise KeyError(what)
-    return set(transitive(self[what]) + [what])
+    return self.plan(what).columns
+
+  @staticmethod
+  def drop_mask(invalid, shape, closures=None):
+    '''Return the mask of the cells of a window no target needs.  invalid
+    maps level 0 columns to their no-data masks and closures lists the
+    level 0 columns each target depends on (default: a single target
+    that depends on all of them).  A cell is dropped when it is masked
+    for every target.'''
+    if closures is None:
+      closures = [tuple(invalid.keys())]
+    namask = None
+    for closure in closures:
+      tmask = reduce(np.logical_or, [invalid[name] for name in closure
+                                     if name in invalid],
+                     np.zeros(shape, dtype=bool))
+      namask = tmask if namask is None else namask & tmask
+    return namask
 
-  def dropna(self, df):
-    namask = reduce(np.logical_or, map(ma.getmask, df.values()),
-                    np.zeros(tuple(df.values())[0].shape))
+  @staticmethod
+  def kept_masks(invalid, namask, masks):
+    '''Store in masks the (compressed) no-data masks of the columns that
+    are masked at some of the cells kept for another target.'''
+    valid = ~namask
+    for name, mask in invalid.items():
+      if mask is ma.nomask or mask is False:
+        continue
+      mask = mask[valid]
+      if mask.any():
+        masks[name] = mask
+
+  def dropna(self, df, closures=None, masks=None):
+    invalid = dict((key, ma.getmask(df[key])) for key in df.keys())
+    namask = self.drop_mask(invalid, tuple(df.values())[0].shape, closures)
+    if masks is not None:
+      self.kept_masks(invalid, namask, masks)
+    valid = ~namask
     for key in df.keys():
-      df[key].mask = namask
-      df[key] = df[key].compressed()
+      df[key] = ma.getdata(df[key])[valid]
     return namask
 
   def reflate(self, namask, data):
@@ -164,24 +251,90 @@ class RasterSet(object):
     arr[~namask] = data
     return arr
     
-  def _eval(self, ctx, window=None):
-    # Compute partial order in which to evaluate rasters
-    self.compute_order()
+  def _read_compact(self, ctx, level, df, window, closures=None,
+                    masks=None):
+    '''Read the rasters in level 0 as plain arrays, combine their masks
+    into a single validity mask and store only the valid cells in df.'''
+    rasters = [name for name in level if ctx.plan.column(name).is_raster]
+    arrays = {}
+    invalid = {}
+    for name in rasters:
+      arrays[name], invalid[name] = ctx.plan.column(name).source.read(window)
+    # Start from the window (not the first raster) so a level 0 with no
+    # rasters keeps every cell.
+    shape = ctx.shape if window is None else window_shape(window)
+    namask = self.drop_mask(invalid, shape, closures)
+    if masks is not None:
+      self.kept_masks(invalid, namask, masks)
+    valid = ~namask
+    for name in rasters:
+      df[name] = arrays.pop(name)[valid]
+    return namask
 
+  @staticmethod
+  def densify(data, size):
+    '''Convert the result of a column to a dense float32 vector.  Cells
+    masked by the column are set to NaN, and every non-finite cell of a
+    target is written as nodata (or masked by eval()).'''
+    if not isinstance(data, np.ndarray):
+      return np.full(size, data, dtype=np.float32)
+    if isinstance(data, ma.MaskedArray):
+      data = data.astype(np.float32, copy=False).filled(np.nan)
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2 and data.shape[1] == size:
+      # A multi-output column (one row per output).
+      return data
+    return data.reshape(-1)
+
+  def _eval_levels(self, ctx, window=None, closures=None, masks=None):
+    '''Evaluate the plan of ctx in window.  Returns the columns,
+    compressed to the cells that are not dropped, and the mask of the
+    dropped cells.  By default a cell is dropped when any level 0 column
+    is masked there.  closures (the level 0 columns each target depends
+    on) only drops the cells masked for every target; the no-data masks
+    of the level 0 columns at the kept cells are then stored in masks.'''
     df = {}
-    for idx, level in enumerate(self._levels):
+    namask = None
+    for idx, level in enumerate(ctx.plan.levels):
       if ctx.msgs:
         click.echo("Level %d" % idx)
-      for name in level:
-        if ctx.need(name):
-          if ctx.msgs:
-            click.echo("  eval %s" % name)
-          df[name] = self[name].eval(df, window)
       if idx == 0:
-        namask = self.dropna(df)
+        # One read per window for the rasters that share a file.
+        read_grouped([ctx.plan.column(name).source for name in level
+                      if ctx.plan.column(name).is_raster], window)
+      if idx == 0 and self._compact:
+        namask = self._read_compact(ctx, level, df, window, closures, masks)
+        size = np.count_nonzero(~namask)
+      for name in level:
+        if name in df:
+          continue
+        if ctx.msgs:
+          click.echo("  eval %s" % name)
+        col = ctx.plan.column(name)
+        # In compact mode every column sees dense vectors of the valid
+        # cells, so the window is meaningless past the rasters.
+        win = None if self._compact else window
+        if self._cache is None or idx == 0:
+          data = col.eval(df, win)
+        else:
+          key = ctx.cache_key(name, window)
+          data = self._cache.get(key, namask)
+          if data is None:
+            data = col.eval(df, win)
+            self._cache.put(key, namask, data, ctx.deps(name))
+        df[name] = self.densify(data, size) if self._compact else data
+      if idx == 0 and not self._compact:
+        namask = self.dropna(df, closures, masks)
+    return df, namask
+
+  def _eval(self, ctx, window=None):
+    df, namask = self._eval_levels(ctx, window)
     data = ma.empty_like(namask, dtype=np.float32)
     data.mask = namask
     data[~namask] = df[ctx.what]
+    if self._compact:
+      # Cells masked by a column are NaN (see densify()).
+      data = ma.masked_invalid(data, copy=False)
     if False:
       import pandas as pd
       dframe = pd.DataFrame(df)
@@ -223,47 +376,190 @@ class RasterSet(object):
     ctx = EvalContext(self, what)
     self.set_props(ctx)
     meta = ctx.meta(args)
-    iters = math.ceil(1.0 * ctx.height / ctx._block_shape[0])
+    iters = ctx.block_count
+    buffers = BufferPool(meta['nodata'])
     with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True, GDAL_CACHEMAX=256):
       with rasterio.open(path, 'w', **meta) as dst:
         with click.progressbar(ctx.block_windows(), iters) as bar:
           for win in bar:
-            height, width = (win[0][1] - win[0][0], win[1][1] - win[1][0])
-            out = self._eval(ctx, win)
-            dst.write(out.filled(meta['nodata']), window = win, indexes = 1)
+            out = self._eval_block(ctx, win, meta['nodata'], buffers)[what]
+            dst.write(out, window = win, indexes = 1)
+            buffers.put(out)
             ctx.msgs = False
 
 
-  def write(self, what, path, crop=True, args={}):
-    ctx = EvalContext(self, what)
+  def _eval_block(self, ctx, window, nodata, buffers=None):
+    '''Evaluate the targets in window into float32 blocks taken from
+    buffers (a BufferPool), where masked cells are nodata.  The valid
+    cells are scattered straight into the blocks, which go to the writer
+    as they are: no masked array is built and nothing is filled.'''
+    if buffers is None:
+      buffers = BufferPool(nodata)
+    # Each target is masked by its own sources only.
+    roots = dict((name, ctx.plan.roots(name)) for name in ctx.targets)
+    masks = {}
+    df, namask = self._eval_levels(ctx, window,
+                                   [roots[name] for name in ctx.targets],
+                                   masks)
+    valid = ~namask
+    outs = {}
+    for name in ctx.targets:
+      data = df[name]
+      if isinstance(data, ma.MaskedArray):
+        # Cells masked by the target itself, e.g. log() of a negative.
+        # Only copies when the target has a mask.
+        data = data.filled(nodata)
+      elif self._compact:
+        # In compact mode those cells are NaN (see densify()).
+        invalid = ~np.isfinite(data)
+        if invalid.any():
+          data = np.where(invalid, np.float32(nodata), data)
+      tmasks = [masks[root] for root in roots[name] if root in masks]
+      if tmasks:
+        # Cells kept for another target but masked for this one.
+        data = np.where(reduce(np.logical_or, tmasks), np.float32(nodata),
+                        data)
+      outs[name] = buffers.get(namask.shape)
+      outs[name][valid] = data
+    return outs
+
+  def write(self, what, path, crop=True, args={}, executor='threads',
+            num_workers=None, max_inflight=None, skip_empty=True, time=None):
+    return self.write_many({what: path}, crop, args, executor, num_workers,
+                           max_inflight, skip_empty, time)
+
+  @staticmethod
+  def is_sparse(meta):
+    '''Whether blocks that are never written read back as nodata, i.e. the
+    output is a sparse GeoTIFF or a COG.'''
+    if meta.get('driver', '').upper() == 'COG':
+      return True
+    return str(meta.get('sparse_ok', '')).upper() in ('TRUE', 'YES', 'ON', '1')
+
+  def write_many(self, outputs, crop=True, args={}, executor='threads',
+                 num_workers=None, max_inflight=None, skip_empty=True,
+                 time=None):
+    '''Evaluate several targets in a single pass over the blocks.  outputs
+is a dictionary that maps each target to the path of the GeoTIFF to
+write.  Sources and intermediate columns are read / evaluated once per
+block and shared by all targets.
+
+A path ending in .zarr names a zarr store instead: the target is written
+as time step time of the (time, y, x) array named after the target (see
+zarrstore.ZarrSlice).  Writing every year of a projection to the same
+store builds the time series in a single array.
+
+executor selects how blocks are evaluated (see executor.EXECUTORS).
+Results are always written by the calling thread, in the order they
+complete.  max_inflight caps the number of jobs submitted but not yet
+written (default: twice the number of workers).
+
+When skip_empty is set, blocks where every cell is masked (by the mask
+of the set or the mask of the first source) are never evaluated.  They
+are written as nodata, or not written at all when the output is sparse
+(see is_sparse()).  Returns the scheduling statistics, including the
+number of skipped blocks and the peak memory used (the peak resident set
+size of this process or of the largest worker process, see
+executor.peak_rss()).'''
+    names = sorted(outputs.keys())
+    ctx = EvalContext(self, names)
     self.set_props(ctx)
     meta = ctx.meta(args)
+    if time is None and any(zarrstore.is_zarr(outputs[name])
+                            for name in names):
+      raise ValueError('writing to a zarr store needs a time step')
     # by default ThreadPoolExecutor uses num_cpus() * 5 but that's too
     # high for this problem because threads start competing for the GIL.
-    # Increasing the clock size helps, at the cost of higher memory
-    # utilization.
-    num_workers = multiprocessing.cpu_count()
+    # Use the process executor to scale past a handful of cores.
     ctx.msgs = False
 
-    def jobs():
-      for win in ctx.block_windows():
-        yield win
+    bar = tqdm(leave=True, total=ctx.block_count, desc=', '.join(names))
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True, GDAL_CACHEMAX=256):
+      with contextlib.ExitStack() as stack:
+        def open_output(name):
+          if zarrstore.is_zarr(outputs[name]):
+            return zarrstore.ZarrSlice(outputs[name], name, meta, time,
+                                       ctx._block_shape)
+          return rasterio.open(outputs[name], 'w', **meta)
 
-    def compute(win):
-      return self._eval(ctx, win)
+        dsts = dict((name, stack.enter_context(open_output(name)))
+                    for name in names)
+        # Time steps appended to a zarr array read back as nodata.
+        sparse = all(dsts[name].fresh
+                     if isinstance(dsts[name], zarrstore.ZarrSlice)
+                     else self.is_sparse(meta) for name in names)
 
-    bar = tqdm(leave=True, total=ctx.height, desc=what)
-    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True, GDAL_CACHEMAX=256):
-      with rasterio.open(path, 'w', **meta) as dst:
-        with concurrent.futures.ThreadPoolExecutor(
-            max_workers=num_workers) as executor:
-          future_to_window = {
-            executor.submit(compute, win): win for win in jobs()
-          }
-          for future in concurrent.futures.as_completed(future_to_window):
-            win = future_to_window[future]
-            rows = win[0][1] - win[0][0]
-            bar.update(rows)
-            out = future.result()
-            dst.write(out.filled(meta['nodata']), window = win, indexes = 1)
+        def store(win, outs):
+          bar.update(1)
+          for name in names:
+            dsts[name].write(outs[name], window = win, indexes = 1)
+
+        def skip(win):
+          if sparse:
+            bar.update(1)
+            return
+          empty = np.full(window_shape(win), meta['nodata'], dtype=np.float32)
+          store(win, dict((name, empty) for name in names))
+
+        with BlockExecutor(executor, self, ctx, meta['nodata'],
+                           num_workers) as pool:
+          stats = pool.run(ctx.block_windows(skip_empty, skip), store,
+                           max_inflight)
+    bar.close()
+    stats['skipped'] = ctx.skipped
+    click.echo('%d blocks (%d empty blocks skipped), at most %d jobs in '
+               'flight, peak RSS %.1f MB' %
+               (stats['blocks'], stats['skipped'], stats['peak_inflight'],
+                stats['peak_rss'] / (1024.0 * 1024)))
+    return stats
+
+  def _reduce_block(self, ctx, window, what, zones, weights, bins):
+    df, namask = self._eval_levels(ctx, window)
+    size = np.count_nonzero(~namask)
+    def vector(name):
+      return None if name is None else self.densify(df[name], size)
+    return reduction.partial(vector(what), vector(zones), vector(weights),
+                             bins)
+
+  def reduce(self, what, zones=None, weights=None, ops=('sum', 'mean', 'count'),
+             bins=None, executor='threads', num_workers=None,
+             max_inflight=None):
+    '''Aggregate a target per zone without writing it out.  zones and
+weights name columns of the set: zones holds integer zone ids (e.g.
+country codes) and weights the weight of each cell (e.g. its area).
+ops is a list of reductions from reduction.REDUCE_OPS:
+
+  sum    weighted sum of the target
+  mean   weighted mean of the target
+  count  number of valid cells
+  hist   weighted histogram with the given bin edges (one column per
+         bin, hist_0, hist_1, ...)
+
+Cells where the target, the zone or the weight is nodata are ignored.
+Blocks are evaluated with the executor (see write_many()), reduced to
+per-zone partial aggregates in the workers and combined by the calling
+thread, so the full target raster is never materialised.  Returns a
+pandas DataFrame indexed by zone (a single zone 0 when zones is None).'''
+    reduction.check_ops(ops, bins)
+    if bins is not None:
+      bins = np.asarray(bins, dtype=np.float64)
+    names = [name for name in (what, zones, weights) if name is not None]
+    ctx = EvalContext(self, sorted(set(names)))
+    self.set_props(ctx)
+    ctx.msgs = False
+
+    def evaluate(ctx, win):
+      return self._reduce_block(ctx, win, what, zones, weights, bins)
+
+    totals = [None]
+    bar = tqdm(leave=True, total=ctx.block_count, desc=what)
+    def combine(win, part):
+      bar.update(1)
+      totals[0] = reduction.combine(totals[0], part)
+
+    with rasterio.Env(GDAL_CACHEMAX=256):
+      with BlockExecutor(executor, self, ctx, ctx._nodata, num_workers,
+                         evaluate=evaluate) as pool:
+        pool.run(ctx.block_windows(True), combine, max_inflight)
     bar.close()
+    return reduction.finish(totals[0], ops, bins)
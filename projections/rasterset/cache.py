@@ -0,0 +1,179 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import numpy.ma as ma
+
+def nbytes(arr):
+  size = arr.nbytes
+  if isinstance(arr, ma.MaskedArray) and arr.mask is not ma.nomask:
+    size += arr.mask.nbytes
+  return size
+
+class EvalCache(object):
+  '''LRU cache of intermediate columns shared by all evaluations of a
+RasterSet.
+
+Entries are keyed by (column name, bounds, window, source stamps), where
+the stamps record the file name and modification time of every raster
+the column depends on.  Each entry stores the compressed data together
+with the no-data mask of the window it was computed for.  A cached
+column can be reused by an evaluation with the same or a larger no-data
+mask, i.e. when every cell that is valid now was valid when the column
+was computed.
+
+When the cache grows above max_bytes the least recently used entries
+are evicted.  If spill_dir is given, evicted entries are saved to that
+directory and memory-mapped back on the next hit instead of being
+dropped.
+
+  '''
+  def __init__(self, max_bytes=512 * 1024 * 1024, spill_dir=None):
+    self._max_bytes = max_bytes
+    self._spill_dir = None
+    if spill_dir is not None:
+      if not os.path.isdir(spill_dir):
+        os.makedirs(spill_dir)
+      self._spill_dir = tempfile.mkdtemp(prefix='evalcache-', dir=spill_dir)
+    self._lock = threading.RLock()
+    self._entries = collections.OrderedDict()
+    self._spilled = {}
+    self._bytes = 0
+    self._stats = collections.Counter()
+
+  @property
+  def max_bytes(self):
+    return self._max_bytes
+
+  @property
+  def nbytes(self):
+    return self._bytes
+
+  @property
+  def stats(self):
+    '''Return a dictionary with hit, miss, eviction and spill counts.'''
+    with self._lock:
+      stats = dict((k, self._stats[k]) for k in ('hits', 'misses', 'evictions',
+                                                 'spills', 'spill_hits',
+                                                 'rejects'))
+      stats['entries'] = len(self._entries)
+      stats['spilled'] = len(self._spilled)
+      stats['bytes'] = self._bytes
+      lookups = stats['hits'] + stats['misses']
+      stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+    return stats
+
+  def __len__(self):
+    return len(self._entries) + len(self._spilled)
+
+  @staticmethod
+  def _reuse(old_mask, data, new_mask):
+    if old_mask is new_mask or np.array_equal(old_mask, new_mask):
+      return data
+    if np.any(old_mask & ~new_mask):
+      # Some cells valid now were not computed.
+      return None
+    # Multi-output columns have one row per output.
+    full = np.empty(data.shape[:-1] + old_mask.shape, dtype=data.dtype)
+    full[..., ~old_mask] = ma.getdata(data)
+    res = full[..., ~new_mask]
+    if ma.getmask(data) is ma.nomask:
+      return res
+    # Cells masked by the column itself (e.g. log() of a negative) stay
+    # masked.
+    mask = np.zeros(full.shape, dtype=bool)
+    mask[..., ~old_mask] = ma.getmask(data)
+    return ma.masked_array(res, mask=mask[..., ~new_mask])
+
+  def get(self, key, namask):
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        old_mask, data, _, _ = self._entries[key]
+        spilled = False
+      elif key in self._spilled:
+        mpath, dpath, cpath, _ = self._spilled[key]
+        old_mask = np.load(mpath, mmap_mode='r')
+        data = np.load(dpath, mmap_mode='r')
+        if cpath is not None:
+          data = ma.masked_array(data, mask=np.load(cpath))
+        spilled = True
+      else:
+        self._stats['misses'] += 1
+        return None
+      res = self._reuse(np.asarray(old_mask), data, namask)
+      if res is None:
+        self._stats['misses'] += 1
+        return None
+      self._stats['hits'] += 1
+      if spilled:
+        self._stats['spill_hits'] += 1
+      return res
+
+  def put(self, key, namask, data, deps=()):
+    size = namask.nbytes + nbytes(data)
+    if size > self._max_bytes:
+      with self._lock:
+        self._stats['rejects'] += 1
+      return
+    with self._lock:
+      self._discard(key)
+      self._entries[key] = (namask, data, size, frozenset(deps))
+      self._bytes += size
+      while self._bytes > self._max_bytes:
+        self._evict()
+
+  def _evict(self):
+    key, (namask, data, size, deps) = self._entries.popitem(last=False)
+    self._bytes -= size
+    self._stats['evictions'] += 1
+    if self._spill_dir is None:
+      return
+    fd, base = tempfile.mkstemp(dir=self._spill_dir)
+    os.close(fd)
+    os.remove(base)
+    mpath = base + '-mask.npy'
+    dpath = base + '-data.npy'
+    cpath = None
+    np.save(mpath, namask)
+    if ma.getmask(data) is not ma.nomask:
+      # The mask of the column itself.
+      cpath = base + '-cmask.npy'
+      np.save(cpath, ma.getmaskarray(data))
+    np.save(dpath, ma.getdata(data))
+    self._spilled[key] = (mpath, dpath, cpath, deps)
+    self._stats['spills'] += 1
+
+  def _discard(self, key):
+    if key in self._entries:
+      self._bytes -= self._entries.pop(key)[2]
+    if key in self._spilled:
+      mpath, dpath, cpath, _ = self._spilled.pop(key)
+      for path in (mpath, dpath, cpath):
+        if path is not None and os.path.exists(path):
+          os.remove(path)
+
+  def invalidate(self, name):
+    '''Drop all entries for column name and every column that depends
+on it.'''
+    with self._lock:
+      keys = [k for k, v in self._entries.items()
+              if k[0] == name or name in v[3]]
+      keys += [k for k, v in self._spilled.items()
+               if k[0] == name or name in v[3]]
+      for key in keys:
+        self._discard(key)
+
+  def clear(self):
+    with self._lock:
+      for key in tuple(self._entries.keys()) + tuple(self._spilled.keys()):
+        self._discard(key)
+
+  def close(self):
+    self.clear()
+    if self._spill_dir is not None:
+      shutil.rmtree(self._spill_dir, ignore_errors=True)
+      self._spill_dir = None
@@ -5,6 +5,14 @@ import numpy.ma as ma
 import rasterio
 import rasterio.features
 
+from .raster import window_inset
+
+## Default memory budget for the intermediate columns of one block
+## (see EvalContext.auto_block_shape()).
+DEFAULT_BLOCK_BUDGET = 64 * 1024 * 1024
+## Blocks are never smaller than this (number of cells).
+MIN_BLOCK_CELLS = 64 * 1024
+
 def window_shape(win):
   return (win[0][1] - win[0][0], win[1][1] - win[1][0])
 
@@ -12,16 +20,24 @@ class EvalContext(object):
   def __init__(self, rasterset, what, crop=True):
     self._rasterset = rasterset
     self._what = what
+    if isinstance(what, str):
+      self._targets = (what, )
+    else:
+      self._targets = tuple(what)
     self._crop = crop
     self._msgs = True
     self._mask = None
     self._bounds = None
     self._affine = None
     self._nodata = -9999
-    self._needed = sorted(rasterset.find_needed(what),
-                          key=lambda x: x.lower())
-    self._sources = [rasterset[x].source for x in
-                     filter(lambda c: rasterset[c].is_raster, self._needed)]
+    # Only the columns (and rasters) reachable from the targets are
+    # visited.
+    self._plan = rasterset.plan(self._targets)
+    self._needed = sorted(self._plan.columns, key=lambda x: x.lower())
+    self._sources = list(self._plan.sources)
+    self._deps = {}
+    self._stamps = {}
+    self._skipped = 0
 
     # Check all rasters have the same resolution.
     # TODO:: scale rasters appropriatelly
@@ -58,8 +74,15 @@ class EvalContext(object):
     if self.mask is not None:
       assert self.shape == self.mask.shape
     
-    # Compute minimal block shape that covers all block shapes
-    self._block_shape = self.block_shape(self.sources)
+    # Use the block shape requested by the user or pick one from the
+    # layout of the sources and the memory budget.
+    if rasterset.block_shape:
+      self._block_shape = (min(rasterset.block_shape[0], self.height),
+                           min(rasterset.block_shape[1], self.width))
+    else:
+      self._block_shape = self.auto_block_shape(self.sources, self.shape,
+                                                len(self._plan.evaluated),
+                                                rasterset.mem_budget)
 
   @staticmethod
   def check_rasters(columns):
@@ -163,18 +186,111 @@ class EvalContext(object):
     block_shape = (max(ys), max(xs))
     blocks = set(block_shapes)
     return block_shape
+
+  @staticmethod
+  def auto_block_shape(sources, shape, ncols, budget=None):
+    '''Pick the shape of the blocks to evaluate.
+
+Starts from the minimal shape that covers the block (chunk) shape of
+every source and grows it in multiples of that shape, first along rows
+and then along columns, until a block holds about budget bytes of
+intermediate columns.  ncols is the number of columns evaluated per
+block; each costs a float32 value and a mask byte per cell, plus as much
+again in temporaries.  Blocks that cover the minimal shape but would
+not fit the budget (e.g. NetCDF variables stored as a single chunk) are
+cut down to fit.  Small blocks are never generated, even with a tight
+budget, since the per-block overhead dominates below MIN_BLOCK_CELLS.'''
+    if budget is None:
+      budget = DEFAULT_BLOCK_BUDGET
+    height, width = shape
+    ys, xs = EvalContext.block_shape(sources)
+    ys, xs = min(ys, height), min(xs, width)
+    per_cell = 2 * max(ncols, 1) * (np.dtype(np.float32).itemsize + 1)
+    cells = max(budget // per_cell, MIN_BLOCK_CELLS)
+
+    if ys * xs > cells:
+      # Source chunks are too big: cut rows first, then columns.
+      ys = max(1, min(ys, cells // xs))
+      xs = max(1, min(xs, cells // ys))
+      return (ys, xs)
+    # Widen in multiples of the source blocks.  Full rows are cheap to
+    # read from both strips and tiles.
+    xs = min(width, xs * max(1, cells // (ys * xs)))
+    ys = min(height, ys * max(1, cells // (ys * xs)))
+    return (ys, xs)
   
-  def block_windows(self):
+  @property
+  def block_count(self):
+    '''Number of windows generated by block_windows() (including the
+    empty ones).'''
+    y_inc, x_inc = self._block_shape
+    return (math.ceil(1.0 * self.height / y_inc) *
+            math.ceil(1.0 * self.width / x_inc))
+
+  def block_windows(self, skip_empty=False, on_skip=None):
+    '''Generate the windows to evaluate.  When skip_empty is set windows
+    where every cell is masked are not generated; on_skip (if given) is
+    called for each of them instead.'''
     y_inc, x_inc = self._block_shape
     for j in range(0, self.height, y_inc):
       j2 = min(j + y_inc, self.height)
       for i in range(0, self.width, x_inc):
         i2 = min(i + x_inc, self.width)
-        yield ((j, j2), (i, i2))
+        win = ((j, j2), (i, i2))
+        if skip_empty and self.empty(win):
+          self._skipped += 1
+          if on_skip:
+            on_skip(win)
+          continue
+        yield win
+
+  def empty(self, win):
+    '''Return True if every cell in the window is masked, either by the
+    mask of the raster set or, for every target, by the nodata / internal
+    mask of the first raster the target depends on.  Reading the mask of
+    one source per target is much cheaper than evaluating the window.
+    Targets that do not depend on any raster are never empty.'''
+    if self.mask is not None:
+      if self.mask[win[0][0]:win[0][1], win[1][0]:win[1][1]].all():
+        return True
+    empty = {}
+    for target in self._targets:
+      rasters = [name for name in self._plan.roots(target)
+                 if self._plan.column(name).is_raster]
+      if not rasters:
+        return False
+      if rasters[0] not in empty:
+        src = self._plan.column(rasters[0]).source
+        masks = src.reader.read_masks(src.band,
+                                      window=window_inset(src.window, win))
+        empty[rasters[0]] = not masks.any()
+      if not empty[rasters[0]]:
+        return False
+    return True
+
+  @property
+  def skipped(self):
+    '''Number of empty windows skipped by block_windows().'''
+    return self._skipped
 
   def need(self, what):
     return what in self._needed
 
+  def deps(self, name):
+    '''Return the set of columns name depends on.'''
+    if name not in self._deps:
+      self._deps[name] = self._rasterset.find_needed(name) - set([name])
+    return self._deps[name]
+
+  def cache_key(self, name, window):
+    '''Return the key used to cache column name for window.'''
+    if name not in self._stamps:
+      rs = self._rasterset
+      self._stamps[name] = tuple(sorted(rs[dep].source.stamp
+                                        for dep in self.deps(name)
+                                        if rs[dep].is_raster))
+    return (name, self.bounds, window, self._stamps[name])
+
   def meta(self, args={}):
     meta = self.sources[0].reader.meta.copy()
     meta.update({'driver': 'GTiff', 'compress': 'lzw', 'predictor': 2,
@@ -186,6 +302,10 @@ class EvalContext(object):
                  'dtype': np.float32})
     return meta
   
+  @property
+  def plan(self):
+    return self._plan
+
   @property
   def sources(self):
     return self._sources
@@ -234,6 +354,10 @@ class EvalContext(object):
   def what(self):
     return self._what
 
+  @property
+  def targets(self):
+    return self._targets
+
   @property
   def msgs(self):
     return self._msgs
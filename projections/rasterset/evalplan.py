@@ -0,0 +1,223 @@
+from ..r2py import reval
+from ..r2py import tree
+from ..r2py.tree import Node, Operator
+from ..simpleexpr import FusedExpr, SimpleExpr
+from .rastercol import RasterCol
+
+class EvalPlan(object):
+  '''Evaluation plan for one or more targets of a RasterSet.
+
+Only the transitive closure of the targets is visited, so building a
+plan (and opening the rasters it needs) costs time proportional to the
+targets rather than to the size of the set.  Columns are grouped in
+levels: every column only depends on columns in earlier levels.  Level
+0 holds the columns without inputs, rasters first.
+
+  '''
+  def __init__(self, rasterset, targets, fuse=False):
+    if isinstance(targets, str):
+      targets = (targets, )
+    self._targets = tuple(targets)
+    cols = {}
+    visiting = set()
+
+    def visit(name):
+      if name in cols:
+        return
+      if name in visiting:
+        raise RuntimeError('circular dependency')
+      if name not in rasterset:
+        raise KeyError(name)
+      visiting.add(name)
+      for dep in rasterset[name].inputs:
+        visit(dep)
+      visiting.discard(name)
+      cols[name] = rasterset[name]
+
+    for target in self._targets:
+      visit(target)
+    self._closure = set(cols.keys())
+    self._fused = {}
+    if fuse:
+      self._fused = self.fuse(cols, self._targets)
+
+    order = {}
+    def level(name):
+      if name not in order:
+        order[name] = max([level(dep) + 1 for dep in cols[name].inputs] +
+                          [0])
+      return order[name]
+    for name in cols:
+      level(name)
+
+    nlevels = max(order.values()) + 1 if order else 0
+    levels = [[] for x in range(nlevels)]
+    for name, idx in sorted(order.items(), key=lambda kv: (kv[1], kv[0])):
+      levels[idx].append(name)
+    self._levels = [level for level in levels if level]
+    if self._levels:
+      self._levels[0].sort(key=lambda a: -1 if cols[a].is_raster else 1)
+    self._columns = cols
+    self._inputs = dict((name, tuple(sorted(cols[name].inputs)))
+                        for name in cols)
+    self._rasters = tuple(name for name in sorted(cols, key=str.lower)
+                          if cols[name].is_raster)
+    self._sources = tuple(cols[name].source for name in self._rasters)
+    self._roots = {}
+
+  @staticmethod
+  def fuse(cols, targets):
+    '''Inline chains of pointwise SimpleExpr columns into their consumers.
+A SimpleExpr is inlined when it is not a target and all the columns that
+use it are pointwise SimpleExprs themselves.  Columns with a constant
+value (e.g. timber = '0') are folded into the pointwise consumers, which
+drops the terms they zero out.  Consumers that absorbed at least one
+column are replaced by a FusedExpr, which compiles the combined (and
+re-optimised, see tree.optimize) expression into a single kernel.
+Modifies cols in place and returns a dictionary that maps each consumer
+to the columns inlined into it.'''
+    def fusable(name):
+      obj = cols[name].source
+      return (isinstance(obj, SimpleExpr) and cols[name].inputs and
+              reval.is_pointwise(obj.tree))
+
+    constants = {}
+    for name, col in cols.items():
+      if isinstance(col.source, SimpleExpr) and not col.inputs:
+        value = tree.fold(col.source.tree)
+        if tree.is_const(value):
+          constants[name] = value
+
+    consumers = dict((name, set()) for name in cols)
+    for name, col in cols.items():
+      for dep in col.inputs:
+        consumers[dep].add(name)
+    inline = set(name for name in cols
+                 if name not in targets and fusable(name) and
+                 consumers[name] and all(map(fusable, consumers[name])))
+    if not inline and not constants:
+      return {}
+
+    def expand(root, absorbed):
+      def replace(node):
+        if isinstance(node, Node) and node.type is Operator('in'):
+          if node.args[0] in inline:
+            absorbed.add(node.args[0])
+            return expand(tree.clone(cols[node.args[0]].source.tree),
+                          absorbed)
+          raise StopIteration
+        return node
+      return root.transform(replace)
+
+    fused = {}
+    for name in tuple(cols.keys()):
+      if name in inline or not fusable(name):
+        continue
+      absorbed = set()
+      root = expand(tree.clone(cols[name].source.tree), absorbed)
+      used = set(reval.find_inputs(root)) & set(constants)
+      if not absorbed and not used:
+        continue
+      folded = tree.optimize(root, constants, absorb=True)
+      if reval.find_inputs(folded):
+        root = folded
+        absorbed |= used
+      if absorbed:
+        cols[name] = RasterCol(name, FusedExpr(name, root), None, None)
+        fused[name] = absorbed
+    for name in inline:
+      del cols[name]
+    # Constants folded into all their consumers are not needed anymore.
+    needed = set(dep for col in cols.values() for dep in col.inputs)
+    for name in constants:
+      if name not in targets and name not in needed:
+        del cols[name]
+    return fused
+
+  @property
+  def targets(self):
+    return self._targets
+
+  @property
+  def levels(self):
+    return self._levels
+
+  @property
+  def columns(self):
+    '''Set of columns the targets depend on (including the targets).'''
+    return set(self._closure)
+
+  @property
+  def evaluated(self):
+    '''Set of columns evaluated by the plan.  Differs from columns when
+chains of expressions have been fused.'''
+    return set(self._columns.keys())
+
+  @property
+  def fused(self):
+    '''Dictionary mapping each fused column to the columns inlined into
+it.'''
+    return self._fused
+
+  def column(self, name):
+    return self._columns[name]
+
+  @property
+  def rasters(self):
+    '''Names of the raster columns read by the plan.'''
+    return self._rasters
+
+  @property
+  def sources(self):
+    '''Raster objects read by the plan.'''
+    return self._sources
+
+  def inputs(self, name):
+    return self._inputs[name]
+
+  def roots(self, name):
+    '''Return the level 0 columns (rasters and columns without inputs)
+column name depends on, or name itself if it is one.'''
+    if name not in self._roots:
+      if self._inputs[name]:
+        self._roots[name] = tuple(sorted(set(root
+                                             for dep in self._inputs[name]
+                                             for root in self.roots(dep))))
+      else:
+        self._roots[name] = (name, )
+    return self._roots[name]
+
+  def __contains__(self, name):
+    return name in self._columns
+
+  def __len__(self):
+    return len(self._columns)
+
+  def __repr__(self):
+    lines = ['EvalPlan(%s): %d columns, %d rasters, %d levels' %
+             (', '.join(self._targets), len(self), len(self._rasters),
+              len(self._levels))]
+    for idx, level in enumerate(self._levels):
+      lines.append('  level %d:' % idx)
+      for name in level:
+        deps = self._inputs[name]
+        if name in self._fused:
+          lines.append('    %s <- %s (fused %s)' %
+                       (name, ', '.join(deps),
+                        ', '.join(sorted(self._fused[name]))))
+        elif deps:
+          lines.append('    %s <- %s' % (name, ', '.join(deps)))
+        else:
+          lines.append('    %s' % name)
+    return '\n'.join(lines)
+
+  def to_dot(self):
+    lines = ['digraph "%s" {' % ', '.join(self._targets),
+             'node [fontname="Palatino", fontsize=24];']
+    for level in self._levels:
+      for name in level:
+        lines.append('"%s" [];' % name)
+        for dep in self._inputs[name]:
+          lines.append('"%s" -> "%s";' % (dep, name))
+    lines.append('}')
+    return '\n'.join(lines)
@@ -0,0 +1,336 @@
+import concurrent.futures
+import itertools
+import multiprocessing
+import resource
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+EXECUTORS = ('threads', 'processes', 'serial')
+
+class SerialExecutor(object):
+  '''Executor that runs every job in the calling thread as soon as it is
+submitted.  Mostly useful for debugging and profiling.'''
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+    return False
+
+  def submit(self, fn, *args, **kwargs):
+    future = concurrent.futures.Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  def shutdown(self, wait=True):
+    pass
+
+class BufferPool(object):
+  '''Recycles the float32 blocks the targets are evaluated into.  get()
+returns a block filled with nodata, either new or one given back with
+put(), so writing a window allocates nothing once the pool has warmed up
+(the pool holds at most as many blocks of each shape as were in flight
+at the same time).  Safe to share between threads.'''
+  def __init__(self, nodata):
+    self._nodata = nodata
+    self._free = {}
+    self._lock = threading.Lock()
+    self._allocated = 0
+
+  @property
+  def allocated(self):
+    '''Number of blocks allocated so far.'''
+    return self._allocated
+
+  def get(self, shape):
+    shape = tuple(shape)
+    with self._lock:
+      free = self._free.get(shape)
+      if not free:
+        self._allocated += 1
+        return np.full(shape, self._nodata, dtype=np.float32)
+      buf = free.pop()
+    buf.fill(self._nodata)
+    return buf
+
+  def put(self, buf):
+    with self._lock:
+      self._free.setdefault(buf.shape, []).append(buf)
+
+## State of a worker process.  Set by _init_worker() when the process
+## starts.  Since the pool uses the fork start method the raster set and
+## the evaluation context are inherited and never pickled.
+_STATE = {}
+
+def _init_worker(rasterset, ctx, nodata, evaluate=None):
+  _STATE['rasterset'] = rasterset
+  _STATE['ctx'] = ctx
+  _STATE['nodata'] = nodata
+  _STATE['evaluate'] = evaluate
+  _STATE['buffers'] = BufferPool(nodata)
+  # Never share GDAL handles with the parent process.
+  for src in ctx.sources:
+    src.reset_reader()
+
+def share(arr):
+  '''Copy an array into a new shared memory segment and return a
+descriptor that can be sent to another process.'''
+  shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+  buf = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+  buf[:] = arr
+  desc = (shm.name, arr.shape, arr.dtype.str)
+  del buf
+  shm.close()
+  # The segment is owned (and unlinked) by the process that attaches to
+  # it; stop the resource tracker from removing it behind our back.
+  resource_tracker.unregister(shm._name, 'shared_memory')
+  return desc
+
+def attach(desc):
+  name, shape, dtype = desc
+  shm = shared_memory.SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def release(desc):
+  '''Unlink the shared memory segment of a descriptor returned by share()
+that will never be consumed.'''
+  try:
+    shm = shared_memory.SharedMemory(name=desc[0])
+  except FileNotFoundError:
+    return
+  shm.close()
+  shm.unlink()
+
+def release_results(results):
+  '''Unlink the segments of all the blocks of a batch.'''
+  for win, outs in results:
+    for desc in outs.values():
+      release(desc)
+
+def _eval_batch(wins):
+  rasterset = _STATE['rasterset']
+  ctx = _STATE['ctx']
+  results = []
+  if _STATE['evaluate'] is not None:
+    # Custom results are small; send them back pickled.
+    return [(win, _STATE['evaluate'](ctx, win)) for win in wins]
+  try:
+    for win in wins:
+      outs = rasterset._eval_block(ctx, win, _STATE['nodata'],
+                                   _STATE['buffers'])
+      results.append((win, {}))
+      for name, arr in outs.items():
+        results[-1][1][name] = share(arr)
+      for arr in outs.values():
+        _STATE['buffers'].put(arr)
+  except BaseException:
+    # The parent never sees the blocks of a failed batch.
+    release_results(results)
+    raise
+  return results
+
+def peak_rss():
+  '''Return the largest of the peak resident set size (in bytes) of this
+process and of its largest child process that has been waited for.
+Both are peaks over the lifetime of the processes: the peak of this
+process may predate the current run, and a child only counts once it
+has exited and been reaped.'''
+  # ru_maxrss is reported in kilobytes on Linux but bytes on macOS.
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def batches(windows, size):
+  it = iter(windows)
+  while True:
+    batch = tuple(itertools.islice(it, size))
+    if not batch:
+      return
+    yield batch
+
+class BlockExecutor(object):
+  '''Evaluate blocks of a raster set with one of the backends in
+EXECUTORS.
+
+  threads    a thread pool; cheap to start but workers compete for
+             the GIL in the numpy.ma heavy parts of the evaluation.
+  processes  a pool of forked processes.  Each worker reopens its
+             readers, evaluates a batch of windows and returns the
+             blocks through shared memory.
+  serial     evaluate everything in the calling thread.
+
+Each job is a batch of windows and its result a list of (window,
+{name: block}) tuples.  Pass evaluate (a callable taking the context
+and a window) to compute something other than the blocks of the
+targets, e.g. per-block partial aggregates; its results are returned
+as they are.  Use run() to schedule all the windows of a
+context, or submit() and consume() to drive the executor by hand;
+blocks go back to the buffer pool (see BufferPool), and shared memory is
+released, as soon as each block has been consumed.  The shared memory of
+jobs that are never consumed is released when the executor shuts down.
+
+  '''
+  def __init__(self, kind, rasterset, ctx, nodata, num_workers=None,
+               batch=None, evaluate=None):
+    if kind not in EXECUTORS:
+      raise ValueError("unknown executor '%s' (expected one of %s)" %
+                       (kind, ', '.join(EXECUTORS)))
+    self._kind = kind
+    self._rasterset = rasterset
+    self._ctx = ctx
+    self._nodata = nodata
+    self._num_workers = num_workers or multiprocessing.cpu_count()
+    if batch is None:
+      batch = 4 if kind == 'processes' else 1
+    self._batch = batch
+    self._evaluate = evaluate
+    self._buffers = BufferPool(nodata)
+    self._pool = None
+    self._stats = []
+    self._pending = set()
+
+  @property
+  def kind(self):
+    return self._kind
+
+  @property
+  def num_workers(self):
+    return 1 if self._kind == 'serial' else self._num_workers
+
+  @property
+  def batch(self):
+    return self._batch
+
+  @property
+  def buffers(self):
+    return self._buffers
+
+  def __enter__(self):
+    if self._kind == 'serial':
+      self._pool = SerialExecutor()
+    elif self._kind == 'threads':
+      self._pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=self._num_workers)
+    else:
+      try:
+        mp_ctx = multiprocessing.get_context('fork')
+      except ValueError:
+        raise RuntimeError('process executor requires the fork start method')
+      self._pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=self._num_workers, mp_context=mp_ctx,
+        initializer=_init_worker,
+        initargs=(self._rasterset, self._ctx, self._nodata,
+                  self._evaluate))
+    return self
+
+  def __exit__(self, *args):
+    self._pool.shutdown(wait=True)
+    self._pool = None
+    # Jobs submitted but never consumed (e.g. fn raised in run()) still
+    # hold shared memory.
+    for future in self._pending:
+      if self._shared and not future.cancelled() and \
+         future.exception() is None:
+        release_results(future.result())
+    self._pending = set()
+    # Only now have the worker processes been reaped, so that their peak
+    # shows up in RUSAGE_CHILDREN.
+    rss = peak_rss()
+    for stats in self._stats:
+      stats['peak_rss'] = rss
+    self._stats = []
+    return False
+
+  def _compute(self, wins):
+    if self._evaluate is not None:
+      return [(win, self._evaluate(self._ctx, win)) for win in wins]
+    return [(win, self._rasterset._eval_block(self._ctx, win, self._nodata,
+                                              self._buffers))
+            for win in wins]
+
+  def jobs(self, windows):
+    return batches(windows, self._batch)
+
+  @property
+  def _shared(self):
+    '''Whether blocks come back through shared memory.'''
+    return self._kind == 'processes' and self._evaluate is None
+
+  def submit(self, wins):
+    if self._kind == 'processes':
+      future = self._pool.submit(_eval_batch, wins)
+    else:
+      future = self._pool.submit(self._compute, wins)
+    self._pending.add(future)
+    return future
+
+  def consume(self, future, fn):
+    '''Call fn(window, blocks) for every block computed by a job.  The
+blocks are only valid for the duration of the call.  The shared memory
+of the job is released even when fn raises.'''
+    self._pending.discard(future)
+    results = future.result()
+    if not self._shared:
+      for win, outs in results:
+        fn(win, outs)
+        if self._evaluate is None:
+          for arr in outs.values():
+            self._buffers.put(arr)
+      return
+    try:
+      for win, outs in results:
+        shms = {}
+        arrays = {}
+        try:
+          for name in list(outs.keys()):
+            shms[name], arrays[name] = attach(outs.pop(name))
+          fn(win, arrays)
+        finally:
+          del arrays
+          for shm in shms.values():
+            shm.close()
+            shm.unlink()
+    finally:
+      # Blocks left when fn raised.
+      release_results(results)
+
+  def run(self, windows, fn, max_inflight=None):
+    '''Evaluate all windows and call fn(window, blocks) for every block in
+the order blocks complete.  At most max_inflight jobs (default: twice
+the number of workers) are outstanding at any time so memory use is
+bounded by the number of blocks in flight rather than the size of the
+raster.  Returns a dictionary with scheduling statistics.  Its
+peak_rss entry (see peak_rss()) is filled in when the executor shuts
+down, once the worker processes have exited; read it after leaving the
+with block.'''
+    if max_inflight is None:
+      max_inflight = 2 * self.num_workers
+    if max_inflight < 1:
+      raise ValueError('max_inflight must be at least 1')
+    stats = {'jobs': 0, 'blocks': 0, 'peak_inflight': 0, 'peak_rss': None}
+    self._stats.append(stats)
+
+    def drain(pending):
+      done, pending = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        self.consume(future, fn)
+      return pending
+
+    pending = set()
+    for wins in self.jobs(windows):
+      while len(pending) >= max_inflight:
+        pending = drain(pending)
+      pending.add(self.submit(wins))
+      stats['jobs'] += 1
+      stats['blocks'] += len(wins)
+      stats['peak_inflight'] = max(stats['peak_inflight'], len(pending))
+    while pending:
+      pending = drain(pending)
+    return stats
@@ -0,0 +1,190 @@
+import math
+import os
+import threading
+
+from affine import Affine
+import numpy as np
+import numpy.ma as ma
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+
+from .raster import Raster
+
+## The HDF5 library is not thread safe: every access to a dataset goes
+## through this lock.
+_LOCK = threading.RLock()
+## Open datasets keyed by file name.  One handle per process, shared by
+## all threads and variables.
+_DATASETS = {}
+_PID = None
+## Upper bound of the HDF5 chunk cache of each variable.
+MAX_CHUNK_CACHE = 256 * 1024 * 1024
+
+def open_dataset(fname):
+  '''Return the dataset for fname, opening it on first use in this
+process.'''
+  global _PID
+  import netCDF4
+  with _LOCK:
+    if _PID != os.getpid():
+      # Handles are never shared with the parent process.
+      _DATASETS.clear()
+      _PID = os.getpid()
+    if fname not in _DATASETS:
+      try:
+        _DATASETS[fname] = netCDF4.Dataset(fname)
+      except IOError as e:
+        print("Error: opening '%s'" % fname)
+        raise IOError("Error: opening '%s'" % fname)
+    return _DATASETS[fname]
+
+class NetCDFReader(object):
+  '''Presents a (time, lat, lon) variable of a NetCDF file with the
+subset of the rasterio dataset interface used by RasterSet.  Band b is
+time step b - 1.  Reads go straight to the HDF5 hyperslab of the window
+and several bands are read with a single hyperslab.'''
+  def __init__(self, fname, variable):
+    self._fname = fname
+    self._variable = variable
+    with _LOCK:
+      ds = open_dataset(fname)
+      var = ds.variables[variable]
+      if len(var.dimensions) != 3:
+        raise ValueError('%s:%s: expected a (time, lat, lon) variable' %
+                         (fname, variable))
+      lats = np.asarray(ds.variables[var.dimensions[1]][:], dtype=np.float64)
+      lons = np.asarray(ds.variables[var.dimensions[2]][:], dtype=np.float64)
+      self._count = var.shape[0]
+      self._dtype = np.dtype(var.dtype).name
+      self._nodata = getattr(var, '_FillValue', None)
+      chunks = var.chunking()
+      if chunks == 'contiguous':
+        # Mimic GDAL: one row per block.
+        chunks = (1, 1, var.shape[2])
+      self._chunks = tuple(chunks)
+      # Cache a full row of chunks so reading the blocks of a row of
+      # windows decodes each chunk once.
+      size = (np.dtype(var.dtype).itemsize * int(np.prod(chunks[:2])) *
+              var.shape[2])
+      var.set_var_chunk_cache(size=min(size, MAX_CHUNK_CACHE))
+    self.height, self.width = len(lats), len(lons)
+    rx = (lons[-1] - lons[0]) / max(len(lons) - 1, 1)
+    ry = (lats[-1] - lats[0]) / max(len(lats) - 1, 1)
+    # Row 0 is the northernmost row.
+    self._flip = ry > 0
+    ry = abs(ry)
+    self.res = (rx, ry)
+    self.affine = Affine(rx, 0.0, lons[0] - rx / 2.0,
+                         0.0, -ry, lats.max() + ry / 2.0)
+    self.transform = self.affine
+    self.crs = CRS.from_string(u'epsg:4326')
+
+  @property
+  def name(self):
+    return 'netcdf:%s:%s' % (self._fname, self._variable)
+
+  @property
+  def count(self):
+    return self._count
+
+  @property
+  def bounds(self):
+    left, top = self.affine * (0, 0)
+    right, bottom = self.affine * (self.width, self.height)
+    return BoundingBox(left, bottom, right, top)
+
+  @property
+  def block_shapes(self):
+    return [self._chunks[1:]] * self._count
+
+  @property
+  def dtypes(self):
+    return [self._dtype] * self._count
+
+  @property
+  def nodata(self):
+    return self._nodata
+
+  @property
+  def meta(self):
+    return {'driver': 'netCDF', 'dtype': self._dtype, 'nodata': self._nodata,
+            'width': self.width, 'height': self.height, 'count': self._count,
+            'crs': self.crs, 'transform': self.affine, 'affine': self.affine}
+
+  def window(self, left, bottom, right, top):
+    inv = ~self.affine
+    c0, r0 = inv * (left, top)
+    c1, r1 = inv * (right, bottom)
+    return ((int(math.floor(r0 + 0.5)), int(math.floor(r1 + 0.5))),
+            (int(math.floor(c0 + 0.5)), int(math.floor(c1 + 0.5))))
+
+  def window_transform(self, window):
+    return self.affine * Affine.translation(window[1][0], window[0][0])
+
+  def read(self, indexes=None, window=None, masked=False):
+    '''Read one band (a 2-D array) or a list of bands (a 3-D array).
+Bands between the first and the last band in the list are read as a
+single hyperslab.'''
+    if indexes is None:
+      indexes = list(range(1, self._count + 1))
+    bands = [indexes] if isinstance(indexes, int) else list(indexes)
+    if window is None:
+      window = ((0, self.height), (0, self.width))
+    (r0, r1), (c0, c1) = window
+    if self._flip:
+      rows = slice(self.height - r1, self.height - r0)
+    else:
+      rows = slice(r0, r1)
+    t0, t1 = min(bands) - 1, max(bands)
+    with _LOCK:
+      var = open_dataset(self._fname).variables[self._variable]
+      data = var[t0:t1, rows, c0:c1]
+    data = ma.masked_invalid(ma.asarray(data)[[b - 1 - t0 for b in bands]],
+                             copy=False)
+    if self._flip:
+      data = data[:, ::-1, :]
+    if not masked:
+      fill = self._nodata if self._nodata is not None else np.nan
+      data = data.filled(fill)
+    return data[0] if isinstance(indexes, int) else data
+
+  def read_masks(self, band=1, window=None):
+    data = self.read(band, window=window, masked=True)
+    return np.where(ma.getmaskarray(data), 0, 255).astype(np.uint8)
+
+class NetCDFRaster(Raster):
+  '''A time step of a (time, lat, lon) variable of a NetCDF (or HDF5)
+file, read with netCDF4 instead of GDAL's netcdf: driver.  band is the
+1-based time index, as with GDAL.  All the variables of a file share a
+single handle per process, and blocks follow the chunking of the
+variable.'''
+  def __init__(self, name, fname, variable, band=1):
+    super(NetCDFRaster, self).__init__(name, fname, band)
+    self._variable = variable
+    self._reader = None
+
+  @property
+  def variable(self):
+    return self._variable
+
+  @property
+  def path(self):
+    return self._fname
+
+  @property
+  def stamp(self):
+    return super(NetCDFRaster, self).stamp + (self._variable, )
+
+  @property
+  def reader(self):
+    if self._reader is None:
+      self._reader = NetCDFReader(self._fname, self._variable)
+    return self._reader
+
+  def reset_reader(self):
+    self._threadlocal = threading.local()
+
+  @property
+  def group_key(self):
+    # Time steps of the same variable are read as one hyperslab.
+    return (self._fname, self._variable, self._window)
@@ -1,9 +1,15 @@
+import collections
+import os
+import re
+
 import numpy as np
 import numpy.ma as ma
 import rasterio
 import rasterio.errors
 import threading
 
+from . import rastercache
+
 
 def window_inset(win1, win2):
   if win2:
@@ -11,6 +17,44 @@ def window_inset(win1, win2):
             (win1[1][0] + win2[1][0], min(win1[1][0] + win2[1][1], win1[1][1])))
   return win1
 
+## Open datasets, per thread and keyed by file name, shared by all the
+## Raster objects that read the same file (e.g. different bands).
+_READERS = threading.local()
+
+def shared_reader(fname):
+  '''Return this thread's reader for fname.'''
+  readers = getattr(_READERS, 'readers', None)
+  if readers is None:
+    readers = _READERS.readers = {}
+  if fname not in readers:
+    readers[fname] = rasterio.open(fname)
+  return readers[fname]
+
+def reset_readers():
+  '''Forget all shared readers, e.g. after forking a worker process.'''
+  global _READERS
+  _READERS = threading.local()
+
+def read_grouped(rasters, window=None):
+  '''Read window from several rasters.  Rasters that are bands of the
+same file (see Raster.group_key) are read with a single multi-band read
+so each block of the file is only decoded once.  The data is handed to
+each raster on its next eval() or read() of the same window.'''
+  groups = collections.OrderedDict()
+  for raster in rasters:
+    key = raster.group_key
+    if key is not None:
+      groups.setdefault(key, []).append(raster)
+  for group in groups.values():
+    bands = sorted(set(raster.band for raster in group))
+    if len(bands) < 2:
+      continue
+    first = group[0]
+    win = window_inset(first.window, window)
+    data = first.reader.read(bands, window=win, masked=True)
+    for raster in group:
+      raster._threadlocal.prefetched = (window, data[bands.index(raster.band)])
+
 class Raster(object):
   def __init__(self, name, fname, band=1):
     self._name = name
@@ -19,6 +63,7 @@ class Raster(object):
     self._band = band
     self._window = None
     self._mask = None
+    self._local = None
 
   @property
   def name(self):
@@ -28,16 +73,65 @@ class Raster(object):
   def syms(self):
     return []
 
+  @property
+  def fname(self):
+    return self._fname
+
+  @property
+  def band(self):
+    return self._band
+
+  @property
+  def path(self):
+    '''Path of the file on the local file system that holds the data,
+i.e. the file name stripped of any GDAL driver prefix or suffix.'''
+    path = re.sub(r'^(netcdf|NETCDF|HDF5|hdf5):', '', self._fname)
+    path = re.sub(r'^(zip|tar|gzip)://?', '', path)
+    path = re.sub(r'^/vsi(zip|tar|gzip)/', '', path)
+    path = path.split('!')[0]
+    if not os.path.exists(path) and ':' in path:
+      # netcdf:file.nc:variable
+      path = path.rsplit(':', 1)[0]
+    return path
+
+  @property
+  def local_fname(self):
+    '''Name of the raster that is opened.  Rasters GDAL can only read
+sequentially (e.g. inside a zip file) are read from a tiled copy (see
+rastercache.local_copy()).'''
+    if self._local is None:
+      self._local = rastercache.local_copy(self._fname, self.path)
+    return self._local
+
+  @property
+  def stamp(self):
+    '''Tuple that changes whenever the data in the raster changes.'''
+    try:
+      mtime = os.path.getmtime(self.path)
+    except OSError:
+      mtime = None
+    return (self._fname, self._band, mtime)
+
   @property
   def reader(self):
-    if getattr(self._threadlocal, 'reader', None) is None:
-      try:
-        self._threadlocal.reader = rasterio.open(self._fname)
-      except (SystemError, rasterio.errors.RasterioIOError) as e:
-        print("Error: opening raster '%s' for %s" % (self._fname, self.name))
-        raise SystemError("Error: opening raster '%s' for %s" %
-                          (self._fname, self.name))
-    return self._threadlocal.reader
+    try:
+      return shared_reader(self.local_fname)
+    except (SystemError, rasterio.errors.RasterioIOError) as e:
+      print("Error: opening raster '%s' for %s" % (self._fname, self.name))
+      raise SystemError("Error: opening raster '%s' for %s" %
+                        (self._fname, self.name))
+
+  def reset_reader(self):
+    '''Forget all open readers, e.g. after forking a worker process.'''
+    self._threadlocal = threading.local()
+    reset_readers()
+
+  @property
+  def group_key(self):
+    '''Rasters with the same key are bands of the same dataset and can be
+read together (see read_grouped()).  None if the raster cannot be read
+together with others.'''
+    return (self._fname, self._window)
 
   @property
   def window(self):
@@ -63,21 +157,42 @@ class Raster(object):
   def dtype(self):
     return self.reader.dtypes[self._band - 1]
   
-  def eval(self, df, window=None):
+  def _read(self, window):
     assert self.window
+    prefetched = getattr(self._threadlocal, 'prefetched', None)
+    if prefetched is not None:
+      self._threadlocal.prefetched = None
+      if prefetched[0] == window:
+        return prefetched[1]
     win = window_inset(self.window, window)
     try:
-      data = self.reader.read(self._band, window=win, masked=True)
+      return self.reader.read(self._band, window=win, masked=True)
     except IndexError as e:
       print("Error: reading band %d from %s" % (self._band, self._fname))
       raise IndexError("Error: reading band %d from %s" %
                        (self._band, self._fname))
+
+  def _mask_window(self, window):
+    if window:
+      return self.mask[window[0][0]:window[0][1], window[1][0]:window[1][1]]
+    return self.mask
+
+  def eval(self, df, window=None):
+    data = self._read(window)
     ## HPD raster sometimes has NODATA values that leak.
     data = ma.where(data < -1e20, np.nan, data)
     if self.mask is not None:
-      if window:
-        data.mask = data.mask | self.mask[window[0][0]:window[0][1],
-                                          window[1][0]:window[1][1]]
-      else:
-        data.mask = data.mask | self.mask
+      data.mask = data.mask | self._mask_window(window)
     return data
+
+  def read(self, window=None):
+    '''Read the raster without building a masked array.  Returns a
+float32 array and a boolean array that is True for invalid cells.'''
+    data = self._read(window)
+    invalid = ma.getmaskarray(data)
+    data = ma.getdata(data).astype(np.float32, copy=False)
+    ## HPD raster sometimes has NODATA values that leak.
+    data[data < -1e20] = np.nan
+    if self.mask is not None:
+      invalid = invalid | self._mask_window(window)
+    return data, invalid
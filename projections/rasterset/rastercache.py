@@ -0,0 +1,107 @@
+import hashlib
+import os
+import re
+import threading
+
+import numpy as np
+import rasterio
+import rasterio.errors
+
+## Sources GDAL can only read sequentially: rasters inside compressed
+## archives and ASCII grids.
+_ARCHIVE = re.compile(r'^(zip|tar|gzip)://?|^/vsi(zip|tar|gzip)/')
+_SEQUENTIAL = ('.asc', )
+
+## Tile size of the converted rasters.
+TILE = 512
+
+_LOCK = threading.Lock()
+_CONVERTED = {}
+
+def is_sequential(fname):
+  '''Return True if fname names a raster GDAL cannot read a block of
+without decoding everything before it.'''
+  return bool(_ARCHIVE.match(fname) or
+              fname.split('!')[-1].lower().endswith(_SEQUENTIAL))
+
+def enabled():
+  '''Conversion is disabled by setting $RASTER_CACHE to off.'''
+  return os.environ.get('RASTER_CACHE', '').lower() not in ('off', 'no', '0')
+
+def cache_dir(path):
+  '''Directory of the converted copies of the rasters in the file path:
+$RASTER_CACHE or a .raster-cache directory next to path.'''
+  if os.environ.get('RASTER_CACHE'):
+    return os.environ['RASTER_CACHE']
+  return os.path.join(os.path.dirname(os.path.abspath(path)), '.raster-cache')
+
+def cache_path(fname, path):
+  base = re.sub(r'[^\w.-]', '_', os.path.basename(fname.split('!')[-1]))
+  digest = hashlib.sha256(fname.encode('utf-8')).hexdigest()[:16]
+  return os.path.join(cache_dir(path), '%s-%s.tif' % (base, digest))
+
+def source_tags(path):
+  st = os.stat(path)
+  return {'SOURCE_SIZE': str(st.st_size), 'SOURCE_MTIME': str(st.st_mtime_ns)}
+
+def is_fresh(dst, tags):
+  '''Whether the converted copy dst was made from the current version of
+the source (same size and modification time).'''
+  if not os.path.isfile(dst):
+    return False
+  try:
+    with rasterio.open(dst) as ds:
+      have = ds.tags()
+  except rasterio.errors.RasterioIOError:
+    return False
+  return all(have.get(k) == v for k, v in tags.items())
+
+def convert(fname, dst, tags):
+  '''Copy the raster fname into a tiled, deflate compressed GeoTIFF.  The
+source is read in strips of full rows, in order, which is the access
+pattern sequential sources handle well.  The copy is written under a
+temporary name and renamed into place, so readers never see a partial
+file.'''
+  tmp = '%s.%d.tmp' % (dst, os.getpid())
+  with rasterio.open(fname) as src:
+    meta = src.meta.copy()
+    meta.update({'driver': 'GTiff', 'tiled': True, 'blockxsize': TILE,
+                 'blockysize': TILE, 'compress': 'deflate',
+                 'predictor': 3 if np.dtype(src.dtypes[0]).kind == 'f' else 2,
+                 'bigtiff': 'IF_SAFER'})
+    try:
+      with rasterio.open(tmp, 'w', **meta) as out:
+        for row in range(0, src.height, TILE):
+          win = ((row, min(row + TILE, src.height)), (0, src.width))
+          out.write(src.read(window=win), window=win)
+        out.update_tags(SOURCE=fname, **tags)
+      os.rename(tmp, dst)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+def local_copy(fname, path):
+  '''Return the name to open for the raster fname (stored in the file
+path).  Sequential sources (see is_sequential()) are converted once into
+a tiled GeoTIFF in the cache directory and the copy is returned; it is
+converted again when the size or the modification time of path changes.
+Other sources, or sources whose copy cannot be written, are returned
+unchanged.'''
+  if not (enabled() and is_sequential(fname) and os.path.isfile(path)):
+    return fname
+  tags = source_tags(path)
+  with _LOCK:
+    key = (fname, tags['SOURCE_SIZE'], tags['SOURCE_MTIME'])
+    if key in _CONVERTED:
+      return _CONVERTED[key]
+    dst = cache_path(fname, path)
+    if not is_fresh(dst, tags):
+      try:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        print('converting %s' % fname)
+        convert(fname, dst, tags)
+      except (OSError, rasterio.errors.RasterioIOError) as e:
+        print('WARNING: cannot cache %s (%s)' % (fname, e))
+        dst = fname
+    _CONVERTED[key] = dst
+    return dst
@@ -53,3 +53,16 @@ class RasterCol(object):
       return self._eval(df, window)
     else:
       return self._eval(df)
+
+class OutputSelector(object):
+  '''Select one output (row) of a multi-output column.'''
+  def __init__(self, column, index):
+    self._column = column
+    self._index = index
+
+  @property
+  def syms(self):
+    return [self._column]
+
+  def eval(self, df):
+    return df[self._column][self._index]
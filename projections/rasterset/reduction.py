@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+REDUCE_OPS = ('sum', 'mean', 'count', 'hist')
+
+def check_ops(ops, bins):
+  for op in ops:
+    if op not in REDUCE_OPS:
+      raise ValueError("unknown reduction '%s' (expected one of %s)" %
+                       (op, ', '.join(REDUCE_OPS)))
+  if 'hist' in ops and bins is None:
+    raise ValueError('hist reduction requires bins')
+
+def partial(values, zones=None, weights=None, bins=None):
+  '''Compute the per-zone partial aggregates of one block.  All
+arguments are dense vectors of the same length (zones and weights are
+optional); cells where any of them is NaN are ignored.  Returns a
+DataFrame indexed by zone with the weighted sum, the sum of the
+weights, the number of cells and (when bins is given) the weighted
+histogram of the values.'''
+  valid = ~np.isnan(values)
+  if zones is not None:
+    valid &= ~np.isnan(zones)
+  if weights is not None:
+    valid &= ~np.isnan(weights)
+  values = values[valid].astype(np.float64)
+  if weights is None:
+    weights = np.ones_like(values)
+  else:
+    weights = weights[valid].astype(np.float64)
+  if zones is None:
+    ids = np.zeros(1, dtype=np.int64)
+    idx = np.zeros(len(values), dtype=np.intp)
+  else:
+    ids, idx = np.unique(zones[valid].astype(np.int64), return_inverse=True)
+  nzones = len(ids)
+  cols = {'sum': np.bincount(idx, weights * values, minlength=nzones),
+          'weight': np.bincount(idx, weights, minlength=nzones),
+          'count': np.bincount(idx, minlength=nzones)}
+  if bins is not None:
+    nbins = len(bins) - 1
+    # Same convention as np.histogram: the last bin is closed.
+    which = np.searchsorted(bins, values, side='right') - 1
+    which[values == bins[-1]] = nbins - 1
+    inside = (which >= 0) & (which < nbins)
+    hist = np.bincount(idx[inside] * nbins + which[inside], weights[inside],
+                       minlength=nzones * nbins).reshape(nzones, nbins)
+    for i in range(nbins):
+      cols['hist_%d' % i] = hist[:, i]
+  return pd.DataFrame(cols, index=pd.Index(ids, name='zone'))
+
+def combine(acc, part):
+  '''Add the partial aggregates of a block to the running totals.'''
+  if acc is None:
+    return part
+  return acc.add(part, fill_value=0)
+
+def finish(acc, ops, bins=None):
+  '''Turn the accumulated partial aggregates into the requested
+reductions.'''
+  if acc is None:
+    acc = partial(np.empty(0, dtype=np.float32), bins=bins).iloc[0:0]
+  acc = acc.sort_index()
+  out = pd.DataFrame(index=acc.index)
+  for op in ops:
+    if op == 'sum':
+      out['sum'] = acc['sum']
+    elif op == 'mean':
+      out['mean'] = acc['sum'] / acc['weight'].where(acc['weight'] != 0)
+    elif op == 'count':
+      out['count'] = acc['count'].astype(np.int64)
+    elif op == 'hist':
+      for i in range(len(bins) - 1):
+        out['hist_%d' % i] = acc['hist_%d' % i]
+  return out
@@ -0,0 +1,137 @@
+import numpy as np
+import numpy.ma as ma
+from affine import Affine
+
+## Number of time steps per chunk.  A chunk covers TIME_CHUNK years of
+## one block of the map, so reading a time series of a window touches
+## 1 / TIME_CHUNK as many chunks as there are years, while writing a year
+## rewrites the chunks of its block only.
+TIME_CHUNK = 8
+
+def is_zarr(path):
+  '''Whether path names a zarr store (a directory ending in .zarr).'''
+  return path.rstrip('/').endswith('.zarr')
+
+def synchronizer(path):
+  '''Locks shared by every process that writes to the store path.'''
+  import zarr
+  return zarr.ProcessSynchronizer(path.rstrip('/') + '.sync')
+
+def crs_string(crs):
+  if hasattr(crs, 'to_wkt'):
+    return crs.to_wkt()
+  if hasattr(crs, 'to_string'):
+    return crs.to_string()
+  return str(crs)
+
+class ZarrSlice(object):
+  '''A time step of the (time, y, x) array name in the zarr store path,
+with the subset of the rasterio dataset interface used by
+RasterSet.write_many().  The time step is appended to the array (created
+on first use) unless the array already has it, in which case it is
+overwritten.
+
+Several processes can write to the same store at the same time, e.g. one
+per year: the array is created and extended under a lock and the chunks
+are written under per-chunk locks (see synchronizer()).  Blocks written
+by one process never overlap because spatial chunks match the blocks of
+the RasterSet.'''
+  def __init__(self, path, name, meta, time, block_shape):
+    import zarr
+    self._path = path
+    self._name = name
+    self._time = time
+    sync = synchronizer(path)
+    height, width = meta['height'], meta['width']
+    attrs = {'crs': crs_string(meta['crs']),
+             'transform': tuple(meta['transform'])[:6],
+             'nodata': meta['nodata']}
+    with sync['.append']:
+      root = zarr.open_group(path, mode='a', synchronizer=sync)
+      if name not in root:
+        root.create_dataset(name, shape=(0, height, width),
+                            chunks=(TIME_CHUNK, ) + tuple(block_shape),
+                            dtype='f4', fill_value=meta['nodata'])
+      # Other processes resize the array: never trust cached metadata.
+      self._array = zarr.open_array(path, mode='r+', path=name,
+                                    synchronizer=sync, cache_metadata=False,
+                                    cache_attrs=False)
+      self.check(attrs, (height, width))
+      times = list(self._array.attrs.get('time', []))
+      self._fresh = time not in times
+      if self._fresh:
+        times.append(time)
+        self._array.attrs.update(attrs)
+        self._array.attrs['time'] = times
+        self._array.resize(len(times), height, width)
+      self._index = times.index(time)
+
+  def check(self, attrs, shape):
+    if self._array.shape[1:] != shape:
+      raise ValueError('%s/%s: shape %s does not match %s' %
+                       (self._path, self._name, self._array.shape[1:],
+                        shape))
+    for key, value in attrs.items():
+      have = self._array.attrs.get(key)
+      if have is None:
+        continue
+      if key == 'transform':
+        have, value = tuple(have), tuple(value)
+      if have != value:
+        raise ValueError('%s/%s: %s %s does not match %s' %
+                         (self._path, self._name, key, have, value))
+
+  @property
+  def name(self):
+    return '%s/%s' % (self._path, self._name)
+
+  @property
+  def fresh(self):
+    '''True when the time step was appended (every cell reads as nodata
+until written).'''
+    return self._fresh
+
+  def write(self, arr, window=None, indexes=1):
+    if window is None:
+      window = ((0, self._array.shape[1]), (0, self._array.shape[2]))
+    (r0, r1), (c0, c1) = window
+    self._array[self._index, r0:r1, c0:c1] = ma.getdata(arr)
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class ZarrSeries(object):
+  '''Read access to the (time, y, x) array name of the zarr store path.
+Time steps are returned in increasing order, whatever the order in which
+they were written.'''
+  def __init__(self, path, name):
+    import zarr
+    self._array = zarr.open_array(path, mode='r', path=name)
+    times = list(self._array.attrs['time'])
+    self._order = np.argsort(times, kind='stable')
+    self.times = [times[i] for i in self._order]
+    self.nodata = self._array.attrs['nodata']
+    self.crs = self._array.attrs['crs']
+    self.affine = Affine(*self._array.attrs['transform'])
+    self.height, self.width = self._array.shape[1:]
+
+  def window(self, left, bottom, right, top):
+    inv = ~self.affine
+    c0, r0 = inv * (left, top)
+    c1, r1 = inv * (right, bottom)
+    return ((int(round(r0)), int(round(r1))), (int(round(c0)), int(round(c1))))
+
+  def read(self, window=None):
+    '''Return a masked (time, y, x) array with every time step of the
+window, read with one pass over the chunks.'''
+    if window is None:
+      window = ((0, self.height), (0, self.width))
+    (r0, r1), (c0, c1) = window
+    data = self._array[:, r0:r1, c0:c1][self._order]
+    return ma.masked_equal(data, self.nodata, copy=False)
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+import click
+
+from ..r2py import modeldesc
+
+@click.command()
+@click.argument('rds', nargs=-1, type=click.Path(dir_okay=False, exists=True))
+def main(rds):
+  """Export the models in RDS files to model descriptions (JSON files
+next to the RDS files).  Projections compile the models from the
+descriptions, so they do not need rpy2 or R.
+
+  """
+  for fname in rds:
+    path = modeldesc.export(fname)
+    click.echo('%s -> %s' % (fname, path))
+
+if __name__ == '__main__':
+  main()
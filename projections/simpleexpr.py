@@ -1,17 +1,25 @@
 
+from functools import reduce
+import re
+import threading
+import warnings
+
 import numpy as np
 import numpy.ma as ma
 
 import projections.r2py.reval as reval
 import projections.r2py.rparser as rparser
+import projections.r2py.tree as tree
 
 class SimpleExpr():
   def __init__(self, name, expr):
     self.name = name
-    self.tree = reval.make_inputs(rparser.parse(expr))
+    self.tree = tree.optimize(reval.make_inputs(rparser.parse(expr)))
     lokals = {}
     exec(reval.to_py(self.tree, name), lokals)
     self.func = lokals[name + '_st']
+    # Used instead of func when the inputs are dense (see eval()).
+    self.dense = reval.dense_func(self.tree)
 
   @property
   def syms(self):
@@ -19,7 +27,12 @@ class SimpleExpr():
   
   def eval(self, df, window=None):
     try:
-      res = self.func(df)
+      if self.dense is not None:
+        args = [df[arg] for arg in sorted(set(self.syms))]
+      if self.dense is not None and reval.is_dense(args):
+        res = self.dense(*args)
+      else:
+        res = self.func(df)
     except KeyError as e:
       print("Error: input '%s' not defined" % e)
       raise e
@@ -32,3 +45,58 @@ class SimpleExpr():
         w = window[1][1] - window[1][0]
         res = ma.masked_array(np.full((h, w), res, dtype=np.float32))
     return res
+
+## Compiled kernels shared by all FusedExpr with the same expression.
+_KERNELS = {}
+_KERNELS_LOCK = threading.Lock()
+
+class FusedExpr(SimpleExpr):
+  '''A SimpleExpr whose tree is the result of inlining a chain of
+pointwise SimpleExpr columns.  The whole tree is compiled into a single
+numba kernel so the intermediate columns are never materialised.  If
+numba cannot compile the expression it falls back to numpy.'''
+  def __init__(self, name, tree):
+    self.name = name
+    self.tree = tree
+    self._func = None
+
+  def _compile(self):
+    key = repr(self.tree)
+    with _KERNELS_LOCK:
+      if key not in _KERNELS:
+        fname = 'fused_' + re.sub(r'\W', '_', self.name)
+        lokals = {}
+        try:
+          # to_numba() modifies the tree it is given.
+          exec(reval.to_numba(tree.clone(self.tree), fname, self.name,
+                              cache=False, typed=False,
+                              error_model='numpy'), lokals)
+          func = lokals[fname]
+          args = self.syms
+          _KERNELS[key] = (func, tuple(sorted(args)), True)
+        except Exception as e:
+          warnings.warn('could not fuse %s (%s); using numpy' %
+                        (self.name, e), RuntimeWarning)
+          exec(reval.to_py(self.tree, fname), lokals)
+          _KERNELS[key] = (lokals[fname], tuple(sorted(self.syms)), False)
+      self._func = _KERNELS[key]
+
+  def eval(self, df, window=None):
+    if self._func is None:
+      self._compile()
+    func, args, jitted = self._func
+    ins = [df[arg] for arg in args]
+    if not jitted:
+      return func(*ins)
+    masks = [ma.getmask(x) for x in ins if ma.getmask(x) is not ma.nomask]
+    shape = ins[0].shape
+    res = func(*[np.ascontiguousarray(ma.getdata(x)).reshape(-1) for x in ins])
+    res = res.reshape(shape)
+    # Cells numpy.ma masks inside the chain (log() of a negative, division
+    # by zero, ...) come out of the kernel as NaN or inf.
+    invalid = ~np.isfinite(res)
+    if invalid.any():
+      masks.append(invalid)
+    if masks:
+      return ma.masked_array(res, mask=reduce(np.logical_or, masks))
+    return res
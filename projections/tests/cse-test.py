@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+## Check that common subexpression elimination leaves the linear
+## predictor of a model in a var node, so the generated code evaluates it
+## once per pixel even though inv_logit() uses its argument twice.  Also
+## check that folding constants preserves NaN unless asked to absorb
+## zeros.
+
+import env
+
+from projections.r2py import reval, rparser, tree
+from projections.r2py.tree import Node, Operator
+
+PREDICTOR = '0.5 + 1.2345 * x + 0.3 * log(y + 1) - 0.2 * x:y'
+
+def glm_equation():
+  # The way glm.GLM builds its equation.
+  expr = rparser.parse(PREDICTOR)
+  return Node(Operator('inv_logit'), [Node(Operator('var'),
+                                           (hash(expr), expr))])
+
+for root in (glm_equation(),
+             rparser.parse('inv_logit(%s)' % PREDICTOR)):
+  root = tree.optimize(reval.make_inputs(root))
+  for src in (reval.to_numba(root, 'm', 'out', cache=False),
+              reval.to_py(root, 'm')):
+    assert src.count('1.234500') == 1, src
+
+for expr in ('0 * x', 'x:0', '0 / x'):
+  root = reval.make_inputs(rparser.parse(expr))
+  assert tuple(reval.find_inputs(tree.fold(root))) == ('x', ), expr
+  assert tree.fold(root, absorb=True) == 0, expr
+  assert tree.fold(root, {'x': 2}) == 0, expr
+print('ok')
@@ -9,3 +9,13 @@ sys.path.append(
         )
     )
 )
+# and the repository root, for imports of the projections package
+sys.path.append(
+    os.path.dirname(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        )
+    )
+)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+## Check that cells masked by a column itself (e.g. log() of a negative
+## value) stay masked, on top of the no-data mask of the sources.
+
+import os
+import tempfile
+
+import env
+
+from affine import Affine
+import numpy as np
+import numpy.ma as ma
+import rasterio
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+
+from projections.rasterset import Raster, RasterSet
+from projections.rasterset.cache import EvalCache
+from projections.simpleexpr import FusedExpr, SimpleExpr
+
+class MemReader(object):
+  '''An in-memory single band raster with the subset of the rasterio
+dataset interface used by RasterSet.  NaN cells are nodata.'''
+  def __init__(self, name, data):
+    self.name = name
+    self._data = data
+    self.height, self.width = data.shape
+    self.count = 1
+    self.affine = Affine(1.0, 0.0, 0.0, 0.0, -1.0, self.height)
+    self.transform = self.affine
+    self.res = (1.0, 1.0)
+    self.crs = CRS.from_epsg(4326)
+    self.bounds = BoundingBox(0, 0, self.width, self.height)
+    self.block_shapes = [(16, 16)]
+    self.dtypes = ['float32']
+    self.nodata = -9999.0
+    self.meta = {'driver': 'GTiff', 'dtype': 'float32', 'nodata': -9999.0,
+                 'width': self.width, 'height': self.height, 'count': 1,
+                 'crs': self.crs, 'transform': self.affine}
+
+  def window(self, left, bottom, right, top):
+    return ((int(round(self.height - top)), int(round(self.height - bottom))),
+            (int(round(left)), int(round(right))))
+
+  def window_transform(self, window):
+    return self.affine * Affine.translation(window[1][0], window[0][0])
+
+  def read(self, indexes=1, window=None, masked=False):
+    if window is None:
+      window = ((0, self.height), (0, self.width))
+    (r0, r1), (c0, c1) = window
+    data = self._data[r0:r1, c0:c1]
+    if masked:
+      data = ma.masked_invalid(data)
+    return data if isinstance(indexes, int) else data[np.newaxis]
+
+  def read_masks(self, band=1, window=None):
+    data = self.read(band, window, masked=True)
+    return np.where(ma.getmaskarray(data), 0, 255).astype(np.uint8)
+
+class MemRaster(Raster):
+  def __init__(self, name, data):
+    super(MemRaster, self).__init__(name, name)
+    self._reader = MemReader(name, data)
+
+  @property
+  def reader(self):
+    return self._reader
+
+def check_compact(expr):
+  rng = np.random.default_rng(0)
+  c1 = rng.random((64, 64), dtype=np.float32)
+  c1[rng.random((64, 64)) < 0.1] = np.nan
+  tmpdir = tempfile.mkdtemp()
+  results = []
+  for compact in (False, True):
+    rs = RasterSet({'c1': MemRaster('c1', c1), 'x': SimpleExpr('x', expr)},
+                   compact=compact)
+    data, meta = rs.eval('x', quiet=True)
+    path = os.path.join(tmpdir, 'x-%d.tif' % compact)
+    rs.write('x', path, executor='serial')
+    with rasterio.open(path) as ds:
+      results.append((data, ds.read(1)))
+  (d1, w1), (d2, w2) = results
+  assert np.array_equal(ma.getmaskarray(d1), ma.getmaskarray(d2)), expr
+  assert np.allclose(d1.compressed(), d2.compressed()), expr
+  assert np.array_equal(w1 == meta['nodata'], w2 == meta['nodata']), expr
+  assert np.allclose(w1, w2), expr
+
+def check_write_many(compact):
+  # Two targets whose sources are masked in different halves of the map.
+  a = np.ones((64, 64), dtype=np.float32)
+  a[:32] = np.nan
+  b = np.full((64, 64), 2.0, dtype=np.float32)
+  b[32:] = np.nan
+  tmpdir = tempfile.mkdtemp()
+  rs = RasterSet({'a': MemRaster('a', a), 'b': MemRaster('b', b),
+                  'aa': SimpleExpr('aa', 'a * 3'),
+                  'bb': SimpleExpr('bb', 'b + 1'),
+                  'ab': SimpleExpr('ab', 'a + b')}, compact=compact,
+                 block_shape=(16, 64))
+  names = ('aa', 'bb', 'ab')
+  outputs = dict((name, os.path.join(tmpdir, name + '.tif')) for name in names)
+  # Blocks where every source of a target is masked are skipped, but
+  # only when they are empty for every target.
+  stats = rs.write_many(outputs, executor='serial')
+  assert stats['skipped'] == 0
+  res = {}
+  for name in names:
+    with rasterio.open(outputs[name]) as ds:
+      res[name] = ds.read(1, masked=True)
+  for name, src in (('aa', a), ('bb', b)):
+    exp, meta = rs.eval(name, quiet=True)
+    assert np.array_equal(ma.getmaskarray(res[name]), np.isnan(src)), name
+    assert np.array_equal(ma.getmaskarray(res[name]), ma.getmaskarray(exp))
+    assert np.allclose(res[name].compressed(), exp.compressed()), name
+  assert ma.getmaskarray(res['ab']).all()
+  stats = rs.write('aa', outputs['aa'], executor='serial')
+  assert stats['skipped'] == 2
+
+def check_constant(compact):
+  # A target that depends on no raster is valid everywhere.
+  a = np.ones((64, 64), dtype=np.float32)
+  a[:32] = np.nan
+  tmpdir = tempfile.mkdtemp()
+  rs = RasterSet({'a': MemRaster('a', a), 'k': SimpleExpr('k', '2'),
+                  'x': SimpleExpr('x', 'a + 1')}, compact=compact,
+                 block_shape=(16, 64))
+  outputs = {'k': os.path.join(tmpdir, 'k.tif'),
+             'x': os.path.join(tmpdir, 'x.tif')}
+  rs.write_many(outputs, executor='serial')
+  with rasterio.open(outputs['k']) as ds:
+    k = ds.read(1, masked=True)
+  assert ma.count_masked(k) == 0
+  assert np.all(k == 2)
+
+def check_cache(spill):
+  rng = np.random.default_rng(0)
+  old_mask = rng.random((64, 64)) < 0.2
+  new_mask = old_mask | (rng.random((64, 64)) < 0.2)
+  full = ma.log(rng.random((64, 64)) - 0.5)
+  cache = EvalCache(spill_dir=tempfile.mkdtemp() if spill else None)
+  cache.put('x', old_mask, full[~old_mask])
+  if spill:
+    cache._evict()
+  got = cache.get('x', new_mask)
+  assert got is not None
+  exp = full[~new_mask]
+  assert np.array_equal(ma.getmaskarray(got), ma.getmaskarray(exp))
+  assert np.array_equal(got.compressed(), exp.compressed())
+  cache.close()
+
+def check_fused(expr):
+  rng = np.random.default_rng(0)
+  a = ma.masked_array(rng.random((64, 64), dtype=np.float32),
+                      mask=rng.random((64, 64)) < 0.1)
+  b = rng.random((64, 64), dtype=np.float32)
+  b[::3] = 0
+  df = {'a': a, 'b': b}
+  exp = SimpleExpr('x', expr).func(df)
+  got = FusedExpr('x', SimpleExpr('x', expr).tree).eval(df)
+  assert np.array_equal(ma.getmaskarray(got), ma.getmaskarray(exp)), expr
+  assert np.allclose(got.compressed(), exp.compressed()), expr
+
+for spill in (False, True):
+  check_cache(spill)
+check_fused('log(a - 0.5) + b')
+check_fused('a / b')
+check_compact('log(c1 - 0.5)')
+check_compact('c1 * 2')
+for compact in (False, True):
+  check_write_many(compact)
+  check_constant(compact)
+print('ok')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+## Check the hand-written parser against the pyparsing grammar.
+## Optionally pass RDS files of GLM models to also compare the parse of
+## every coefficient name.
+
+import sys
+
+import env
+
+from pyparsing import ParseException
+
+from projections.r2py import rparser
+
+TESTS = [
+  'sin( 1 + 2 * x ) + tan( 2.123 * x )',
+  'poly(log(cropland + 1), 3)',
+  'poly(log(cropland + 1), 3)2',
+  'factor(unSub)143:poly(log(cropland + 1), 3)2',
+  'factor(unSub)143:poly(log(cropland + 1), 3)3:poly(log(hpd + 1), 3)2',
+  '(Intercept)',
+  '"Intercept"',
+  '"a quoted name"',
+  'x',
+  '42',
+  '-3',
+  '2.5e-3 * x',
+  '.5 + x',
+  '1e3',
+  'a - b + c',
+  'a + b * c - d / e',
+  'a:b * c',
+  'a | b',
+  'a ^ b ^ c',
+  '(a + b) * (c - d)',
+  '((a))',
+  'x -1',
+  'x - -1',
+  'log(x) - 1',
+  'log(x) -1',
+  'logHPD.rs + logDTR_rs',
+  'scale(log(hpd + 1), 0.0, 1.0, 0.0, 10.020830)',
+  'rescale(hpd, newrange = c(0, 1))',
+  'inv_logit(0.5 + 1.2 * x + 0.3 * log(y + 1) - 0.2 * x:y)',
+  'exp(abundance) / exp(3.3396125)',
+  'clip(x, 0, 1)',
+  'max(gsecd - gfsh1 - gfsh2 - gfsh3, 0)',
+  'min(gothr, gfvh1 + gfvh2)',
+  'pow(Rd_1km, 1/3.)',
+  'I(x^2)',
+  'f()',
+  '0 - logHPD_s2',
+  'mature_secondary + intermediate_secondary + young_secondary',
+  '  x\t+\n1 ',
+]
+
+ERRORS = ['', 'x +', '(x', 'x)', 'f(x,', '1x', 'x y', '+', 'log(x) 2.5']
+
+def outcome(fn, text):
+  try:
+    return repr(fn(text))
+  except (ParseException, rparser.ParseError):
+    return 'error'
+  except AssertionError as e:
+    return 'assert: %s' % e
+
+def check(text):
+  fast = outcome(rparser.parse, text)
+  slow = outcome(rparser.parse_pyparsing, text)
+  assert fast == slow, 'mismatch for %r: %s != %s' % (text, fast, slow)
+  return fast
+
+if __name__ == "__main__":
+  for text in TESTS:
+    tree = check(text)
+    assert tree not in ('error', ), 'failed to parse %r' % text
+    print('%-40s %s' % (text, tree))
+    if not text.startswith(('"', '-', '(Intercept)')):
+      nodes = rparser._Parser(rparser._prepare(text)).parse()
+      assert str(nodes) == str(rparser.PARSER.parseString(
+        rparser._prepare(text), parseAll=True)), 'lists differ for %r' % text
+  for text in ERRORS:
+    assert check(text) == 'error', 'expected an error for %r' % text
+
+  # The cache returns copies.
+  r1 = rparser.parse(TESTS[3])
+  r1.args = ()
+  assert rparser.parse(TESTS[3]) == rparser.parse_pyparsing(TESTS[3])
+
+  if len(sys.argv) > 1:
+    import rpy2.robjects as robjects
+    from projections.r2py import glm
+    for fname in sys.argv[1:]:
+      models = robjects.r('models <- readRDS("%s")' % fname)
+      mod = glm.GLM(models[0])
+      for t in mod.coefficients().itertuples():
+        check(t[0])
+  print('ok')
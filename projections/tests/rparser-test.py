@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 
-from pyparsing import ParseException
-
 import env
 import rparser
 
@@ -41,6 +39,6 @@ if __name__ == "__main__":
     print(factor + " -> ",)
     try:
       print(rparser.parse(factor))
-    except ParseException as e:
+    except rparser.ParseError as e:
       print(e)
       pass
@@ -18,33 +18,50 @@ from rasterio.warp import Resampling, calculate_default_transform, reproject
 import cartopy.crs as ccrs
 from affine import Affine
 
+from projections.rasterset import zarrstore
 import projections.utils as utils
 
 import pdb
 
-def read_historical(start, end, bounds, metric):
-  path = '/out/luh2/historical-%s-%%d.tif' % metric
+def historical_years(start, end, bounds, metric):
+  '''Generate the (year, data) pairs of the historical projection between
+start and end, from the zarr store when there is one (a single read) or
+else from the per-year GeoTIFFs.'''
   nodata = -9999.0
-  data = []
-  last_year = None
+  store = '/out/luh2/historical.zarr'
+  if os.path.isdir(store):
+    series = zarrstore.ZarrSeries(store, metric)
+    assert series.nodata == nodata
+    stack = series.read(series.window(*bounds))
+    for year, d in zip(series.times, stack):
+      if start <= year < end:
+        yield year, d
+    return
+  path = '/out/luh2/historical-%s-%%d.tif' % metric
   for year in range(start, end):
     fname = path % year
     if os.path.isfile(fname):
       with rasterio.open(fname) as src:
         assert src.nodata == nodata
         win = src.window(*bounds)
-        d = src.read(1, masked=True, window=win)
-      if last_year is not None and (year - last_year != 1):
-        ## Interpolate between the values
-        delta = year - last_year
-        f1 = 1. / delta
-        for yy in range(last_year + 1, year):
-          i = yy - last_year
-          dd = data[-1] * i * f1 + d * (delta - i) * f1
-          data.append(dd)
-        pass
-      data.append(d)
-      last_year = year
+        yield year, src.read(1, masked=True, window=win)
+
+def read_historical(start, end, bounds, metric):
+  nodata = -9999.0
+  data = []
+  last_year = None
+  for year, d in historical_years(start, end, bounds, metric):
+    if last_year is not None and (year - last_year != 1):
+      ## Interpolate between the values
+      delta = year - last_year
+      f1 = 1. / delta
+      for yy in range(last_year + 1, year):
+        i = yy - last_year
+        dd = data[-1] * i * f1 + d * (delta - i) * f1
+        data.append(dd)
+      pass
+    data.append(d)
+    last_year = year
   stack = np.stack(data, axis=0)
   stack2 = ma.masked_equal(stack, nodata)
   return stack2
@@ -23,10 +23,12 @@ setup(
       'setuptools',
       'shapely',
       'xlrd',
+      'zarr<3',
     ],
     entry_points='''
         [console_scripts]
         extract_values=projections.scripts.extract_values:main
+        export_model=projections.scripts.export_model:main
         gen_hyde=projections.scripts.gen_hyde:main
         gen_sps=projections.scripts.gen_sps:main
 	hyde2nc=projections.scripts.hyde2nc:main